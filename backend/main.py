@@ -3,14 +3,21 @@ from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import List, Dict, Any, Optional
-import uvicorn
 import numpy as np
 import cv2
 import math
-from sklearn.cluster import KMeans
+import os
 import io
+import sys
 import base64
 
+# Color correction is shared with the desktop app (color_correction.py in the repo root)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from color_correction import (MIN_FIT_PATCHES, MAX_FIT_RESIDUAL, fit_color_correction,
+                              apply_color_correction, pair_mappings)
+# scikit-learn (KMeans) and uvicorn are imported where they are used so that
+# worker start-up does not pay for them.
+
 # -----------------------
 # Config / thresholds
 # -----------------------
@@ -18,6 +25,11 @@ PAD_MIN_AREA = 350
 MAX_MATCH_DISTANCE = 18.0
 LOW_CONF_DISTANCE = 30.0
 
+# Precomputed mapping for the bundled reference chart (see build_calibration.py)
+DEFAULT_CALIBRATION_ARTIFACT = os.environ.get(
+    "KAELION_CALIBRATION_ARTIFACT",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "reference_chart2_calibration.npz"))
+
 ANALYTE_ORDER = [
     "Leukocytes", "Nitrites", "Urobilinogen", "Protein", "pH",
     "Blood", "SpecificGravity", "Ketone", "Bilirubin", "Glucose"
@@ -33,9 +45,15 @@ DIAGNOSIS_TEXT = {
     "SpecificGravity": "Abnormal urine concentration - check hydration or kidney function",
     "Ketone": "Ketones present - abnormal fat metabolism (check for diabetes/ketoacidosis)",
     "Bilirubin": "Bilirubin present - liver dysfunction or bile duct problem",
-    "Glucose": "Glucosuria - elevated urinary glucose (suggestive of diabetes)"
+    "Glucose": "Glucosuria - elevated urinary glucose (suggestive of diabetes)",
+    "AscorbicAcid": "Ascorbic acid present - may mask blood, glucose and nitrite results"
 }
 
+# Strip layouts (pad count / analyte order per strip type), shared with the desktop app
+STRIP_LAYOUTS_PATH = os.environ.get(
+    "KAELION_LAYOUTS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "strip_layouts.json"))
+
 # -----------------------
 # FastAPI + CORS
 # -----------------------
@@ -127,6 +145,7 @@ def ciede2000(Lab_1, Lab_2):
 # Chart patch extraction (similar to original)
 # -----------------------
 def extract_patches_from_chart_image(img_bgr, expected_patches=30):
+    from sklearn.cluster import KMeans
     img = img_bgr.copy()
     h, w = img.shape[:2]
     blur = cv2.GaussianBlur(img, (3,3), 0)
@@ -153,7 +172,8 @@ def extract_patches_from_chart_image(img_bgr, expected_patches=30):
     patches_sorted = sorted(patches, key=lambda p: (p['bbox'][1], p['bbox'][0]))
     return patches_sorted
 
-def prepare_reference_mapping_from_image_bytes(img_bytes, expected_rows=10):
+def prepare_reference_mapping_from_image_bytes(img_bytes, expected_rows=10, analytes=ANALYTE_ORDER):
+    from sklearn.cluster import KMeans
     nparr = np.frombuffer(img_bytes, np.uint8)
     img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
     if img is None:
@@ -171,7 +191,7 @@ def prepare_reference_mapping_from_image_bytes(img_bytes, expected_rows=10):
         ordered_rows = sorted(row_groups.items(), key=lambda kv: np.mean([p['bbox'][1] for p in kv[1]]))
         mapping = {}
         for idx,(row_id, plist) in enumerate(ordered_rows):
-            analyte = ANALYTE_ORDER[idx] if idx < len(ANALYTE_ORDER) else f"custom_{idx}"
+            analyte = analytes[idx] if idx < len(analytes) else f"custom_{idx}"
             plist_sorted = sorted(plist, key=lambda p: p['bbox'][0])
             levels = []
             for j, p in enumerate(plist_sorted):
@@ -182,9 +202,9 @@ def prepare_reference_mapping_from_image_bytes(img_bytes, expected_rows=10):
         return mapping
     except Exception:
         mapping = {}
-        N = len(ANALYTE_ORDER)
+        N = len(analytes)
         per_row = max(1, len(patches)//N)
-        for i, analyte in enumerate(ANALYTE_ORDER):
+        for i, analyte in enumerate(analytes):
             slice_start = i*per_row
             slice_end = slice_start + per_row
             slice_patches = patches[slice_start:slice_end]
@@ -192,6 +212,52 @@ def prepare_reference_mapping_from_image_bytes(img_bytes, expected_rows=10):
             mapping[analyte] = levels
         return mapping
 
+def load_reference_map_json(npz_path):
+    """
+    Load a mapping written by build_calibration.py: analyte -> [(label, [L,a,b]), ...].
+    LAB values are plain lists so the mapping can be returned as JSON; unlike
+    urine_diagnosis.load_reference_mapping() the source hash is not returned.
+    """
+    data = np.load(npz_path, allow_pickle=False)
+    mapping = {}
+    start = 0
+    for analyte, count in zip(data["analytes"], data["level_counts"]):
+        count = int(count)
+        mapping[str(analyte)] = [(str(lbl), data["labs"][start + j].astype(float).tolist())
+                                 for j, lbl in enumerate(data["labels"][start:start+count])]
+        start += count
+    return mapping
+
+# Loaded once at startup; used by /diagnose when the request carries no ref_map
+DEFAULT_REF_MAP = None
+if os.path.exists(DEFAULT_CALIBRATION_ARTIFACT):
+    try:
+        DEFAULT_REF_MAP = load_reference_map_json(DEFAULT_CALIBRATION_ARTIFACT)
+    except Exception as e:
+        print("Warning: could not load default calibration:", e)
+
+def load_strip_layouts(path):
+    """Load strip_layouts.json: returns ({name: {analytes, pad_centers, pad_height, ...}}, default_name)."""
+    import json
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    layouts = config["layouts"]
+    return layouts, config.get("default", next(iter(layouts)))
+
+STRIP_LAYOUTS, DEFAULT_LAYOUT = {"urs_10": {"analytes": ANALYTE_ORDER}}, "urs_10"
+if os.path.exists(STRIP_LAYOUTS_PATH):
+    try:
+        STRIP_LAYOUTS, DEFAULT_LAYOUT = load_strip_layouts(STRIP_LAYOUTS_PATH)
+    except Exception as e:
+        print("Warning: could not load strip layouts:", e)
+
+def layout_analytes(layout):
+    """Analyte order (top to bottom) of a strip layout; HTTP 400 for unknown names."""
+    name = layout or DEFAULT_LAYOUT
+    if name not in STRIP_LAYOUTS:
+        raise HTTPException(status_code=400, detail=f"Unknown strip layout '{name}'. Available: {', '.join(STRIP_LAYOUTS)}")
+    return STRIP_LAYOUTS[name]["analytes"]
+
 # -----------------------
 # Matching & interpreting
 # -----------------------
@@ -250,21 +316,44 @@ class DiagnoseRequest(BaseModel):
     pads: List[PadRGB]  # ordered top→bottom, one entry per analyte/pad
     ref_map: Optional[Dict[str, List[List[Any]]]] = None  
     # ref_map format: analyte -> [ [label, [L,a,b]], ... ]
+    layout: Optional[str] = None  # strip layout name (GET /layouts); default layout if omitted
+    correction: Optional[List[List[float]]] = None
+    # 3x4 LAB correction from /calibrate; applied to the pad colors before matching
 
 # -----------------------
 # Endpoints
 # -----------------------
 @app.post("/calibrate")
-async def calibrate_chart(file: UploadFile = File(...), expected_rows: int = len(ANALYTE_ORDER)):
+async def calibrate_chart(file: UploadFile = File(...), expected_rows: Optional[int] = None,
+                          layout: Optional[str] = None):
     """
     Upload reference chart image (multipart file). Returns a mapping analyte -> [(label, [L,a,b]), ...]
     Save this mapping client-side (frontend) and send it with /diagnose calls.
+    Chart rows are named after the analytes of `layout` (query param, default layout if omitted).
+    When the photographed chart pairs up with the bundled reference chart, a 3x4 `correction`
+    (photo colors -> reference colors) is returned too: send it to /diagnose without a ref_map
+    to match against the bundled reference under the photo's lighting. Like the desktop app,
+    a fit whose median residual exceeds MAX_FIT_RESIDUAL is rejected (`correction` is null);
+    `correction_residual` reports the residual of the fit either way.
     """
+    analytes = layout_analytes(layout)
     content = await file.read()
     try:
-        mapping = prepare_reference_mapping_from_image_bytes(content, expected_rows=expected_rows)
+        mapping = prepare_reference_mapping_from_image_bytes(content, expected_rows=expected_rows or len(analytes),
+                                                             analytes=analytes)
        
-        return {"status":"ok", "mapping": mapping}
+        correction, residual = None, None
+        if DEFAULT_REF_MAP:
+            measured, reference = pair_mappings(mapping, DEFAULT_REF_MAP)
+            if len(measured) >= MIN_FIT_PATCHES:
+                try:
+                    M, residual = fit_color_correction(measured, reference)
+                except (ValueError, np.linalg.LinAlgError):
+                    M = None
+                if M is not None and residual <= MAX_FIT_RESIDUAL:
+                    correction = M.tolist()
+        return {"status":"ok", "mapping": mapping, "correction": correction,
+                "correction_residual": residual}
     except Exception as e:
         raise HTTPException(status_code=400, detail=str(e))
 
@@ -272,20 +361,29 @@ async def calibrate_chart(file: UploadFile = File(...), expected_rows: int = len
 async def diagnose(req: DiagnoseRequest):
     """
     Diagnose from pads (list of RGBs) and a ref_map.
-    Pads must be ordered top-to-bottom matching ANALYTE_ORDER.
+    Pads must be ordered top-to-bottom matching the analytes of req.layout (ANALYTE_ORDER by default).
+    Without a ref_map the precomputed mapping of the bundled reference chart is used.
+    A correction maps photo colors to that bundled chart, so it can't be combined with a ref_map.
     """
-    if not req.ref_map:
+    analytes = layout_analytes(req.layout)
+    if req.correction is not None and np.asarray(req.correction).shape != (3, 4):
+        raise HTTPException(status_code=400, detail="correction must be a 3x4 matrix")
+    if req.correction is not None and req.ref_map:
+        raise HTTPException(status_code=400, detail="Send either a ref_map or a correction, not both: "
+                                                    "the correction targets the bundled reference chart.")
+    ref_map = req.ref_map or DEFAULT_REF_MAP
+    if not ref_map:
         raise HTTPException(status_code=400, detail="ref_map required. Call /calibrate first or provide mapping.")
 
     # convert ref_map values to list of (label, labvec)
     prepared_ref = {}
-    for analyte, levels in req.ref_map.items():
+    for analyte, levels in ref_map.items():
         prepared_ref[analyte] = [(lbl, np.array(lab).astype(float)) for lbl, lab in levels]
 
     match_results = {}
     for i, pad in enumerate(req.pads):
-        analyte = ANALYTE_ORDER[i] if i < len(ANALYTE_ORDER) else f"custom_{i}"
-        labvec = rgb_to_lab_vector((pad.r, pad.g, pad.b))
+        analyte = analytes[i] if i < len(analytes) else f"custom_{i}"
+        labvec = apply_color_correction(rgb_to_lab_vector((pad.r, pad.g, pad.b)), req.correction)
         refs = prepared_ref.get(analyte, [])
         if not refs:
             match_results[analyte] = (None, float('inf'))
@@ -296,10 +394,18 @@ async def diagnose(req: DiagnoseRequest):
     diagnoses, confidences = interpret_match_labels(match_results)
     return {"status":"ok", "matches": match_results, "diagnoses": diagnoses, "confidences": confidences}
 
+@app.get("/layouts")
+async def list_layouts():
+    """Available strip layouts and their analyte order."""
+    return {"status":"ok", "default": DEFAULT_LAYOUT,
+            "layouts": {name: {"analytes": spec["analytes"], "description": spec.get("description", "")}
+                        for name, spec in STRIP_LAYOUTS.items()}}
+
 @app.get("/")
 async def root():
     return {"status":"ok", "info":"Kaelion-AI Urine Diagnosis API"}
 
 # Entry point for uvicorn
 if __name__ == "__main__":
+    import uvicorn
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
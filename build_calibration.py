@@ -0,0 +1,48 @@
+import os
+import time
+import cv2
+from urine_diagnosis import (ANALYTE_ORDER, DEFAULT_CALIBRATION_ARTIFACT,
+                             prepare_reference_mapping_from_image, save_reference_mapping,
+                             load_reference_mapping, load_reference_boxes)
+
+DEFAULT_CHART_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_chart2.png")
+
+
+def build_calibration(chart_path=DEFAULT_CHART_PATH, out_path=DEFAULT_CALIBRATION_ARTIFACT):
+    """
+    Precompute the reference mapping for a chart image and store it as .npz
+
+    The artifact is loaded at startup by urine_diagnosis.py and backend/main.py,
+    so the bundled chart never needs KMeans clustering at runtime. Re-run this
+    after replacing the chart image.
+    """
+    print(f"Clustering reference chart: {chart_path}")
+    start = time.perf_counter()
+    img = cv2.imread(chart_path)
+    if img is None:
+        raise FileNotFoundError(f"Chart image not found: {chart_path}")
+    mapping, boxes = prepare_reference_mapping_from_image(img, expected_rows=len(ANALYTE_ORDER),
+                                                          return_boxes=True)
+    elapsed = time.perf_counter() - start
+
+    # patch boxes let calibration_monitor.py sample the live chart without re-clustering
+    save_reference_mapping(mapping, out_path, source_path=chart_path, boxes=boxes)
+    # Round-trip check
+    loaded, _ = load_reference_mapping(out_path)
+    assert list(loaded.keys()) == list(mapping.keys())
+    assert load_reference_boxes(out_path) is not None
+
+    print(f"✓ Calibration built in {elapsed:.2f}s")
+    print(f"  Analytes: {', '.join(f'{a} ({len(l)})' for a, l in mapping.items())}")
+    print(f"📁 Saved to: {out_path} ({os.path.getsize(out_path)} bytes)")
+    return out_path
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Precompute the default chart calibration")
+    parser.add_argument('--chart', default=DEFAULT_CHART_PATH, help="Reference chart image")
+    parser.add_argument('--out', default=DEFAULT_CALIBRATION_ARTIFACT, help="Output .npz path")
+    args = parser.parse_args()
+
+    build_calibration(args.chart, args.out)
@@ -0,0 +1,199 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from pad_sampling import sample_pad_colors
+from color_correction import (MIN_FIT_PATCHES, apply_color_correction, fit_color_correction,
+                              pair_mappings)
+
+
+class CalibrationMonitor:
+    """
+    Incremental calibration for the live loop
+
+    Instead of re-clustering the chart every few seconds, each frame samples a
+    handful of known patch locations (normalized boxes stored with the
+    calibration) in the live chart ROI, color-corrects them and compares them
+    with the reference colors. When the smoothed drift exceeds drift_threshold
+    the 3x4 color correction is first refitted from all known patches (cheap);
+    only if that leaves a residual above refit_threshold is a full
+    recalibration (KMeans clustering of the live ROI) started, on a background
+    worker so the video loop never waits for it. The loop picks up the new
+    calibration with poll().
+
+    The reference mapping stays the canonical one whenever the re-clustered
+    chart can be paired with it level by level; lighting is then absorbed by
+    the correction (self.correction), which is applied to pad means only.
+    """
+
+    def __init__(self, ref_map, boxes, recalibrate_fn, drift_threshold=8.0, sample_count=8,
+                 inner=0.25, smoothing=0.3, min_interval_s=5.0, correction=None, refit_threshold=None):
+        """
+        Args:
+            ref_map: Current mapping analyte -> [(label, lab), ...]
+            boxes: analyte -> (n_levels, 4) patch boxes normalized to the chart, or None
+                   (drift is then unknown and the first chart sighting triggers a recalibration)
+            recalibrate_fn: fn(chart_roi) -> (mapping, boxes), run on the background worker
+            drift_threshold: Smoothed median LAB distance (0..255 scale) that triggers a recalibration
+            sample_count: Number of patches sampled per frame
+            inner: Fraction of each patch box trimmed per side before sampling
+            smoothing: EMA factor of the drift estimate
+            min_interval_s: Minimum time between two automatic recalibrations
+            correction: Initial 3x4 LAB correction (None for identity)
+            refit_threshold: Largest median residual accepted from a correction refit
+                             (default drift_threshold / 2)
+        """
+        self.recalibrate_fn = recalibrate_fn
+        self.drift_threshold = drift_threshold
+        self.sample_count = sample_count
+        self.inner = inner
+        self.smoothing = smoothing
+        self.min_interval_s = min_interval_s
+        self.refit_threshold = refit_threshold if refit_threshold is not None else drift_threshold / 2
+        self.refits = 0
+        self.version = 0            # incremented whenever the reference or correction changes
+        self.drift = None           # smoothed drift
+        self.last_drift = None      # drift of the last checked frame
+        self.recalibrations = 0
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="recalibration")
+        self._future = None
+        self._last_recal = 0.0
+        self._lock = threading.Lock()
+        self.set_calibration(ref_map, boxes, correction)
+
+    def set_calibration(self, ref_map, boxes, correction=None):
+        """Replace the reference (and correction) and choose the patches sampled for drift checks"""
+        self.ref_map = ref_map
+        self.boxes = boxes
+        self.correction = correction
+        self.drift = None
+        self.version += 1
+        sample_boxes, sample_labs = [], []
+        if boxes:
+            for analyte, levels in ref_map.items():
+                analyte_boxes = boxes.get(analyte)
+                if analyte_boxes is None or len(analyte_boxes) != len(levels):
+                    continue
+                for box, (_, lab) in zip(analyte_boxes, levels):
+                    sample_boxes.append(box)
+                    sample_labs.append(np.asarray(lab, dtype=np.float64))
+        if sample_boxes:
+            self._all_boxes = np.asarray(sample_boxes, dtype=np.float64)
+            self._all_labs = np.asarray(sample_labs)
+            # spread the samples evenly over all patches (all rows and levels)
+            pick = np.unique(np.linspace(0, len(sample_boxes) - 1, self.sample_count).round().astype(int))
+            self._sample_boxes = self._all_boxes[pick]
+            self._sample_labs = self._all_labs[pick]
+        else:
+            self._all_boxes = self._all_labs = None
+            self._sample_boxes = self._sample_labs = None
+
+    @property
+    def busy(self):
+        return self._future is not None and not self._future.done()
+
+    def _sample(self, chart_roi, boxes):
+        h, w = chart_roi.shape[:2]
+        pads = np.rint(boxes * [w, h, w, h]).astype(int)
+        return sample_pad_colors(chart_roi, pads, inner=self.inner)
+
+    def measure_drift(self, chart_roi):
+        """Median LAB distance between the corrected live patch samples and their reference colors"""
+        if self._sample_boxes is None:
+            return None
+        live = apply_color_correction(self._sample(chart_roi, self._sample_boxes), self.correction)
+        d = np.linalg.norm(live - self._sample_labs, axis=1)
+        d = d[~np.isnan(d)]
+        # median: a single occluded or glare-hit patch does not trigger a recalibration
+        return float(np.median(d)) if len(d) else None
+
+    def observe(self, chart_roi):
+        """
+        Check one live chart ROI; starts a background recalibration on drift
+
+        Returns the drift of this frame (None when it cannot be measured).
+        """
+        drift = self.measure_drift(chart_roi)
+        self.last_drift = drift
+        if drift is not None:
+            self.drift = drift if self.drift is None else self.drift + self.smoothing * (drift - self.drift)
+        if self.drift is not None and self.drift > self.drift_threshold and self.refit(chart_roi):
+            return drift
+        needs_recal = self.drift is None or self.drift > self.drift_threshold
+        if needs_recal and time.time() - self._last_recal >= self.min_interval_s:
+            self.request_recalibration(chart_roi)
+        return drift
+
+    def refit(self, chart_roi):
+        """
+        Refit the color correction from all known patches of the live chart
+
+        Returns True when the fit explains the chart well enough (median residual
+        <= refit_threshold) and was adopted.
+        """
+        if self._all_boxes is None:
+            return False
+        live = self._sample(chart_roi, self._all_boxes)
+        try:
+            correction, residual = fit_color_correction(live, self._all_labs)
+        except (ValueError, np.linalg.LinAlgError):
+            return False
+        if residual > self.refit_threshold:
+            return False
+        self.correction = correction
+        self.drift = residual
+        self.refits += 1
+        self.version += 1
+        print(f"[calibration] Refitted color correction (drift -> residual {residual:.1f})")
+        return True
+
+    def request_recalibration(self, chart_roi):
+        """Start a full recalibration from chart_roi unless one is already running"""
+        with self._lock:
+            if self.busy:
+                return False
+            self._last_recal = time.time()
+            reason = "forced" if self.drift is None or self.drift <= self.drift_threshold else f"drift {self.drift:.1f}"
+            print(f"Starting background recalibration ({reason})...")
+            self._future = self._executor.submit(self._recalibrate, chart_roi.copy())
+            return True
+
+    def _recalibrate(self, chart_roi):
+        start = time.perf_counter()
+        mapping, boxes = self.recalibrate_fn(chart_roi)
+        return mapping, boxes, time.perf_counter() - start
+
+    def poll(self):
+        """Return the new mapping once a background recalibration has finished, else None"""
+        with self._lock:
+            if self._future is None or not self._future.done():
+                return None
+            future, self._future = self._future, None
+        try:
+            mapping, boxes, elapsed = future.result()
+        except Exception as e:
+            print("Calibration failed:", e)
+            return None
+        if not mapping:
+            return None
+        self.recalibrations += 1
+        # keep the canonical reference when the live chart pairs up with it level by level
+        measured, reference = pair_mappings(mapping, self.ref_map)
+        correction = None
+        if len(measured) >= MIN_FIT_PATCHES:
+            try:
+                correction, residual = fit_color_correction(measured, reference)
+            except (ValueError, np.linalg.LinAlgError):
+                # e.g. fewer than MIN_FIT_PATCHES usable (non-NaN) pairs
+                correction = None
+        if correction is not None and residual <= self.refit_threshold:
+            self.set_calibration(self.ref_map, boxes, correction)
+            print(f"Calibration successful in {elapsed:.2f}s (background): color correction fitted on "
+                  f"{len(measured)} patches, residual {residual:.1f}")
+        else:
+            self.set_calibration(mapping, boxes)
+            print(f"Calibration successful in {elapsed:.2f}s (background). Mapped analytes: {list(mapping.keys())}")
+        return self.ref_map
+
+    def close(self):
+        self._executor.shutdown(wait=False)
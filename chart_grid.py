@@ -0,0 +1,198 @@
+import time
+import cv2
+import numpy as np
+from pad_sampling import sample_pad_colors
+from color_correction import MIN_FIT_PATCHES, fit_color_correction
+
+# A candidate chart outline must cover at least this fraction of the image
+MIN_QUAD_AREA = 0.2
+# Median LAB residual (after the affine color fit) above which a grid fit is rejected
+MAX_GRID_RESIDUAL = 8.0
+
+
+def order_corners(pts):
+    """Order 4 points as top-left, top-right, bottom-right, bottom-left"""
+    pts = np.asarray(pts, dtype=np.float32).reshape(4, 2)
+    s = pts.sum(axis=1)
+    d = pts[:, 1] - pts[:, 0]
+    return np.array([pts[np.argmin(s)], pts[np.argmin(d)], pts[np.argmax(s)], pts[np.argmax(d)]],
+                    dtype=np.float32)
+
+
+def find_chart_corners(img, min_area=MIN_QUAD_AREA):
+    """
+    Corners of the chart sheet: the largest convex quadrilateral outline in the image
+
+    Returns a (4, 2) float32 array (tl, tr, br, bl) or None when no outline covering
+    min_area of the image is found (e.g. the image is already a tight chart crop).
+    """
+    h, w = img.shape[:2]
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY) if img.ndim == 3 else img
+    # work on a small copy: the outline does not need full resolution
+    scale = min(1.0, 512.0 / max(h, w))
+    small = cv2.resize(gray, (max(1, int(w*scale)), max(1, int(h*scale))), interpolation=cv2.INTER_AREA)
+    edges = cv2.Canny(cv2.GaussianBlur(small, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    best, best_area = None, min_area * small.shape[0] * small.shape[1]
+    for cnt in contours:
+        hull = cv2.convexHull(cnt)
+        approx = cv2.approxPolyDP(hull, 0.02 * cv2.arcLength(hull, True), True)
+        if len(approx) != 4:
+            continue
+        area = cv2.contourArea(approx)
+        if area > best_area:
+            best, best_area = approx, area
+    if best is None:
+        return None
+    return order_corners(best.reshape(4, 2) / scale)
+
+
+def chart_homography(corners):
+    """Homography from normalized chart coordinates (unit square) to image pixels"""
+    unit = np.array([[0, 0], [1, 0], [1, 1], [0, 1]], dtype=np.float32)
+    return cv2.getPerspectiveTransform(unit, np.asarray(corners, dtype=np.float32))
+
+
+def project_boxes(boxes, H, inner=0.25):
+    """
+    Map normalized (x, y, w, h) patch boxes through H to pixel boxes
+
+    Each box is shrunk by `inner` per side first, so the axis-aligned bounding
+    box of the projected quad stays inside the patch under moderate perspective.
+    """
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    x0 = boxes[:, 0] + inner * boxes[:, 2]
+    y0 = boxes[:, 1] + inner * boxes[:, 3]
+    x1 = boxes[:, 0] + (1 - inner) * boxes[:, 2]
+    y1 = boxes[:, 1] + (1 - inner) * boxes[:, 3]
+    quads = np.stack([np.stack([x0, y0], 1), np.stack([x1, y0], 1),
+                      np.stack([x1, y1], 1), np.stack([x0, y1], 1)], axis=1)
+    pts = cv2.perspectiveTransform(quads.reshape(-1, 1, 2).astype(np.float32), H).reshape(-1, 4, 2)
+    lo = np.floor(pts.min(axis=1))
+    hi = np.ceil(pts.max(axis=1))
+    return np.hstack([lo, hi - lo]).astype(int)
+
+
+def _flatten(ref_map, ref_boxes):
+    """Reference patches that have a box: (analytes, level labels, boxes (K,4), labs (K,3))"""
+    keys, boxes, labs = [], [], []
+    for analyte, levels in ref_map.items():
+        analyte_boxes = ref_boxes.get(analyte) if ref_boxes else None
+        if analyte_boxes is None or len(analyte_boxes) != len(levels):
+            continue
+        for box, (label, lab) in zip(analyte_boxes, levels):
+            keys.append((analyte, label))
+            boxes.append(box)
+            labs.append(np.asarray(lab, dtype=np.float64))
+    return keys, np.asarray(boxes, dtype=np.float64).reshape(-1, 4), np.asarray(labs).reshape(-1, 3)
+
+
+def grid_calibrate(img, ref_map, ref_boxes, max_residual=MAX_GRID_RESIDUAL):
+    """
+    Calibrate from a chart of known layout by sampling its patch grid directly
+
+    The expected patch boxes (normalized to the chart, as stored in the
+    calibration artifact) are projected through a homography from the chart
+    outline (or through the image frame itself, for tight chart crops) and
+    sampled with one integral image: O(number of patches), no pixel clustering.
+    A fit is accepted when an affine color correction explains the sampled
+    colors with a median residual <= max_residual.
+
+    Returns:
+        (mapping, boxes, residual): mapping analyte -> [(label, live lab)] in the
+        reference's level structure and boxes normalized to img, or None when no
+        candidate fits.
+    """
+    keys, boxes, ref_labs = _flatten(ref_map, ref_boxes)
+    if len(keys) < MIN_FIT_PATCHES:
+        return None
+    h, w = img.shape[:2]
+    candidates = [np.array([[0, 0], [w, 0], [w, h], [0, h]], dtype=np.float32)]
+    corners = find_chart_corners(img)
+    if corners is not None:
+        candidates.insert(0, corners)
+
+    best = None
+    for corners in candidates:
+        pixel_boxes = project_boxes(boxes, chart_homography(corners))
+        live = sample_pad_colors(img, pixel_boxes, inner=0.0)
+        try:
+            _, residual = fit_color_correction(live, ref_labs)
+        except (ValueError, np.linalg.LinAlgError):
+            continue
+        if best is None or residual < best[2]:
+            best = (live, pixel_boxes, residual)
+    if best is None or best[2] > max_residual or np.isnan(best[0]).any():
+        return None
+
+    live, pixel_boxes, residual = best
+    norm = np.array([w, h, w, h], dtype=np.float32)
+    mapping, out_boxes = {}, {}
+    for (analyte, label), lab, box in zip(keys, live, pixel_boxes):
+        mapping.setdefault(analyte, []).append((label, lab))
+        out_boxes.setdefault(analyte, []).append(box / norm)
+    return mapping, {a: np.array(b, dtype=np.float32) for a, b in out_boxes.items()}, residual
+
+
+def calibrate_chart(img, ref_map, ref_boxes, cluster_fn, mode="grid"):
+    """
+    Grid-fit calibration with fallback to pixel clustering
+
+    Args:
+        img: Chart image or live chart ROI (BGR)
+        ref_map, ref_boxes: Canonical calibration with normalized patch boxes
+        cluster_fn: fn(img) -> (mapping, boxes), the clustering path
+        mode: "grid" (try the grid fit first) or "clustering"
+
+    Returns:
+        (mapping, boxes, report) where report holds the method used and the
+        time spent in each path (ms)
+    """
+    report = {'method': None, 'grid_ms': None, 'clustering_ms': None, 'residual': None}
+    if mode == "grid" and ref_boxes:
+        start = time.perf_counter()
+        result = grid_calibrate(img, ref_map, ref_boxes)
+        report['grid_ms'] = (time.perf_counter() - start) * 1000
+        if result is not None:
+            mapping, boxes, report['residual'] = result
+            report['method'] = 'grid'
+            print(f"Grid calibration: {report['grid_ms']:.1f} ms (residual {report['residual']:.1f})")
+            return mapping, boxes, report
+        print(f"Grid calibration failed after {report['grid_ms']:.1f} ms; falling back to clustering")
+    start = time.perf_counter()
+    mapping, boxes = cluster_fn(img)
+    report['clustering_ms'] = (time.perf_counter() - start) * 1000
+    report['method'] = 'clustering'
+    print(f"Clustering calibration: {report['clustering_ms']:.1f} ms")
+    return mapping, boxes, report
+
+
+if __name__ == "__main__":
+    from urine_diagnosis import (ANALYTE_ORDER, load_reference_mapping, load_reference_boxes,
+                                 prepare_reference_mapping_from_image, DEFAULT_CALIBRATION_ARTIFACT)
+    from build_calibration import DEFAULT_CHART_PATH
+
+    ref_map, _ = load_reference_mapping(DEFAULT_CALIBRATION_ARTIFACT)
+    ref_boxes = load_reference_boxes(DEFAULT_CALIBRATION_ARTIFACT)
+    chart = cv2.imread(DEFAULT_CHART_PATH)
+
+    # the chart photographed: darker, on a desk, seen slightly in perspective
+    h, w = chart.shape[:2]
+    canvas = np.full((h + 400, w + 400, 3), 60, np.uint8)
+    src = np.float32([[0, 0], [w, 0], [w, h], [0, h]])
+    dst = np.float32([[230, 180], [w + 160, 220], [w + 210, h + 230], [170, h + 190]])
+    photo = cv2.warpPerspective(cv2.convertScaleAbs(chart, alpha=0.85, beta=5),
+                                cv2.getPerspectiveTransform(src, dst), canvas.shape[1::-1],
+                                dst=canvas, borderMode=cv2.BORDER_TRANSPARENT)
+
+    def cluster_fn(img):
+        return prepare_reference_mapping_from_image(img, expected_rows=len(ANALYTE_ORDER), return_boxes=True)
+
+    grid_calibrate(chart, ref_map, ref_boxes)  # warm-up: first OpenCV/LAPACK calls are slow
+    for name, img in [("chart crop", chart), ("perspective photo", photo)]:
+        print(f"--- {name} ---")
+        grid = calibrate_chart(img, ref_map, ref_boxes, cluster_fn, mode="grid")[2]
+        clustering = calibrate_chart(img, ref_map, ref_boxes, cluster_fn, mode="clustering")[2]
+        if grid['method'] == 'grid':
+            print(f"Grid fit {clustering['clustering_ms'] / grid['grid_ms']:.0f}x faster than clustering")
@@ -0,0 +1,50 @@
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds each module may take to import in a fresh interpreter. Generous on
+# purpose: the point is to catch a heavy dependency creeping back in at
+# module level (ultralytics/scikit-learn used to add several seconds)
+IMPORT_BUDGETS = {
+    "urine_diagnosis": 1.0,
+    "backend.main": 2.0,
+}
+# Must only be imported inside the functions that use them
+DEFERRED_MODULES = ("sklearn", "ultralytics", "skimage")
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "loaded": [m for m in {deferred!r} if m in sys.modules]}}))
+"""
+
+
+def measure_import(module, deferred=DEFERRED_MODULES):
+    """
+    Import a module in a fresh interpreter (nothing cached in sys.modules)
+
+    Returns (seconds, deferred modules that the import pulled in).
+    """
+    out = subprocess.run([sys.executable, "-c", _PROBE.format(module=module, deferred=tuple(deferred))],
+                         cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout
+    result = json.loads(out.strip().splitlines()[-1])
+    return result["seconds"], result["loaded"]
+
+
+def check_import_time(budgets=IMPORT_BUDGETS, deferred=DEFERRED_MODULES):
+    """Assert every module imports within its budget without the deferred dependencies"""
+    for module, budget in budgets.items():
+        seconds, loaded = measure_import(module, deferred)
+        print(f"{module:16s}: {seconds:.3f} s (budget {budget:.1f} s), deferred modules loaded: {loaded or 'none'}")
+        assert not loaded, f"importing {module} pulled in {', '.join(loaded)}"
+        assert seconds <= budget, f"importing {module} took {seconds:.2f} s, budget {budget:.1f} s"
+
+
+if __name__ == "__main__":
+    check_import_time()
+    print("Import-time budget respected")
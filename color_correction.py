@@ -0,0 +1,74 @@
+import numpy as np
+
+# Minimum number of patch correspondences for a full 3x4 fit (12 unknowns)
+MIN_FIT_PATCHES = 8
+# Largest median residual (LAB, 0..255 scale) of a fit that is adopted; worse fits
+# mean the chart was misread and are rejected (desktop monitor and backend alike)
+MAX_FIT_RESIDUAL = 4.0
+
+
+def identity_correction():
+    """3x4 affine LAB correction that leaves colors unchanged"""
+    return np.hstack([np.eye(3), np.zeros((3, 1))])
+
+
+def fit_color_correction(measured, reference, ridge=1.0, outlier_factor=3.0):
+    """
+    Fit a 3x4 affine correction in LAB space: reference ~= M[:, :3] @ measured + M[:, 3]
+
+    measured are chart patch colors as seen under the current lighting, reference
+    the same patches in the canonical calibration. The least-squares fit is
+    regularized towards the identity (ridge) so a chart with few or similar
+    patches cannot produce a wild matrix, and refitted once without patches
+    whose residual exceeds outlier_factor times the median (glare, occlusion).
+
+    Args:
+        measured, reference: (K, 3) LAB arrays (OpenCV 0..255 scale); NaN rows are ignored
+
+    Returns:
+        (M, residual): (3, 4) matrix and median residual LAB distance after correction
+    """
+    measured = np.asarray(measured, dtype=np.float64).reshape(-1, 3)
+    reference = np.asarray(reference, dtype=np.float64).reshape(-1, 3)
+    ok = ~(np.isnan(measured).any(axis=1) | np.isnan(reference).any(axis=1))
+    measured, reference = measured[ok], reference[ok]
+    if len(measured) < MIN_FIT_PATCHES:
+        raise ValueError(f"Need at least {MIN_FIT_PATCHES} patches to fit a color correction, got {len(measured)}")
+
+    prior = identity_correction().T  # (4, 3)
+    keep = np.ones(len(measured), dtype=bool)
+    for _ in range(2):
+        X = np.hstack([measured[keep], np.ones((keep.sum(), 1))])
+        A = np.linalg.solve(X.T @ X + ridge * np.eye(4), X.T @ reference[keep] + ridge * prior)
+        residuals = np.linalg.norm(measured @ A[:3] + A[3] - reference, axis=1)
+        inliers = residuals <= outlier_factor * max(np.median(residuals), 1e-6)
+        if inliers.all() or inliers.sum() < MIN_FIT_PATCHES or np.array_equal(inliers, keep):
+            break
+        keep = inliers
+    return A.T, float(np.median(residuals[keep]))
+
+
+def apply_color_correction(labs, correction):
+    """Apply a 3x4 correction to an (N, 3) array of LAB values (NaN rows stay NaN)"""
+    if correction is None:
+        return labs
+    labs = np.asarray(labs, dtype=np.float64)
+    M = np.asarray(correction, dtype=np.float64)
+    return np.clip(labs @ M[:, :3].T + M[:, 3], 0, 255)
+
+
+def pair_mappings(measured_map, reference_map):
+    """
+    Patch correspondences between two mappings of the same chart
+
+    Levels are paired by position for every analyte that has the same number of
+    levels in both mappings. Returns (measured, reference) (K, 3) arrays.
+    """
+    measured, reference = [], []
+    for analyte, ref_levels in reference_map.items():
+        levels = measured_map.get(analyte)
+        if not levels or len(levels) != len(ref_levels):
+            continue
+        measured.extend(np.asarray(lab, dtype=np.float64) for _, lab in levels)
+        reference.extend(np.asarray(lab, dtype=np.float64) for _, lab in ref_levels)
+    return np.array(measured).reshape(-1, 3), np.array(reference).reshape(-1, 3)
@@ -0,0 +1,93 @@
+import numpy as np
+
+# |RT| <= 2 * sin(60 deg), so (dC/SC)^2 + (dH/SH)^2 + RT*(dC/SC)*(dH/SH) >= (1 - sqrt(3)/2) * (...)
+_RT_FACTOR = np.sqrt(1.0 - np.sqrt(3.0) / 2.0)
+
+
+def opencv_lab_to_cielab(lab):
+    """
+    OpenCV 8-bit LAB (L*255/100, a+128, b+128) -> CIELAB (L 0..100, a, b)
+
+    cv2.COLOR_BGR2LAB on uint8 images produces the encoded form; the CIE
+    difference formulas are defined on the decoded values.
+    """
+    lab = np.asarray(lab, dtype=np.float64)
+    return np.stack([lab[..., 0] * (100.0 / 255.0), lab[..., 1] - 128.0, lab[..., 2] - 128.0], axis=-1)
+
+
+def cie76(lab1, lab2):
+    """Euclidean LAB distance, broadcasting over leading dimensions"""
+    d = np.asarray(lab1, dtype=np.float64) - np.asarray(lab2, dtype=np.float64)
+    return np.sqrt(np.sum(d * d, axis=-1))
+
+
+def ciede2000(lab1, lab2):
+    """
+    Vectorized CIEDE2000 (Sharma et al.), broadcasting over leading dimensions
+
+    Same formula, branch for branch, as the scalar ciede2000() in
+    urine_diagnosis.py / backend/main.py; results agree to float precision.
+    """
+    lab1 = np.asarray(lab1, dtype=np.float64)
+    lab2 = np.asarray(lab2, dtype=np.float64)
+    L1, a1, b1 = lab1[..., 0], lab1[..., 1], lab1[..., 2]
+    L2, a2, b2 = lab2[..., 0], lab2[..., 1], lab2[..., 2]
+
+    C1 = np.hypot(a1, b1)
+    C2 = np.hypot(a2, b2)
+    avg_C7 = (0.5 * (C1 + C2)) ** 7
+    G = 0.5 * (1 - np.sqrt(avg_C7 / (avg_C7 + 25.0**7)))
+    a1p = (1 + G) * a1
+    a2p = (1 + G) * a2
+    C1p = np.hypot(a1p, b1)
+    C2p = np.hypot(a2p, b2)
+    h1p = np.where(C1p != 0, np.arctan2(b1, a1p), 0.0)
+    h2p = np.where(C2p != 0, np.arctan2(b2, a2p), 0.0)
+    h1p = np.where(h1p < 0, h1p + 2*np.pi, h1p)
+    h2p = np.where(h2p < 0, h2p + 2*np.pi, h2p)
+
+    dLp = L2 - L1
+    dCp = C2p - C1p
+    zero = C1p * C2p == 0
+    dh = h2p - h1p
+    dhp = np.where(np.abs(dh) <= np.pi, dh, np.where(dh > np.pi, dh - 2*np.pi, dh + 2*np.pi))
+    dhp = np.where(zero, 0.0, dhp)
+    dHp = 2 * np.sqrt(C1p * C2p) * np.sin(dhp / 2.0)
+
+    avg_Lp = 0.5 * (L1 + L2)
+    avg_Cp = 0.5 * (C1p + C2p)
+    hsum = h1p + h2p
+    avg_hp = np.where(np.abs(h1p - h2p) <= np.pi, 0.5 * hsum,
+                      np.where(hsum < 2*np.pi, 0.5 * (hsum + 2*np.pi), 0.5 * (hsum - 2*np.pi)))
+    avg_hp = np.where(zero, hsum, avg_hp)
+
+    T = (1 - 0.17*np.cos(avg_hp - np.deg2rad(30)) +
+         0.24*np.cos(2*avg_hp) +
+         0.32*np.cos(3*avg_hp + np.deg2rad(6)) -
+         0.20*np.cos(4*avg_hp - np.deg2rad(63)))
+    delta_ro = 30 * np.exp(-(((np.rad2deg(avg_hp) - 275) / 25.0) ** 2))
+    avg_Cp7 = avg_Cp ** 7
+    RC = 2 * np.sqrt(avg_Cp7 / (avg_Cp7 + 25.0**7))
+    SL = 1 + (0.015 * (avg_Lp - 50) ** 2) / np.sqrt(20 + (avg_Lp - 50) ** 2)
+    SC = 1 + 0.045 * avg_Cp
+    SH = 1 + 0.015 * avg_Cp * T
+    RT = -np.sin(np.deg2rad(2 * delta_ro)) * RC
+    tL, tC, tH = dLp / SL, dCp / SC, dHp / SH
+    return np.sqrt(np.maximum(tL*tL + tC*tC + tH*tH + RT*tC*tH, 0.0))
+
+
+def ciede2000_bound_scales(max_l_dev, max_chroma):
+    """
+    (l_scale, ab_scale) such that
+        CIEDE2000(x, y) >= || (l_scale * dL, ab_scale * da, ab_scale * db) ||
+    for all colors with |L - 50| <= max_l_dev and chroma <= max_chroma
+
+    - the rotation term only couples the chroma and hue terms and removes at most
+      a sqrt(3)/2 share of them: |RT| <= 2 sin(60 deg)
+    - dC'^2 + dH'^2 = (da')^2 + db^2 with a' = (1 + G) a, G >= 0
+    - SL <= 1 + 0.015 |L - 50|; SC <= 1 + 0.045 * 1.5 * C (C' <= (1 + G) C, G <= 0.5)
+      and SH <= 1 + 0.015 * 1.93 * C' < SC
+    """
+    l_scale = 1.0 / (1.0 + 0.015 * max_l_dev)
+    ab_scale = _RT_FACTOR / (1.0 + 0.045 * 1.5 * max_chroma)
+    return l_scale, ab_scale
@@ -0,0 +1,159 @@
+import math
+import numpy as np
+from urine_diagnosis import ciede2000
+
+# The fast path trusts the CIE76 ranking when the runner-up level is more than
+# DEFAULT_MARGIN times as far as the nearest one (see __main__ for the check on the bundled chart)
+DEFAULT_MARGIN = 3.0
+
+
+def cie76(lab_ref, lab):
+    return math.sqrt((lab[0] - lab_ref[0])**2 + (lab[1] - lab_ref[1])**2 + (lab[2] - lab_ref[2])**2)
+
+
+def cie94(lab_ref, lab):
+    """CIE94 (graphic arts weights) with lab_ref as the reference color"""
+    dL = lab_ref[0] - lab[0]
+    C1 = math.hypot(lab_ref[1], lab_ref[2])
+    dC = C1 - math.hypot(lab[1], lab[2])
+    dH2 = max((lab_ref[1] - lab[1])**2 + (lab_ref[2] - lab[2])**2 - dC*dC, 0.0)
+    SC = 1 + 0.045*C1
+    SH = 1 + 0.015*C1
+    return math.sqrt(dL*dL + (dC/SC)**2 + dH2/(SH*SH))
+
+
+# Scalar metrics by name, fn(reference, sample); levels per analyte are few, so
+# a plain loop beats numpy's per-call overhead (color_metrics has the vectorized ones)
+METRICS = {'cie76': cie76, 'cie94': cie94, 'ciede2000': ciede2000}
+
+
+class LevelMatcher:
+    """
+    Nearest reference level of a pad color under a configurable metric
+
+    strategy="exact" scores every level with the metric (what
+    match_lab_to_levels does with CIEDE2000). strategy="fast_then_verify"
+    ranks all levels by CIE76 first and accepts the nearest one when the
+    runner-up is more than `margin` times as far; only ambiguous pads (two
+    levels within the margin) are re-ranked with the metric. The margin is
+    relative because CIE76 and CIEDE2000 scale differently across the color
+    space: no absolute CIE76 gap is safe everywhere. The returned
+    distance is always the metric's, so thresholds such as MAX_MATCH_DISTANCE
+    keep their meaning. self.stats counts how often the fast path was conclusive.
+
+    Colors are used as given (OpenCV 8-bit LAB in this pipeline), like
+    match_lab_to_levels.
+    """
+
+    def __init__(self, metric="ciede2000", strategy="exact", margin=DEFAULT_MARGIN):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown color metric: {metric} (expected one of {sorted(METRICS)})")
+        if strategy not in ("exact", "fast_then_verify"):
+            raise ValueError(f"Unknown matching strategy: {strategy}")
+        self.metric = metric
+        self.strategy = strategy
+        self.margin = margin
+        self._metric = METRICS[metric]
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'matches': 0, 'fast_conclusive': 0, 'verified': 0}
+
+    @property
+    def conclusive_rate(self):
+        """Fraction of fast_then_verify matches decided by CIE76 alone"""
+        fast = self.stats['fast_conclusive'] + self.stats['verified']
+        return self.stats['fast_conclusive'] / fast if fast else None
+
+    def match(self, lab_vec, reference_levels):
+        """
+        Same contract as urine_diagnosis.match_lab_to_levels
+
+        Args:
+            lab_vec: Pad LAB color
+            reference_levels: list of (label, lab) tuples
+
+        Returns:
+            (best_label, best_distance); (None, inf) without levels
+        """
+        if not reference_levels:
+            return None, float('inf')
+        q = [float(v) for v in lab_vec]
+        self.stats['matches'] += 1
+
+        if self.strategy == "fast_then_verify" and len(reference_levels) > 1:
+            first = second = None
+            d1 = d2 = float('inf')
+            for i, (_, lab_ref) in enumerate(reference_levels):
+                d = cie76(lab_ref, q)
+                if d < d1:
+                    first, second, d1, d2 = i, first, d, d1
+                elif d < d2:
+                    second, d2 = i, d
+            if d2 > self.margin * d1:
+                self.stats['fast_conclusive'] += 1
+                label, lab_ref = reference_levels[first]
+                return label, float(self._metric(lab_ref, q))
+            self.stats['verified'] += 1
+
+        best_d = float('inf')
+        best_label = None
+        for label, lab_ref in reference_levels:
+            d = self._metric(lab_ref, q)
+            if d < best_d:
+                best_d = d
+                best_label = label
+        return best_label, float(best_d)
+
+    def match_pad_labs(self, pad_labs, analytes, ref_map):
+        """Like urine_diagnosis.match_pad_labs: analyte -> (best_label, distance)"""
+        results = {}
+        for analyte, lab in zip(analytes, pad_labs):
+            refs = ref_map.get(analyte, [])
+            if np.isnan(lab).any() or not refs:
+                results[analyte] = (None, float('inf'))
+            else:
+                results[analyte] = self.match(lab, refs)
+        return results
+
+
+if __name__ == "__main__":
+    # Consistency check on the bundled chart: fast_then_verify (and the cheaper
+    # metrics) against the exact CIEDE2000 argmin of match_lab_to_levels
+    import time
+    from urine_diagnosis import load_reference_mapping, match_lab_to_levels, DEFAULT_CALIBRATION_ARTIFACT
+
+    ref_map, _ = load_reference_mapping(DEFAULT_CALIBRATION_ARTIFACT)
+    rng = np.random.default_rng(0)
+    queries = []
+    for analyte, levels in ref_map.items():
+        labs = np.array([lab for _, lab in levels])
+        # pads near each level (sensor noise, lighting error) and anywhere between levels
+        for noise in (2.0, 5.0, 10.0):
+            for lab in labs:
+                queries += [(analyte, q) for q in np.clip(lab + rng.normal(0, noise, (40, 3)), 0, 255)]
+        t = rng.uniform(0, 1, (200, 1))
+        i, j = rng.integers(0, len(labs), (2, 200))
+        queries += [(analyte, q) for q in labs[i] * t + labs[j] * (1 - t)]
+
+    start = time.perf_counter()
+    exact = [match_lab_to_levels(q, ref_map[a]) for a, q in queries]
+    t_exact = time.perf_counter() - start
+    print(f"Bundled chart: {len(ref_map)} analytes, {len(queries)} pad colors; "
+          f"match_lab_to_levels {t_exact / len(queries) * 1e6:.0f} us/pad")
+
+    for metric, strategy in [("ciede2000", "exact"), ("ciede2000", "fast_then_verify"),
+                             ("cie94", "exact"), ("cie76", "exact")]:
+        matcher = LevelMatcher(metric, strategy)
+        start = time.perf_counter()
+        got = [matcher.match(q, ref_map[a]) for a, q in queries]
+        elapsed = time.perf_counter() - start
+        same = sum(g[0] == e[0] for g, e in zip(got, exact))
+        line = (f"{metric:9s} {strategy:16s} {elapsed / len(queries) * 1e6:4.0f} us/pad, "
+                f"same argmin as CIEDE2000: {same}/{len(queries)}")
+        if strategy == "fast_then_verify":
+            line += f", conclusive without CIEDE2000: {matcher.conclusive_rate:.1%}"
+            assert same == len(queries), "fast_then_verify changed a decision"
+        if metric == "ciede2000" and strategy == "exact":
+            assert same == len(queries)
+        print(line)
@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+import numpy as np
+
+
+class ModelEntry:
+    """A loaded YOLO model shared by every detector that uses the same weights"""
+
+    def __init__(self, model_path):
+        self.model_path = model_path
+        self.model = None
+        # ultralytics predictors keep per-call state, so inference on a shared
+        # model must be serialized
+        self.lock = threading.RLock()
+        self.ready = threading.Event()
+        self.load_time = None
+        self.warmup_times = {}  # imgsz -> seconds spent warming up at that size
+
+    def timings(self):
+        return {
+            'load_s': self.load_time,
+            'warmup_s': dict(self.warmup_times),
+            'ready': self.ready.is_set(),
+        }
+
+
+class ModelRegistry:
+    """
+    Process-wide cache of YOLO models
+
+    Each weights file is loaded once, warmed up at the requested input sizes
+    and then handed out to every caller. Use the entry's lock around inference
+    when the model is shared between threads.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_path, warmup_sizes=(640,), warmup_runs=1, verbose=True):
+        """
+        Return the ModelEntry for model_path, loading and warming it up if needed
+
+        Args:
+            model_path: .pt weights or an exported model directory
+            warmup_sizes: Inference sizes to warm up (graph/allocator setup per size)
+            warmup_runs: Inferences per size during warm-up
+            verbose: Print timings when loading/warming up
+        """
+        key = os.path.abspath(model_path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = ModelEntry(key)
+                self._entries[key] = entry
+
+        # Loading happens under the entry lock: concurrent callers for the same
+        # weights wait for the first load instead of loading again.
+        with entry.lock:
+            if entry.model is None:
+                from ultralytics import YOLO
+                start = time.perf_counter()
+                entry.model = YOLO(model_path, task='detect')
+                entry.load_time = time.perf_counter() - start
+                if verbose:
+                    print(f"Loaded model {model_path} in {entry.load_time*1000:.0f} ms")
+
+            for size in warmup_sizes or ():
+                size = int(size)
+                if size in entry.warmup_times:
+                    continue
+                dummy = np.zeros((size, size, 3), dtype=np.uint8)
+                start = time.perf_counter()
+                for _ in range(max(1, warmup_runs)):
+                    entry.model.predict(dummy, imgsz=size, verbose=False)
+                entry.warmup_times[size] = time.perf_counter() - start
+                if verbose:
+                    print(f"Warmed up {os.path.basename(model_path)} at imgsz={size} "
+                          f"in {entry.warmup_times[size]*1000:.0f} ms")
+            entry.ready.set()
+        return entry
+
+    def timings(self):
+        """Load and warm-up timings of every registered model"""
+        with self._lock:
+            return {path: entry.timings() for path, entry in self._entries.items()}
+
+    def clear(self):
+        """Drop all cached models"""
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by UrineStripDetector and urine_diagnosis.main
+registry = ModelRegistry()
+
+
+def get_model(model_path, warmup_sizes=(640,), warmup_runs=1, verbose=True):
+    """Shortcut for registry.get()"""
+    return registry.get(model_path, warmup_sizes, warmup_runs, verbose)
@@ -0,0 +1,305 @@
+"""
+Mask R-CNN
+Dynamic batching in front of MaskRCNN.detect().
+
+detect() takes exactly BATCH_SIZE images that mold to the same shape, so a
+service that receives one image per request either runs mostly padding or
+makes its callers coordinate. DynamicBatcher accepts single images from any
+number of threads, groups them by molded shape, and runs a batch when a
+group is full or its oldest image has waited max_wait seconds. Partial
+batches are padded. Each caller gets a Future with its own detect() result.
+
+    batcher = DynamicBatcher(model, max_wait=0.02)
+    r = batcher.detect(image)                # blocking, from any thread
+    future = batcher.submit(image)           # or asynchronous
+    batcher.close()
+
+max_wait trades latency for throughput: 0 runs whatever is queued as soon
+as the model is free (lowest latency, more padding under light load);
+larger values wait for full batches.
+
+Simulated load test (latency and throughput for several max_wait values):
+    python -m mrcnn.batching
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import numpy as np
+import tensorflow as tf
+
+
+############################################################
+#  Dynamic Batcher
+############################################################
+
+class _Request(object):
+    """One submitted image, molded."""
+    __slots__ = ["molded_image", "image_meta", "window", "image_shape",
+                 "mask_format", "arrival", "future"]
+
+    def __init__(self, molded_image, image_meta, window, image_shape, mask_format):
+        self.molded_image = molded_image
+        self.image_meta = image_meta
+        self.window = window
+        self.image_shape = image_shape
+        self.mask_format = mask_format
+        self.arrival = time.monotonic()
+        self.future = Future()
+
+
+def _capture_session(model):
+    """Graph and session of a Keras model. TF1 Keras models run in the graph
+    and session they were built in, which other threads must enter."""
+    keras_model = getattr(model, "keras_model", None)
+    if keras_model is None:
+        return None, None
+    import keras.backend as K
+    if hasattr(keras_model, "_make_predict_function"):
+        # Build the predict function now rather than from the batching thread
+        keras_model._make_predict_function()
+    return tf.get_default_graph(), K.get_session()
+
+
+class DynamicBatcher(object):
+    """Thread-safe batching front end of a MaskRCNN model in inference mode.
+
+    model: MaskRCNN in inference mode. Batches have config.BATCH_SIZE images.
+    max_wait: Seconds the oldest image of a shape group waits for the group
+        to fill up before it runs as a padded partial batch.
+    max_pending: Maximum images queued. submit() blocks while the queue is
+        full. None for no limit.
+    mask_format: Default mask format of the results, see
+        MaskRCNN.unmold_detections().
+    unmold_workers: Threads that convert network outputs into results,
+        so the model can run the next batch meanwhile.
+
+    Images are molded in the calling thread, so concurrent callers mold in
+    parallel. The model only runs in the batcher's own thread.
+    """
+
+    def __init__(self, model, max_wait=0.01, max_pending=None, mask_format="dense",
+                 unmold_workers=1):
+        assert model.mode == "inference", "Create model in inference mode."
+        self.model = model
+        self.batch_size = model.config.BATCH_SIZE
+        self.max_wait = max_wait
+        self.max_pending = max_pending
+        self.mask_format = mask_format
+        self.stats = {"requests": 0, "batches": 0, "padding": 0,
+                      "queue_s": 0.0, "predict_s": 0.0}
+        # Molded shape -> deque of requests, oldest first
+        self._groups = {}
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self._graph, self._session = _capture_session(model)
+        self._unmold = ThreadPoolExecutor(max(unmold_workers, 1))
+        self._thread = threading.Thread(target=self._run, name="DynamicBatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image, mask_format=None):
+        """Queues one image. Returns a Future of its detect() result dict."""
+        molded_image, image_meta, window = self.model.mold_input(image)
+        request = _Request(molded_image, image_meta, window, image.shape,
+                           mask_format or self.mask_format)
+        with self._condition:
+            while self.max_pending and self._pending >= self.max_pending and not self._closed:
+                self._condition.wait()
+            if self._closed:
+                raise RuntimeError("DynamicBatcher is closed")
+            request.arrival = time.monotonic()
+            self._groups.setdefault(molded_image.shape, deque()).append(request)
+            self._pending += 1
+            self.stats["requests"] += 1
+            self._condition.notify_all()
+        return request.future
+
+    def detect(self, image, timeout=None, mask_format=None):
+        """Runs detection on one image and waits for the result dict."""
+        return self.submit(image, mask_format).result(timeout)
+
+    def _next_batch(self):
+        """Waits until a group is full or its deadline passed and takes up
+        to batch_size requests from it, oldest group first. Returns None
+        once closed and drained."""
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                due, wake = None, None
+                for shape, group in self._groups.items():
+                    deadline = group[0].arrival + self.max_wait
+                    if len(group) >= self.batch_size or deadline <= now or self._closed:
+                        if due is None or group[0].arrival < self._groups[due][0].arrival:
+                            due = shape
+                    elif wake is None or deadline < wake:
+                        wake = deadline
+                if due is not None:
+                    group = self._groups[due]
+                    batch = [group.popleft() for _ in range(min(len(group), self.batch_size))]
+                    if not group:
+                        del self._groups[due]
+                    self._pending -= len(batch)
+                    self._condition.notify_all()
+                    return batch
+                if self._closed:
+                    return None
+                self._condition.wait(None if wake is None else wake - now)
+
+    def _predict(self, molded_images, image_metas):
+        if self._graph is None:
+            return self.model.predict_molded(molded_images, image_metas)
+        with self._graph.as_default(), self._session.as_default():
+            return self.model.predict_molded(molded_images, image_metas)
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            # Skip requests cancelled by their callers
+            batch = [r for r in batch if r.future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            start = time.monotonic()
+            # Pad partial batches by repeating the last image
+            padding = self.batch_size - len(batch)
+            requests = batch + batch[-1:] * padding
+            try:
+                detections, mrcnn_mask = self._predict(
+                    np.stack([r.molded_image for r in requests]),
+                    np.stack([r.image_meta for r in requests]))
+            except Exception as e:
+                for r in batch:
+                    r.future.set_exception(e)
+                continue
+            self.stats["batches"] += 1
+            self.stats["padding"] += padding
+            self.stats["queue_s"] += sum(start - r.arrival for r in batch)
+            self.stats["predict_s"] += time.monotonic() - start
+            for i, r in enumerate(batch):
+                self._unmold.submit(self._finish, r, detections[i], mrcnn_mask[i])
+
+    def _finish(self, request, detections, mrcnn_mask):
+        try:
+            result = self.model.detection_result(
+                detections, mrcnn_mask, request.image_shape, request.molded_image.shape,
+                request.window, mask_format=request.mask_format)
+        except Exception as e:
+            request.future.set_exception(e)
+            return
+        request.future.set_result(result)
+
+    def close(self):
+        """Runs the queued images, then stops the batching thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._unmold.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+############################################################
+#  Simulated Load Test
+############################################################
+
+class _SimulatedModel(object):
+    """Stands in for MaskRCNN: molds to one of two shapes, and a batch costs
+    a fixed overhead plus a per-image time whether the slot is padding or
+    not, like a GPU running a fixed-size batch."""
+
+    class config(object):
+        BATCH_SIZE = 4
+
+    mode = "inference"
+
+    def __init__(self, overhead=0.02, per_image=0.01):
+        self.overhead = overhead
+        self.per_image = per_image
+
+    def mold_input(self, image):
+        shape = (64, 64, 3) if image.shape[0] <= image.shape[1] else (64, 48, 3)
+        molded = np.zeros(shape, dtype=np.float32)
+        molded[0, 0, 0] = image[0, 0, 0]
+        return molded, np.array([image[0, 0, 0]]), (0, 0) + shape[:2]
+
+    def predict_molded(self, molded_images, image_metas):
+        assert len(molded_images) == self.config.BATCH_SIZE
+        assert all(m.shape == molded_images[0].shape for m in molded_images)
+        time.sleep(self.overhead + self.per_image * len(molded_images))
+        return image_metas, molded_images
+
+    def detection_result(self, detections, mrcnn_mask, original_image_shape,
+                         image_shape, window, mask_format="dense"):
+        return {"id": float(detections[0]), "molded_shape": mrcnn_mask.shape}
+
+
+if __name__ == "__main__":
+    per_client = 20
+    rng = np.random.RandomState(0)
+
+    def load_test(detect, clients, pause):
+        """Closed-loop clients, each sending per_client images of both
+        orientations with random pauses. Returns images/s and latency
+        percentiles (ms)."""
+        images = [[np.full((48 + 16 * rng.randint(0, 3), 64, 3) if rng.rand() < 0.7 else
+                           (64, 48, 3), c * per_client + i, dtype=np.float32)
+                   for i in range(per_client)] for c in range(clients)]
+        pauses = rng.exponential(pause, (clients, per_client))
+        latencies = []
+        lock = threading.Lock()
+
+        def client(c):
+            for i, image in enumerate(images[c]):
+                time.sleep(pauses[c, i])
+                start = time.monotonic()
+                r = detect(image)
+                # Results are routed back to the right caller
+                assert r["id"] == image[0, 0, 0]
+                with lock:
+                    latencies.append(time.monotonic() - start)
+
+        start = time.monotonic()
+        threads = [threading.Thread(target=client, args=(c,)) for c in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.monotonic() - start
+        latencies = np.array(latencies) * 1000
+        return len(latencies) / elapsed, np.percentile(latencies, 50), np.percentile(latencies, 95)
+
+    model = _SimulatedModel()
+    # Baseline: every request runs alone in a padded batch, one at a time
+    model_lock = threading.Lock()
+
+    def detect_alone(image):
+        molded, meta, window = model.mold_input(image)
+        with model_lock:
+            detections, masks = model.predict_molded(
+                np.stack([molded] * model.config.BATCH_SIZE),
+                np.stack([meta] * model.config.BATCH_SIZE))
+        return model.detection_result(detections[0], masks[0], image.shape, molded.shape, window)
+
+    for clients, pause in [(3, 0.05), (12, 0.02)]:
+        print("{} clients x {} images, batch size {}".format(clients, per_client,
+                                                            model.config.BATCH_SIZE))
+        print("  one image per batch: {:6.1f} images/s, latency p50 {:6.1f} ms, "
+              "p95 {:6.1f} ms".format(*load_test(detect_alone, clients, pause)))
+        for max_wait in [0, 0.02, 0.1]:
+            with DynamicBatcher(model, max_wait=max_wait) as batcher:
+                throughput, p50, p95 = load_test(batcher.detect, clients, pause)
+            stats = batcher.stats
+            print("  max_wait {:5.3f} s:   {:6.1f} images/s, latency p50 {:6.1f} ms, "
+                  "p95 {:6.1f} ms, {} batches, {:.0%} padding".format(
+                      max_wait, throughput, p50, p95, stats["batches"],
+                      stats["padding"] / (stats["batches"] * model.config.BATCH_SIZE)))
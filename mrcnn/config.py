@@ -84,12 +84,24 @@ class Config(object):
     # If 2, then anchors are created for every other cell, and so on.
     RPN_ANCHOR_STRIDE = 1
 
+    # Directory to save generated anchor pyramids in (as .npy files), so that
+    # other processes and later runs load them instead of generating them.
+    # None keeps them in memory only. See utils.get_pyramid_anchors().
+    ANCHOR_CACHE_DIR = None
+
     # Non-max suppression threshold to filter RPN proposals.
     # You can increase this during training to generate more propsals.
     RPN_NMS_THRESHOLD = 0.7
 
     # How many anchors per image to use for RPN training
     RPN_TRAIN_ANCHORS_PER_IMAGE = 256
+
+    # Cache the anchor to GT box matching of each training image in the data
+    # generator. Only used for images that aren't augmented (their boxes are
+    # the same every epoch). Skips most of the RPN target work after the
+    # first epoch, at the cost of memory for the matched anchor IDs of every
+    # image (tens of KB per image).
+    CACHE_ANCHOR_MATCHES = False
     
     # ROIs kept after tf.nn.top_k and before non-maximum suppression
     PRE_NMS_LIMIT = 6000
@@ -210,6 +222,29 @@ class Config(object):
     # Gradient norm clipping
     GRADIENT_CLIP_NORM = 5.0
 
+    # Training input pipeline (see data_pipeline.py)
+    # Number of worker processes that build training batches. 0 uses the
+    # original data_generator() with Keras' own multiprocessing.
+    DATA_PIPELINE_WORKERS = 0
+    # Batches built ahead of the training step (shared memory buffers)
+    DATA_PIPELINE_PREFETCH = 4
+    # Base seed of the batch order and augmentation. None: random.
+    DATA_PIPELINE_SEED = None
+    # Log, per epoch, the time spent waiting for input vs. in training steps
+    DATA_PIPELINE_INSTRUMENT = False
+
+    # Backend of image and mask resizing: "skimage" or "opencv". OpenCV is
+    # several times faster and keeps uint8 images uint8; results differ from
+    # skimage by at most one intensity level (see resize_backend.py).
+    RESIZE_BACKEND = "skimage"
+
+    # Cache of decoded dataset images used by load_image_gt() (see
+    # image_cache.py). Size in bytes, 0 to disable. With IMAGE_CACHE_DIR the
+    # images are stored as memory-mapped files in that directory (shared by
+    # data pipeline workers), otherwise in memory (one cache per worker).
+    IMAGE_CACHE_BYTES = 0
+    IMAGE_CACHE_DIR = None
+
     def __init__(self):
         """Set values of computed attributes."""
         # Effective batch size
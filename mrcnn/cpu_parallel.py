@@ -0,0 +1,386 @@
+"""
+Mask R-CNN
+Data-parallel inference on CPU cores.
+
+ParallelModel splits batches across GPUs with device scopes inside one
+TensorFlow graph. On a CPU-only machine one TensorFlow process doesn't use
+many cores well, so CPUParallelDetector runs N model replicas in separate
+processes instead, each with its own pinned set of cores and TensorFlow
+thread pools sized to match. Images are scattered to the replicas through
+shared memory and the results are gathered back in input order.
+
+    detector = CPUParallelDetector(config, "mask_rcnn.h5", replicas=4)
+    results = detector.detect(images)   # any number of images
+    detector.close()
+
+Replicas are started with the "spawn" method and import TensorFlow only
+after their thread settings are in place, so the parent process doesn't
+need TensorFlow at all.
+
+Scaling measurement from 1 to N replicas:
+    python -m mrcnn.cpu_parallel --weights mask_rcnn.h5 --images path/to/images
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import time
+import queue
+import functools
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+
+from mrcnn.config import Config
+
+
+############################################################
+#  Replica Process
+############################################################
+
+def available_cores():
+    """CPU cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(multiprocessing.cpu_count()))
+
+
+def pin_threads(cores):
+    """Restricts this process to the given cores and sizes the thread pools
+    of the numeric libraries to match. Must run before TensorFlow (or
+    NumPy's BLAS) creates its thread pools."""
+    threads = str(len(cores))
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS",
+                 "TF_NUM_INTRAOP_THREADS"]:
+        os.environ[name] = threads
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+    # CPU only: don't let TensorFlow grab GPUs that might be visible
+    os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+
+
+def load_model(config, weights_path, model_dir, threads):
+    """Default replica model: MaskRCNN in inference mode with the given
+    weights, in a session with `threads` intra-op threads."""
+    import tensorflow as tf
+    import keras.backend as K
+    from mrcnn import model as modellib
+
+    session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                    inter_op_parallelism_threads=1,
+                                    device_count={"GPU": 0})
+    K.set_session(tf.Session(config=session_config))
+    model = modellib.MaskRCNN(mode="inference", config=config, model_dir=model_dir)
+    model.load_weights(weights_path, by_name=True)
+    return model
+
+
+def _replica_main(index, cores, model_factory, config, task_queue, result_queue):
+    """Replica process: loads the model, then runs detect() on the images
+    of each task, read from the named shared memory block."""
+    pin_threads(cores)
+    try:
+        model = model_factory(config, threads=len(cores))
+    except Exception:
+        result_queue.put((index, None, traceback.format_exc()))
+        return
+    result_queue.put((index, "ready", None))
+
+    block = None
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            task_id, block_name, images_layout, mask_format = task
+            try:
+                if block is None or block.name != block_name:
+                    if block is not None:
+                        block.close()
+                    block = shared_memory.SharedMemory(name=block_name)
+                images = [np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=offset)
+                          for offset, shape, dtype in images_layout]
+                results = []
+                batch_size = config.BATCH_SIZE
+                for i in range(0, len(images), batch_size):
+                    batch = images[i:i + batch_size]
+                    # detect() takes full batches: repeat the last image
+                    padded = batch + batch[-1:] * (batch_size - len(batch))
+                    results += model.detect(padded, mask_format=mask_format)[:len(batch)]
+                del images
+            except Exception:
+                result_queue.put((task_id, None, traceback.format_exc()))
+                continue
+            result_queue.put((task_id, "done", results))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if block is not None:
+            block.close()
+
+
+############################################################
+#  Detector
+############################################################
+
+class _InputBlock(object):
+    """Growable shared memory block the images of one replica are written to."""
+
+    def __init__(self):
+        self.shm = None
+
+    def write(self, images):
+        """Copies images into the block. Returns its name and the
+        (offset, shape, dtype) of each image."""
+        layout, size = [], 0
+        for image in images:
+            size = -(-size // 64) * 64  # 64-byte align every image
+            layout.append((size, image.shape, image.dtype.str))
+            size += image.nbytes
+        if self.shm is None or self.shm.size < size:
+            self.close()
+            # Grow with headroom so similar requests reuse the block
+            self.shm = shared_memory.SharedMemory(create=True, size=max(int(size * 1.5), 1))
+        for image, (offset, shape, dtype) in zip(images, layout):
+            np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)[...] = image
+        return self.shm.name, layout
+
+    def close(self):
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class CPUParallelDetector(object):
+    """Runs MaskRCNN.detect() on N CPU replicas in separate processes.
+
+    config: Inference Config of the model. Replicas run batches of
+        config.BATCH_SIZE images; 1 is usually fastest on CPU.
+    weights_path: Weights loaded by every replica (by layer name).
+    replicas: Number of model processes. Default: one per 4 cores.
+    threads_per_replica: Cores pinned to each replica. Default: the
+        available cores divided evenly between the replicas.
+    model_dir: model_dir of the replica models (logs aren't written in
+        inference mode).
+    mask_format: Default mask format, see MaskRCNN.unmold_detections().
+        Results are pickled back to this process, so the compact formats
+        are much cheaper than "dense".
+    model_factory: Optional callable(config, threads) that builds a model
+        with a detect() method in the replica. Must be picklable. Defaults
+        to load_model() with weights_path.
+    startup_timeout: Seconds to wait for the replicas to load their model.
+    """
+
+    def __init__(self, config, weights_path=None, replicas=None, threads_per_replica=None,
+                 model_dir=".", mask_format="dense", model_factory=None,
+                 startup_timeout=600):
+        cores = available_cores()
+        self.config = config
+        self.replicas = replicas or max(1, len(cores) // 4)
+        self.threads_per_replica = threads_per_replica or max(1, len(cores) // self.replicas)
+        self.mask_format = mask_format
+        self._next_task = 0
+        self._closed = False
+        if model_factory is None:
+            assert weights_path, "weights_path is required with the default model"
+            model_factory = functools.partial(load_model, weights_path=weights_path,
+                                              model_dir=model_dir)
+
+        ctx = multiprocessing.get_context("spawn")
+        self._result_queue = ctx.Queue()
+        self._task_queues = []
+        self._blocks = []
+        self._processes = []
+        for i in range(self.replicas):
+            # Replicas share cores round-robin if there are more threads than cores
+            start = i * self.threads_per_replica
+            replica_cores = [cores[(start + j) % len(cores)]
+                             for j in range(self.threads_per_replica)]
+            task_queue = ctx.Queue()
+            p = ctx.Process(target=_replica_main,
+                            args=(i, replica_cores, model_factory, config,
+                                  task_queue, self._result_queue),
+                            daemon=True)
+            p.start()
+            self._task_queues.append(task_queue)
+            self._blocks.append(_InputBlock())
+            self._processes.append(p)
+
+        # Wait for all models to load
+        ready = set()
+        deadline = time.monotonic() + startup_timeout
+        while len(ready) < self.replicas:
+            index, status, info = self._get_result(deadline)
+            if status is None:
+                self.close()
+                raise RuntimeError("Replica {} failed to load the model:\n{}".format(index, info))
+            ready.add(index)
+
+    def _get_result(self, deadline=None):
+        while True:
+            try:
+                return self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._processes):
+                    self.close()
+                    raise RuntimeError("A replica process died unexpectedly")
+                if deadline is not None and time.monotonic() > deadline:
+                    self.close()
+                    raise RuntimeError("Timed out waiting for the replicas")
+
+    def detect(self, images, verbose=0, mask_format=None):
+        """Runs the detection pipeline on any number of images.
+
+        images: List of images, potentially of different sizes.
+        mask_format: "dense", "bbox" or "rle". Defaults to the detector's.
+
+        Returns a list of dicts, one per image, in input order, like
+        MaskRCNN.detect().
+        """
+        assert not self._closed, "CPUParallelDetector is closed"
+        mask_format = mask_format or self.mask_format
+        if not len(images):
+            return []
+        # Scatter contiguous runs of whole batches over the replicas
+        batch_size = self.config.BATCH_SIZE
+        batches = -(-len(images) // batch_size)
+        per_replica = -(-batches // self.replicas) * batch_size
+        tasks = {}
+        for replica, start in enumerate(range(0, len(images), per_replica)):
+            part = [np.ascontiguousarray(image) for image in images[start:start + per_replica]]
+            block_name, layout = self._blocks[replica].write(part)
+            task_id = self._next_task
+            self._next_task += 1
+            tasks[task_id] = start
+            self._task_queues[replica].put((task_id, block_name, layout, mask_format))
+        if verbose:
+            print("Processing {} images on {} replicas".format(len(images), len(tasks)))
+
+        # Gather
+        results = [None] * len(images)
+        while tasks:
+            task_id, status, info = self._get_result()
+            if status is None:
+                self.close()
+                raise RuntimeError("Replica failed on task {}:\n{}".format(task_id, info))
+            start = tasks.pop(task_id)
+            results[start:start + len(info)] = info
+        return results
+
+    def close(self):
+        """Stops the replicas and frees the shared memory."""
+        if self._closed:
+            return
+        self._closed = True
+        for task_queue in self._task_queues:
+            task_queue.put(None)
+        for p in self._processes:
+            p.join(timeout=10)
+            if p.is_alive():
+                p.terminate()
+        for block in self._blocks:
+            block.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+############################################################
+#  Scaling Measurement
+############################################################
+
+def measure_scaling(config, images, replica_counts, weights_path=None, total_threads=None,
+                    repeat=3, **kwargs):
+    """Throughput of CPUParallelDetector for each number of replicas, with
+    the same total number of cores split between them.
+
+    images: Images to run. Use several per replica.
+    replica_counts: e.g. [1, 2, 4, 8]
+    total_threads: Cores to use in total. Default: all available.
+    kwargs: Passed to CPUParallelDetector.
+
+    Returns a list of dicts (replicas, threads_per_replica, images_per_s,
+    speedup, efficiency), speedup relative to the first replica count.
+    """
+    total_threads = total_threads or len(available_cores())
+    rows = []
+    for replicas in replica_counts:
+        threads = max(1, total_threads // replicas)
+        with CPUParallelDetector(config, weights_path, replicas=replicas,
+                                 threads_per_replica=threads, **kwargs) as detector:
+            detector.detect(images[:replicas * config.BATCH_SIZE])  # warm up
+            best = None
+            for _ in range(repeat):
+                start = time.perf_counter()
+                detector.detect(images)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+        rows.append({"replicas": replicas, "threads_per_replica": threads,
+                     "images_per_s": len(images) / best})
+    for row in rows:
+        row["speedup"] = row["images_per_s"] / rows[0]["images_per_s"]
+        row["efficiency"] = row["speedup"] * rows[0]["replicas"] / row["replicas"]
+    return rows
+
+
+class ScalingConfig(Config):
+    """Inference config of the command line measurement. Defined at module
+    level so that spawned replicas can unpickle it."""
+    NAME = "cpu_parallel"
+    GPU_COUNT = 1
+    IMAGES_PER_GPU = 1
+
+    def __init__(self, num_classes):
+        self.NUM_CLASSES = num_classes
+        super(ScalingConfig, self).__init__()
+
+
+def print_scaling(rows):
+    print("replicas  threads/replica  images/s  speedup  efficiency")
+    for row in rows:
+        print("{:8d}  {:15d}  {:8.2f}  {:7.2f}  {:10.0%}".format(
+            row["replicas"], row["threads_per_replica"], row["images_per_s"],
+            row["speedup"], row["efficiency"]))
+
+
+if __name__ == "__main__":
+    import argparse
+    import skimage.io
+
+    parser = argparse.ArgumentParser(
+        description="Measure CPU data-parallel Mask R-CNN inference scaling")
+    parser.add_argument("--weights", required=True, help="Path to weights .h5 file")
+    parser.add_argument("--images", required=True, help="Directory of images to run")
+    parser.add_argument("--num-classes", type=int, default=81,
+                        help="Number of classes including background (default: 81, COCO)")
+    parser.add_argument("--replicas", type=int, default=len(available_cores()),
+                        help="Largest number of replicas to measure")
+    parser.add_argument("--count", type=int, default=32, help="Images per measurement")
+    args = parser.parse_args()
+
+    names = sorted(os.listdir(args.images))
+    images = [skimage.io.imread(os.path.join(args.images, name))[..., :3]
+              for name in names if name.lower().endswith((".jpg", ".jpeg", ".png"))]
+    assert images, "No images found in {}".format(args.images)
+    images = (images * (-(-args.count // len(images))))[:args.count]
+
+    counts = [1]
+    while counts[-1] * 2 <= args.replicas:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != args.replicas:
+        counts.append(args.replicas)
+    print("{} images, {} cores".format(len(images), len(available_cores())))
+    print_scaling(measure_scaling(ScalingConfig(args.num_classes), images, counts, weights_path=args.weights,
+                                  mask_format="bbox"))
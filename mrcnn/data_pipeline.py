@@ -0,0 +1,367 @@
+"""
+Mask R-CNN
+Parallel input pipeline for training.
+
+DataPipeline produces the same (inputs, outputs) batches as
+model.data_generator(), but builds them in worker processes. Batches are
+written into shared memory buffers, so nothing large is pickled between
+processes, and up to `prefetch` batches are built ahead of the training
+step.
+
+Batches are deterministic for a given seed: the image order of each epoch
+and the random state used to build each batch (augmentation, anchor and
+instance sampling) depend only on the seed and the batch number, not on
+the number of workers or on which worker built the batch.
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import time
+import queue
+import random
+import logging
+import traceback
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+import keras
+
+from mrcnn import utils
+from mrcnn import image_cache
+from mrcnn import model as modellib
+
+
+############################################################
+#  Batch construction (runs in the workers)
+############################################################
+
+def batch_seed(seed, batch_index):
+    """Random seed of one batch, derived from the pipeline seed."""
+    return (seed * 1000003 + batch_index * 7919) % (2 ** 32)
+
+
+def seed_everything(seed):
+    """Seeds all random generators used while building a batch."""
+    random.seed(seed)
+    np.random.seed(seed)
+    try:
+        import imgaug
+        imgaug.seed(seed)
+    except ImportError:
+        pass
+
+
+def build_batch(dataset, config, anchors, image_ids, seed, options, out=None,
+                anchor_match_cache=None, max_errors=5):
+    """Builds one batch from the given image IDs.
+
+    Images without instances (or that fail to load) are replaced by images
+    drawn at random from the dataset with the batch's own random state, so
+    the batch stays deterministic.
+
+    Returns (inputs, outputs) as model.data_generator() yields them.
+    """
+    seed_everything(seed)
+    candidates = list(image_ids)
+    samples = []
+    error_count = 0
+    while len(samples) < len(image_ids):
+        image_id = candidates.pop(0) if candidates else np.random.choice(dataset.image_ids)
+        try:
+            sample = modellib.load_training_sample(dataset, config, image_id, anchors,
+                                                   anchor_match_cache=anchor_match_cache,
+                                                   **options)
+        except Exception:
+            logging.exception("Error processing image {}".format(
+                dataset.image_info[image_id]))
+            error_count += 1
+            if error_count > max_errors:
+                raise
+            continue
+        if sample is not None:
+            samples.append(sample)
+    return modellib.assemble_training_batch(
+        samples, config, options["random_rois"], options["detection_targets"], out=out)
+
+
+class _SharedBatch(object):
+    """A batch-sized set of arrays in one shared memory block."""
+
+    def __init__(self, layout, name=None):
+        """layout: list of (shape, dtype str) for inputs followed by outputs."""
+        self.layout = layout
+        offsets, size = [], 0
+        for shape, dtype in layout:
+            size = -(-size // 64) * 64  # 64-byte align every array
+            offsets.append(size)
+            size += int(np.prod(shape)) * np.dtype(dtype).itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=max(size, 1))
+        self.arrays = [np.ndarray(shape, dtype=dtype, buffer=self.shm.buf, offset=offset)
+                       for (shape, dtype), offset in zip(layout, offsets)]
+
+    def split(self, input_count):
+        return self.arrays[:input_count], self.arrays[input_count:]
+
+    def close(self, unlink=False):
+        self.arrays = []
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def _worker_loop(dataset, config, anchors, options, layout, input_count,
+                 task_queue, result_queue):
+    """Worker process: builds batches into the shared slots named in the tasks."""
+    slots = {}
+    anchor_match_cache = {} if config.CACHE_ANCHOR_MATCHES else None
+    # Spawned workers don't inherit the backend selected in the parent
+    utils.set_resize_backend(config.RESIZE_BACKEND)
+    try:
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+            batch_index, image_ids, seed, slot_name = task
+            start = time.perf_counter()
+            try:
+                if slot_name not in slots:
+                    slots[slot_name] = _SharedBatch(layout, name=slot_name)
+                build_batch(dataset, config, anchors, image_ids, seed, options,
+                            out=slots[slot_name].split(input_count),
+                            anchor_match_cache=anchor_match_cache)
+            except Exception:
+                result_queue.put((batch_index, None, traceback.format_exc()))
+                continue
+            result_queue.put((batch_index, slot_name, time.perf_counter() - start))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for slot in slots.values():
+            slot.close()
+
+
+############################################################
+#  Pipeline
+############################################################
+
+class DataPipeline(object):
+    """Multiprocess replacement for model.data_generator().
+
+    Iterating yields (inputs, outputs) lists like data_generator(). The
+    arrays are views into a shared memory slot that is reused once the next
+    batch is requested, so consume (or copy) a batch before asking for the
+    next one. Keras fit_generator() with workers=0 does exactly that.
+
+    dataset, config, shuffle, augment, augmentation, random_rois,
+    batch_size, detection_targets, no_augmentation_sources: See
+        model.data_generator().
+    workers: Number of worker processes (default: CPU count).
+    prefetch: Batches built ahead of the consumer (= shared memory slots).
+    seed: Base random seed. None picks a random one.
+    instrument: Record how long the consumer waits for each batch.
+    mp_context: multiprocessing start method. "fork" (the default where
+        available) shares the dataset with the workers without pickling it;
+        with "spawn" the dataset and config must be picklable.
+    """
+
+    def __init__(self, dataset, config, shuffle=True, augment=False, augmentation=None,
+                 random_rois=0, batch_size=1, detection_targets=False,
+                 no_augmentation_sources=None, workers=None, prefetch=4, seed=None,
+                 instrument=False, mp_context=None):
+        self.dataset = dataset
+        self.config = config
+        self.shuffle = shuffle
+        self.batch_size = batch_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.prefetch = max(prefetch, 1)
+        self.seed = seed if seed is not None else int.from_bytes(os.urandom(4), "little")
+        self.instrument = instrument
+        self.options = {"augment": augment, "augmentation": augmentation,
+                        "random_rois": random_rois, "detection_targets": detection_targets,
+                        "no_augmentation_sources": no_augmentation_sources}
+        self.stats = {"batches": 0, "wait_s": 0.0, "build_s": 0.0}
+        self._image_ids = np.copy(dataset.image_ids)
+        self._epoch_order = {}
+        self._next_task = 0
+        self._next_batch = 0
+        self._ready = {}
+        self._free = []
+        self._in_use = None
+        self._closed = False
+        self._processes = []
+        self._slots = {}
+        utils.set_resize_backend(config.RESIZE_BACKEND)
+        # Before the workers start, so they inherit it. Each worker fills
+        # its own copy of an in-memory cache; a disk cache is shared.
+        image_cache.attach_image_cache(dataset, config)
+
+        # Anchors
+        # [anchor_count, (y1, x1, y2, x2)]
+        backbone_shapes = modellib.compute_backbone_shapes(config, config.IMAGE_SHAPE)
+        self.anchors = utils.get_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                                 config.RPN_ANCHOR_RATIOS,
+                                                 backbone_shapes,
+                                                 config.BACKBONE_STRIDES,
+                                                 config.RPN_ANCHOR_STRIDE,
+                                                 cache_dir=config.ANCHOR_CACHE_DIR)
+
+        # Build the first batch here: it fixes the layout of the shared
+        # slots, and is the batch a worker would have built.
+        start = time.perf_counter()
+        self._first = build_batch(dataset, config, self.anchors, self._batch_image_ids(0),
+                                  batch_seed(self.seed, 0), self.options)
+        self.stats["build_s"] += time.perf_counter() - start
+        self._next_task = 1
+        inputs, outputs = self._first
+        self._input_count = len(inputs)
+        self._layout = [(a.shape, a.dtype.str) for a in inputs + outputs]
+
+        if mp_context is None:
+            mp_context = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        ctx = multiprocessing.get_context(mp_context)
+        self._task_queue = ctx.Queue()
+        self._result_queue = ctx.Queue()
+        for _ in range(self.prefetch):
+            slot = _SharedBatch(self._layout)
+            self._slots[slot.shm.name] = slot
+            self._free.append(slot.shm.name)
+        for _ in range(self.workers):
+            p = ctx.Process(target=_worker_loop,
+                            args=(dataset, config, self.anchors, self.options, self._layout,
+                                  self._input_count, self._task_queue, self._result_queue),
+                            daemon=True)
+            p.start()
+            self._processes.append(p)
+        self._submit()
+
+    def _epoch_image_ids(self, epoch):
+        """Image order of an epoch: the same for a given seed and epoch."""
+        if epoch not in self._epoch_order:
+            if self.shuffle:
+                rng = np.random.RandomState(batch_seed(self.seed, -1 - epoch))
+                self._epoch_order[epoch] = rng.permutation(self._image_ids)
+            else:
+                self._epoch_order[epoch] = self._image_ids
+            self._epoch_order.pop(epoch - 2, None)
+        return self._epoch_order[epoch]
+
+    def _batch_image_ids(self, batch_index):
+        """Image IDs of a batch. Batches run across epoch boundaries like
+        data_generator()."""
+        count = len(self._image_ids)
+        ids = []
+        for position in range(batch_index * self.batch_size,
+                              (batch_index + 1) * self.batch_size):
+            ids.append(self._epoch_image_ids(position // count)[position % count])
+        return ids
+
+    def _submit(self):
+        """Queue tasks for all free slots."""
+        while self._free:
+            slot_name = self._free.pop()
+            index = self._next_task
+            self._task_queue.put((index, self._batch_image_ids(index),
+                                  batch_seed(self.seed, index), slot_name))
+            self._next_task += 1
+
+    def _wait_for(self, batch_index):
+        while batch_index not in self._ready:
+            try:
+                index, slot_name, info = self._result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not all(p.is_alive() for p in self._processes):
+                    self.close()
+                    raise RuntimeError("A data pipeline worker died unexpectedly")
+                continue
+            if slot_name is None:
+                self.close()
+                raise RuntimeError("Data pipeline worker failed on batch {}:\n{}".format(
+                    index, info))
+            self._ready[index] = slot_name
+            self.stats["build_s"] += info
+        return self._ready.pop(batch_index)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        start = time.perf_counter()
+        # The previous batch has been consumed: its slot can be refilled
+        if self._in_use is not None:
+            self._free.append(self._in_use)
+            self._in_use = None
+            self._submit()
+        if self._next_batch == 0:
+            batch = self._first
+            self._first = None
+        else:
+            self._in_use = self._wait_for(self._next_batch)
+            batch = self._slots[self._in_use].split(self._input_count)
+        self._next_batch += 1
+        wait = time.perf_counter() - start
+        self.stats["batches"] += 1
+        self.stats["wait_s"] += wait
+        if self.instrument:
+            self.last_wait = wait
+        return batch
+
+    def close(self):
+        """Stops the workers and frees the shared memory."""
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._processes:
+            self._task_queue.put(None)
+        for p in self._processes:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+        for slot in self._slots.values():
+            slot.close(unlink=True)
+        self._slots = {}
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+############################################################
+#  Instrumentation
+############################################################
+
+class PipelineMonitor(keras.callbacks.Callback):
+    """Keras callback that reports, per epoch, how long training steps
+    waited for input batches versus the time spent in the steps.
+
+    pipeline: The DataPipeline feeding fit_generator() (workers=0).
+    """
+
+    def __init__(self, pipeline):
+        super(PipelineMonitor, self).__init__()
+        self.pipeline = pipeline
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.step_s = 0.0
+        self.steps = 0
+        self.wait_start = self.pipeline.stats["wait_s"]
+
+    def on_batch_begin(self, batch, logs=None):
+        self.step_start = time.perf_counter()
+
+    def on_batch_end(self, batch, logs=None):
+        self.step_s += time.perf_counter() - self.step_start
+        self.steps += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not self.steps:
+            return
+        wait = self.pipeline.stats["wait_s"] - self.wait_start
+        modellib.log("Input pipeline: {:.1f} ms/step waiting for input, {:.1f} ms/step "
+                     "training ({:.0%} of the time waiting)".format(
+                         wait / self.steps * 1000, self.step_s / self.steps * 1000,
+                         wait / max(wait + self.step_s, 1e-9)))
@@ -0,0 +1,434 @@
+"""
+Mask R-CNN
+Dataset-level evaluation: mAP over many images and IoU thresholds.
+
+utils.compute_ap() evaluates one image at one IoU threshold, and
+compute_ap_range() used to repeat the whole matching (mask overlaps
+included) for every threshold. utils.evaluate_image() computes the overlaps
+of an image once and matches the predictions at all IoU thresholds in one
+pass; this module spreads the images over a process pool. Results are accumulated per class across the dataset,
+COCO style (101-point interpolated precision, AP averaged over classes),
+along with the per-image AP of compute_ap() that the sample notebooks
+average.
+
+    evaluator = evaluate.evaluate_model(model, dataset, workers=8)
+    report = evaluator.summarize(class_names=dataset.class_names)
+    evaluate.write_report(report, "eval.json")
+
+Consistency check and benchmark against compute_ap_range():
+    python -m mrcnn.evaluate
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from mrcnn import utils
+# Per-image matching lives in utils (compute_matches() and compute_ap_range()
+# use it too); re-exported here as part of the evaluation API.
+from mrcnn.utils import COCO_IOU_THRESHOLDS, match_predictions, image_ap, evaluate_image
+
+# COCO recall sampling points
+COCO_RECALL_POINTS = np.linspace(0, 1, 101)
+
+
+############################################################
+#  Dataset Accumulation
+############################################################
+
+class Evaluator(object):
+    """Accumulates evaluate_image() results over a dataset.
+
+    iou_thresholds: Must match the thresholds of the added results.
+        Defaults to COCO_IOU_THRESHOLDS.
+    """
+
+    def __init__(self, iou_thresholds=None):
+        self.iou_thresholds = COCO_IOU_THRESHOLDS if iou_thresholds is None else \
+            np.asarray(iou_thresholds, dtype=np.float64)
+        self.image_ids = []
+        self.image_aps = []
+        self.timing = {}
+        self._scores = []
+        self._class_ids = []
+        self._matched = []
+        self._gt_class_ids = []
+
+    def add(self, image_id, result):
+        """Adds the evaluate_image() result of one image."""
+        assert result["pred_match"].shape[0] == len(self.iou_thresholds)
+        self.image_ids.append(image_id)
+        self.image_aps.append(result["ap"])
+        self._scores.append(result["scores"])
+        self._class_ids.append(result["class_ids"])
+        self._matched.append(result["pred_match"] > -1)
+        self._gt_class_ids.append(result["gt_class_ids"])
+
+    def class_ap(self):
+        """COCO-style AP and recall of every class with GT instances.
+
+        All predictions of a class across the dataset are ranked by score.
+        Precision is made non-increasing and sampled at 101 recall points.
+
+        Returns {class_id: dict(gt, predictions, ap [T], recall [T])}.
+        """
+        thresholds = len(self.iou_thresholds)
+        if not self.image_ids:
+            return {}
+        scores = np.concatenate(self._scores)
+        class_ids = np.concatenate(self._class_ids)
+        matched = np.concatenate(self._matched, axis=1) if scores.size else \
+            np.zeros((thresholds, 0), dtype=bool)
+        gt_class_ids = np.concatenate(self._gt_class_ids)
+        results = {}
+        # Crowd instances (negative IDs) aren't evaluated
+        for class_id in np.unique(gt_class_ids[gt_class_ids > 0]):
+            gt_count = int(np.sum(gt_class_ids == class_id))
+            ids = np.where(class_ids == class_id)[0]
+            ids = ids[np.argsort(-scores[ids], kind="mergesort")]
+            ap = np.zeros(thresholds)
+            recall = np.zeros(thresholds)
+            if len(ids):
+                tp = np.cumsum(matched[:, ids], axis=1)
+                recalls = tp / gt_count
+                precisions = tp / np.arange(1, len(ids) + 1)
+                precisions = np.maximum.accumulate(precisions[:, ::-1], axis=1)[:, ::-1]
+                for t in range(thresholds):
+                    steps = np.searchsorted(recalls[t], COCO_RECALL_POINTS, side="left")
+                    sampled = precisions[t][np.minimum(steps, len(ids) - 1)]
+                    ap[t] = np.mean(np.where(steps < len(ids), sampled, 0))
+                recall = recalls[:, -1]
+            results[int(class_id)] = {"gt": gt_count, "predictions": len(ids),
+                                      "ap": ap, "recall": recall}
+        return results
+
+    def summarize(self, class_names=None):
+        """Builds the evaluation report, a JSON-serializable dict.
+
+        class_names: Optional list of names indexed by class ID.
+        """
+        per_class = self.class_ap()
+        labels = ["{:.2f}".format(t) for t in self.iou_thresholds]
+        by_threshold = lambda values: {l: _number(v) for l, v in zip(labels, values)}
+
+        aps = np.array([c["ap"] for c in per_class.values()]).reshape(-1, len(labels))
+        recalls = np.array([c["recall"] for c in per_class.values()]).reshape(-1, len(labels))
+        image_aps = np.array(self.image_aps).reshape(-1, len(labels))
+        with_gt = ~np.isnan(image_aps).any(axis=1)
+        class_ap = aps.mean(axis=0) if len(aps) else np.full(len(labels), np.nan)
+        report = {
+            "images": len(self.image_ids),
+            "images_without_gt": int(np.sum(~with_gt)),
+            "iou_thresholds": [float(t) for t in self.iou_thresholds],
+            # COCO style: per-class AP, averaged over classes and thresholds
+            "mAP": _number(class_ap.mean()),
+            "mAP_per_threshold": by_threshold(class_ap),
+            "mAR": _number(recalls.mean()) if len(recalls) else None,
+            # Mean of the per-image utils.compute_ap() values
+            "image_mAP": _number(image_aps[with_gt].mean()) if with_gt.any() else None,
+            "image_mAP_per_threshold": by_threshold(
+                image_aps[with_gt].mean(axis=0) if with_gt.any() else [np.nan] * len(labels)),
+            "classes": [],
+            "timing": dict(self.timing),
+        }
+        for class_id, c in sorted(per_class.items()):
+            report["classes"].append({
+                "class_id": class_id,
+                "name": class_names[class_id] if class_names is not None else str(class_id),
+                "gt_instances": c["gt"],
+                "predictions": c["predictions"],
+                "AP": _number(c["ap"].mean()),
+                "AP_per_threshold": by_threshold(c["ap"]),
+                "recall_per_threshold": by_threshold(c["recall"]),
+            })
+        return report
+
+
+def _number(value):
+    """float for JSON, None for NaN."""
+    value = float(value)
+    return None if np.isnan(value) else value
+
+
+def write_report(report, path):
+    """Writes a summarize() report as JSON."""
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def print_report(report):
+    thresholds = report["mAP_per_threshold"]
+    print("Evaluated {} images ({} without GT)".format(report["images"],
+                                                     report["images_without_gt"]))
+    print("mAP @{}-{}: {}".format(min(thresholds), max(thresholds), _format(report["mAP"])))
+    for label in ["0.50", "0.75"]:
+        if label in thresholds:
+            print("mAP @{}: {}".format(label, _format(thresholds[label])))
+    print("per-image mAP @{}-{}: {}".format(min(thresholds), max(thresholds),
+                                           _format(report["image_mAP"])))
+    for c in report["classes"]:
+        print("  {:20} AP {}  ({} GT, {} predictions)".format(
+            c["name"], _format(c["AP"]), c["gt_instances"], c["predictions"]))
+
+
+def _format(value):
+    return "-" if value is None else "{:.3f}".format(value)
+
+
+############################################################
+#  Parallel Evaluation
+############################################################
+
+def _evaluate_samples(samples, iou_thresholds, use_masks):
+    """Worker task. samples: list of (image_id, (gt_boxes, gt_class_ids,
+    gt_masks), r) where r is a detection dict as returned by
+    MaskRCNN.detect(). Returns a list of (image_id, result)."""
+    results = []
+    for image_id, (gt_boxes, gt_class_ids, gt_masks), r in samples:
+        results.append((image_id, evaluate_image(
+            gt_boxes, gt_class_ids, gt_masks if use_masks else None,
+            r["rois"], r["class_ids"], r["scores"], r["masks"] if use_masks else None,
+            iou_thresholds=iou_thresholds)))
+    return results
+
+
+def evaluate(samples, iou_thresholds=None, workers=None, use_masks=True, chunk_size=16,
+             mp_context=None):
+    """Evaluates detections over a dataset with a process pool.
+
+    samples: Iterable of (image_id, (gt_boxes, gt_class_ids, gt_masks), r)
+        where r is a detection dict as returned by MaskRCNN.detect(). It's
+        consumed while the workers evaluate earlier images, so it can run
+        inference lazily. Compact masks (CompactMasks or RLE, see
+        detect(mask_format=...)) are much cheaper to send to the workers.
+    iou_thresholds: Defaults to COCO_IOU_THRESHOLDS (0.5:0.95).
+    workers: Number of processes (default: CPU count). 0 evaluates in this
+        process.
+    use_masks: Match by mask IoU (True) or box IoU (False).
+    chunk_size: Images per worker task. Evaluating one image takes about a
+        millisecond, so sending them one at a time costs more than it saves.
+    mp_context: multiprocessing start method, see DataPipeline.
+
+    Returns an Evaluator with all images added, in input order.
+    """
+    evaluator = Evaluator(iou_thresholds)
+    thresholds = evaluator.iou_thresholds
+    workers = multiprocessing.cpu_count() if workers is None else workers
+    start = time.perf_counter()
+    if workers == 0:
+        for image_id, result in _evaluate_samples(samples, thresholds, use_masks):
+            evaluator.add(image_id, result)
+    else:
+        context = multiprocessing.get_context(mp_context) if mp_context else None
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            # Bound the chunks in flight so a lazy samples iterator doesn't
+            # run ahead of the workers
+            pending, chunk = [], []
+            for sample in samples:
+                chunk.append(sample)
+                if len(chunk) == chunk_size:
+                    pending.append(executor.submit(_evaluate_samples, chunk, thresholds,
+                                                   use_masks))
+                    chunk = []
+                if len(pending) >= 2 * workers:
+                    for image_id, result in pending.pop(0).result():
+                        evaluator.add(image_id, result)
+            if chunk:
+                pending.append(executor.submit(_evaluate_samples, chunk, thresholds, use_masks))
+            for future in pending:
+                for image_id, result in future.result():
+                    evaluator.add(image_id, result)
+    evaluator.timing["total_s"] = time.perf_counter() - start
+    return evaluator
+
+
+def evaluate_model(model, dataset, image_ids=None, iou_thresholds=None, workers=None,
+                   use_masks=True, mp_context=None):
+    """Runs inference on dataset images and evaluates it with evaluate().
+
+    Images and GT are loaded with model.load_image_gt() (resized like in
+    training) and detected in batches of config.BATCH_SIZE. The workers
+    evaluate a batch while the next one runs through the model.
+
+    model: MaskRCNN in inference mode.
+    image_ids: Images to evaluate. Defaults to all of dataset.image_ids.
+
+    Returns the Evaluator. Its timing includes the inference time.
+    """
+    from mrcnn import model as modellib
+
+    config = model.config
+    image_ids = dataset.image_ids if image_ids is None else image_ids
+    timing = {"inference_s": 0.0}
+
+    def samples():
+        for i in range(0, len(image_ids), config.BATCH_SIZE):
+            ids = list(image_ids[i:i + config.BATCH_SIZE])
+            images, gts = [], []
+            for image_id in ids:
+                image, _, class_ids, boxes, masks = modellib.load_image_gt(
+                    dataset, config, image_id)
+                images.append(image)
+                gts.append((boxes, class_ids, utils.CompactMasks.from_dense(masks)))
+            # detect() takes full batches: repeat the last image
+            images += images[-1:] * (config.BATCH_SIZE - len(images))
+            start = time.perf_counter()
+            results = model.detect(images, mask_format="bbox")
+            timing["inference_s"] += time.perf_counter() - start
+            for image_id, gt, r in zip(ids, gts, results):
+                yield image_id, gt, r
+
+    evaluator = evaluate(samples(), iou_thresholds=iou_thresholds, workers=workers,
+                         use_masks=use_masks, mp_context=mp_context)
+    evaluator.timing.update(timing)
+    return evaluator
+
+
+############################################################
+#  Consistency Check and Benchmark
+############################################################
+
+# The original per-image loops of utils.compute_matches() and compute_ap(),
+# kept as the reference the engine is checked and benchmarked against.
+
+def _compute_matches_loop(overlaps, pred_class_ids, gt_class_ids, iou_threshold,
+                          score_threshold=0.0):
+    pred_match = -1 * np.ones([overlaps.shape[0]])
+    gt_match = -1 * np.ones([overlaps.shape[1]])
+    for i in range(overlaps.shape[0]):
+        sorted_ixs = np.argsort(overlaps[i])[::-1]
+        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
+        if low_score_idx.size > 0:
+            sorted_ixs = sorted_ixs[:low_score_idx[0]]
+        for j in sorted_ixs:
+            if gt_match[j] > -1:
+                continue
+            iou = overlaps[i, j]
+            if iou < iou_threshold:
+                break
+            if pred_class_ids[i] == gt_class_ids[j]:
+                gt_match[j] = i
+                pred_match[i] = j
+                break
+    return gt_match, pred_match
+
+
+def _compute_ap_loop(gt_boxes, gt_class_ids, gt_masks,
+                     pred_boxes, pred_class_ids, pred_scores, pred_masks, iou_threshold):
+    gt_boxes = utils.trim_zeros(gt_boxes)
+    gt_masks = gt_masks[..., :gt_boxes.shape[0]]
+    pred_boxes = utils.trim_zeros(pred_boxes)
+    pred_scores = pred_scores[:pred_boxes.shape[0]]
+    indices = np.argsort(pred_scores)[::-1]
+    overlaps = utils.compute_overlaps_masks(pred_masks[..., indices], gt_masks)
+    gt_match, pred_match = _compute_matches_loop(overlaps, pred_class_ids[indices],
+                                                 gt_class_ids, iou_threshold)
+    precisions = np.cumsum(pred_match > -1) / (np.arange(len(pred_match)) + 1)
+    recalls = np.cumsum(pred_match > -1).astype(np.float32) / len(gt_match)
+    precisions = np.concatenate([[0], precisions, [0]])
+    recalls = np.concatenate([[0], recalls, [1]])
+    for i in range(len(precisions) - 2, -1, -1):
+        precisions[i] = np.maximum(precisions[i], precisions[i + 1])
+    indices = np.where(recalls[:-1] != recalls[1:])[0] + 1
+    return np.sum((recalls[indices] - recalls[indices - 1]) * precisions[indices])
+
+
+def random_detections(count, image_shape=(1024, 1024), num_classes=4, seed=None):
+    """Synthetic GT and noisy predictions of one image, with CompactMasks.
+    Returns ((gt_boxes, gt_class_ids, gt_masks), r) like evaluate() takes."""
+    rng = np.random.RandomState(seed)
+    h, w = image_shape
+
+    def instances(boxes):
+        boxes = np.clip(boxes, 0, [h, w, h, w]).astype(np.int32)
+        masks = []
+        for y1, x1, y2, x2 in boxes:
+            yy, xx = np.mgrid[y1:y2, x1:x2]
+            cy, cx = (y1 + y2 - 1) / 2, (x1 + x2 - 1) / 2
+            ry, rx = max(y2 - y1, 1) / 2, max(x2 - x1, 1) / 2
+            masks.append(((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2 <= 1)
+        return boxes, utils.CompactMasks(boxes, masks, image_shape)
+
+    sizes = rng.randint(16, 256, (count, 2))
+    y1 = rng.randint(0, h - sizes[:, 0])
+    x1 = rng.randint(0, w - sizes[:, 1])
+    gt_boxes, gt_masks = instances(np.stack([y1, x1, y1 + sizes[:, 0], x1 + sizes[:, 1]], 1))
+    gt_class_ids = rng.randint(1, num_classes, count).astype(np.int32)
+
+    # A jittered detection for most GT instances, plus false positives
+    found = rng.rand(count) < 0.85
+    jitter = rng.normal(0, 0.08, (found.sum(), 4)) * np.tile(sizes[found], 2)
+    boxes = gt_boxes[found] + jitter
+    extra = rng.randint(0, count // 3 + 1)
+    ey = rng.randint(0, h - 32, extra)
+    ex = rng.randint(0, w - 32, extra)
+    boxes = np.concatenate([boxes, np.stack([ey, ex, ey + 32, ex + 48], 1)])
+    pred_boxes, pred_masks = instances(boxes)
+    class_ids = np.concatenate([gt_class_ids[found], rng.randint(1, num_classes, extra)])
+    wrong = rng.rand(len(class_ids)) < 0.05
+    class_ids[wrong] = rng.randint(1, num_classes, wrong.sum())
+    r = {"rois": pred_boxes, "class_ids": class_ids.astype(np.int32),
+         "scores": rng.rand(len(pred_boxes)).astype(np.float32), "masks": pred_masks}
+    return (gt_boxes, gt_class_ids, gt_masks), r
+
+
+if __name__ == "__main__":
+    # Matching: same matches as the original loop at every threshold
+    rng = np.random.RandomState(0)
+    for _ in range(200):
+        p, g = rng.randint(0, 30, 2)
+        overlaps = rng.rand(p, g) * (rng.rand(p, g) < 0.3)
+        pred_class_ids = rng.randint(1, 4, p)
+        gt_class_ids = rng.randint(1, 4, g)
+        gt_match, pred_match = match_predictions(overlaps, pred_class_ids, gt_class_ids,
+                                                 COCO_IOU_THRESHOLDS, 0.1)
+        for t, threshold in enumerate(COCO_IOU_THRESHOLDS):
+            gt_ref, pred_ref = _compute_matches_loop(overlaps, pred_class_ids, gt_class_ids,
+                                                     threshold, 0.1)
+            assert np.array_equal(gt_match[t], gt_ref) and np.array_equal(pred_match[t], pred_ref)
+    print("match_predictions: identical to the compute_matches() loop")
+
+    samples = [(image_id,) + random_detections(rng.randint(0, 25), seed=image_id)
+               for image_id in range(1000)]
+
+    # Per-image AP: same as compute_ap() at every threshold
+    for image_id, (gt_boxes, gt_class_ids, gt_masks), r in samples[:50]:
+        if len(gt_boxes) == 0:
+            continue
+        result = evaluate_image(gt_boxes, gt_class_ids, gt_masks, r["rois"],
+                                r["class_ids"], r["scores"], r["masks"])
+        for t, threshold in enumerate(COCO_IOU_THRESHOLDS):
+            ap = _compute_ap_loop(gt_boxes, gt_class_ids, gt_masks, r["rois"],
+                                  r["class_ids"], r["scores"], r["masks"], threshold)
+            assert abs(ap - result["ap"][t]) < 1e-6, (image_id, threshold, ap, result["ap"][t])
+    print("evaluate_image: per-image AP identical to the compute_ap() loop")
+
+    # Perfect detections score 1
+    perfect = [(i, gt, {"rois": gt[0], "class_ids": gt[1], "masks": gt[2],
+                        "scores": np.linspace(1, 0.5, len(gt[0]))})
+               for i, gt, _ in samples[:20]]
+    report = evaluate(perfect, workers=0).summarize()
+    assert abs(report["mAP"] - 1) < 1e-9 and abs(report["image_mAP"] - 1) < 1e-9
+
+    # Benchmark: the original compute_ap_range() (matching repeated at each
+    # threshold) per image vs the engine
+    start = time.perf_counter()
+    reference = []
+    for image_id, (gt_boxes, gt_class_ids, gt_masks), r in samples:
+        if len(gt_boxes):
+            reference.append(np.mean([_compute_ap_loop(
+                gt_boxes, gt_class_ids, gt_masks, r["rois"], r["class_ids"],
+                r["scores"], r["masks"], threshold) for threshold in COCO_IOU_THRESHOLDS]))
+    t_ref = time.perf_counter() - start
+    for workers in sorted({0, multiprocessing.cpu_count()}):
+        evaluator = evaluate(samples, workers=workers)
+        report = evaluator.summarize()
+        assert abs(report["image_mAP"] - np.mean(reference)) < 1e-6
+        print("{} images, {} workers: {:.2f} s (compute_ap_range loop {:.2f} s)".format(
+            len(samples), workers, evaluator.timing["total_s"], t_ref))
+    json.dumps(report)
+    print_report(report)
@@ -0,0 +1,329 @@
+"""
+Mask R-CNN
+Caches of decoded dataset images.
+
+Dataset.load_image() decodes the image file on every call, and multi-epoch
+training and evaluation decode the same images over and over. A cache set
+with Dataset.set_image_cache() keeps decoded images for
+Dataset.load_cached_image(), which load_image_gt() uses:
+
+- ImageCache: in memory, least recently used images evicted beyond
+  max_bytes. Each process has its own (DataPipeline workers each fill a
+  copy).
+- DiskImageCache: decoded arrays saved as .npy files on local disk and
+  memory-mapped on load, so hits cost a page-cache read instead of a
+  decode. Processes using the same directory share the files and one
+  max_bytes bound.
+
+Cached images are read-only.
+
+Benchmark (decode vs memory vs disk cache over a few epochs):
+    python -m mrcnn.image_cache
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import os
+import time
+import hashlib
+import contextlib
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: evictions are only serialized within the process
+    fcntl = None
+
+
+############################################################
+#  Caches
+############################################################
+
+class ImageCache(object):
+    """In-memory LRU cache of decoded images, bounded by bytes.
+
+    max_bytes: Total size of the cached arrays. Images larger than that
+        aren't cached.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached image or None."""
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.stats["misses"] += 1
+                return None
+            self._images.move_to_end(key)
+            self.stats["hits"] += 1
+            return image
+
+    def put(self, key, image):
+        """Caches an image and returns the cached (read-only) array."""
+        if image.nbytes > self.max_bytes:
+            return image
+        image = np.ascontiguousarray(image)
+        image.flags.writeable = False
+        with self._lock:
+            if key in self._images:
+                self.bytes -= self._images.pop(key).nbytes
+            self._images[key] = image
+            self.bytes += image.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.stats["evictions"] += 1
+        return image
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.bytes = 0
+
+    def __getstate__(self):
+        # Pickled (e.g. to spawned workers) as an empty cache of the same size
+        return {"max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["max_bytes"])
+
+    def __len__(self):
+        return len(self._images)
+
+
+class DiskImageCache(object):
+    """Decoded images stored as memory-mapped .npy files, bounded by bytes.
+
+    cache_dir: Directory of the cache, preferably on a local disk. Files
+        left by earlier runs are reused.
+    max_bytes: Total size of the files in the directory. Beyond that the
+        least recently used files are deleted.
+
+    The bound and the LRU order are kept on disk, not in the process: every
+    hit sets the file's mtime, and put() evicts the oldest files of the
+    directory under a file lock. So processes sharing the directory (e.g.
+    DataPipeline workers) and later runs share one bound. stats counts the
+    hits, misses and evictions of this process only.
+    """
+
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._lock_path = os.path.join(cache_dir, "cache.lock")
+
+    def _name(self, key):
+        return "image_{}.npy".format(hashlib.sha1(str(key).encode("utf-8")).hexdigest())
+
+    def _entries(self):
+        """(mtime_ns, name, size) of the cached files, oldest first."""
+        entries = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.startswith("image_") and entry.name.endswith(".npy"):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # Evicted by another process meanwhile
+                    continue
+                entries.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        return sorted(entries)
+
+    @contextlib.contextmanager
+    def _directory_lock(self):
+        """Exclusive lock of the cache directory, across threads and processes."""
+        with self._lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._lock_path, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    @property
+    def bytes(self):
+        """Total size of the cached files."""
+        return sum(size for _, _, size in self._entries())
+
+    def get(self, key):
+        """Returns the cached image, memory-mapped read-only, or None."""
+        path = os.path.join(self.cache_dir, self._name(key))
+        try:
+            image = np.load(path, mmap_mode="r")
+            # Mark as recently used, for all processes
+            os.utime(path)
+        except (IOError, OSError, ValueError):
+            # Not cached, deleted by another process or partially written
+            with self._lock:
+                self.stats["misses"] += 1
+            return None
+        with self._lock:
+            self.stats["hits"] += 1
+        return np.asarray(image)
+
+    def put(self, key, image):
+        """Saves an image atomically, evicts the least recently used files
+        beyond max_bytes, and returns the image memory-mapped."""
+        if image.nbytes > self.max_bytes:
+            return image
+        name = self._name(key)
+        path = os.path.join(self.cache_dir, name)
+        fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, np.ascontiguousarray(image))
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        # Map it before eviction can delete it; the mapping stays valid
+        try:
+            cached = np.asarray(np.load(path, mmap_mode="r"))
+        except (IOError, OSError):
+            # Already evicted by another process (max_bytes of a few images)
+            return image
+        with self._directory_lock():
+            entries = self._entries()
+            total = sum(size for _, _, size in entries)
+            for _, evicted, size in entries:
+                if total <= self.max_bytes:
+                    break
+                if evicted == name:
+                    continue
+                try:
+                    os.remove(os.path.join(self.cache_dir, evicted))
+                except OSError:
+                    # Already evicted by another process
+                    pass
+                else:
+                    self.stats["evictions"] += 1
+                total -= size
+        return cached
+
+    def clear(self):
+        """Deletes all cached files."""
+        with self._directory_lock():
+            for _, name, _ in self._entries():
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries())
+
+
+def from_config(config):
+    """The image cache described by config.IMAGE_CACHE_BYTES and
+    IMAGE_CACHE_DIR, or None if caching is off."""
+    if not config.IMAGE_CACHE_BYTES:
+        return None
+    if config.IMAGE_CACHE_DIR:
+        return DiskImageCache(config.IMAGE_CACHE_DIR, config.IMAGE_CACHE_BYTES)
+    return ImageCache(config.IMAGE_CACHE_BYTES)
+
+
+def attach_image_cache(dataset, config):
+    """Gives the dataset the cache of the config, unless it has one."""
+    if getattr(dataset, "image_cache", None) is None:
+        cache = from_config(config)
+        if cache is not None:
+            dataset.set_image_cache(cache)
+
+
+############################################################
+#  Benchmark
+############################################################
+
+if __name__ == "__main__":
+    import shutil
+    import multiprocessing
+    import skimage.io
+    from mrcnn import utils
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        dataset = utils.Dataset()
+        for i in range(24):
+            small = rng.randint(0, 256, (48, 64, 3)).astype(np.uint8)
+            image = np.repeat(np.repeat(small, 16, axis=0), 16, axis=1)
+            image = np.clip(image + rng.normal(0, 6, image.shape), 0, 255).astype(np.uint8)
+            path = os.path.join(work_dir, "{}.jpg".format(i))
+            skimage.io.imsave(path, image)
+            dataset.add_image("bench", i, path, height=image.shape[0], width=image.shape[1])
+        dataset.prepare()
+        size = dataset.load_image(0).nbytes * dataset.num_images
+
+        def epoch():
+            start = time.perf_counter()
+            images = [dataset.load_cached_image(i) for i in dataset.image_ids]
+            # Read the pixels: memory-mapped images load lazily
+            [image.max() for image in images]
+            return (time.perf_counter() - start) * 1000, images
+
+        t_decode, reference = epoch()
+        print("{} images 768x1024: decode {:.0f} ms/epoch".format(dataset.num_images, t_decode))
+        for name, cache in [("memory", ImageCache(2 * size)),
+                            ("disk", DiskImageCache(os.path.join(work_dir, "cache"), 2 * size))]:
+            dataset.set_image_cache(cache)
+            t_first, _ = epoch()
+            t_cached, images = epoch()
+            assert all(np.array_equal(a, b) for a, b in zip(images, reference))
+            assert not images[0].flags.writeable
+            print("{:6} cache: first epoch {:.0f} ms, then {:.1f} ms/epoch ({:.0f}x), {}".format(
+                name, t_first, t_cached, t_decode / t_cached, cache.stats))
+
+        # Byte bound: half the dataset fits
+        for cache in [ImageCache(size // 2), DiskImageCache(os.path.join(work_dir, "half"), size // 2)]:
+            dataset.set_image_cache(cache)
+            epoch()
+            assert cache.bytes <= size // 2 and cache.stats["evictions"] > 0
+        print("byte bounds respected: {} of {} images kept".format(len(cache), dataset.num_images))
+
+        # One bound shared by forked processes filling the same directory
+        if "fork" in multiprocessing.get_all_start_methods():
+            shared = DiskImageCache(os.path.join(work_dir, "shared"), size // 3)
+            dataset.set_image_cache(shared)
+            workers = [multiprocessing.get_context("fork").Process(target=epoch)
+                       for _ in range(4)]
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            assert all(w.exitcode == 0 for w in workers)
+            assert shared.bytes <= size // 3, (shared.bytes, size // 3)
+            print("4 forked workers: {} files, {} of {} bytes".format(
+                len(shared), shared.bytes, size // 3))
+
+        # Columnar index
+        index = dataset.image_index
+        assert index.column("width").dtype.kind == "i" and index.source_of(3) == "bench"
+        assert np.array_equal(index.select(source="bench", height=768), dataset.image_ids)
+        print("image index: columns {}".format(sorted(index.columns)))
+    finally:
+        shutil.rmtree(work_dir)
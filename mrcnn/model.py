@@ -24,6 +24,9 @@ import keras.engine as KE
 import keras.models as KM
 
 from mrcnn import utils
+from mrcnn import image_cache
+from mrcnn.targets import match_anchors, build_rpn_targets, \
+    build_detection_targets, generate_random_rois
 
 # Requires TensorFlow 1.3+ and Keras 2.0.8+.
 from distutils.version import LooseVersion
@@ -1207,8 +1210,9 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
         of the image unless use_mini_mask is True, in which case they are
         defined in MINI_MASK_SHAPE.
     """
-    # Load image and mask
-    image = dataset.load_image(image_id)
+    # Load image and mask. The image comes from the dataset's image cache
+    # if it has one (see image_cache.py).
+    image = dataset.load_cached_image(image_id)
     mask, class_ids = dataset.load_mask(image_id)
     original_shape = image.shape
     image, window, scale, padding, crop = utils.resize_image(
@@ -1272,7 +1276,7 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     # Different datasets have different classes, so track the
     # classes supported in the dataset of this image.
     active_class_ids = np.zeros([dataset.num_classes], dtype=np.int32)
-    source_class_ids = dataset.source_class_ids[dataset.image_info[image_id]["source"]]
+    source_class_ids = dataset.source_class_ids[dataset.image_source(image_id)]
     active_class_ids[source_class_ids] = 1
 
     # Resize masks to smaller size to reduce memory usage
@@ -1286,347 +1290,6 @@ def load_image_gt(dataset, config, image_id, augment=False, augmentation=None,
     return image, image_meta, class_ids, bbox, mask
 
 
-def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
-    """Generate targets for training Stage 2 classifier and mask heads.
-    This is not used in normal training. It's useful for debugging or to train
-    the Mask RCNN heads without using the RPN head.
-
-    Inputs:
-    rpn_rois: [N, (y1, x1, y2, x2)] proposal boxes.
-    gt_class_ids: [instance count] Integer class IDs
-    gt_boxes: [instance count, (y1, x1, y2, x2)]
-    gt_masks: [height, width, instance count] Ground truth masks. Can be full
-              size or mini-masks.
-
-    Returns:
-    rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)]
-    class_ids: [TRAIN_ROIS_PER_IMAGE]. Integer class IDs.
-    bboxes: [TRAIN_ROIS_PER_IMAGE, NUM_CLASSES, (y, x, log(h), log(w))]. Class-specific
-            bbox refinements.
-    masks: [TRAIN_ROIS_PER_IMAGE, height, width, NUM_CLASSES). Class specific masks cropped
-           to bbox boundaries and resized to neural network output size.
-    """
-    assert rpn_rois.shape[0] > 0
-    assert gt_class_ids.dtype == np.int32, "Expected int but got {}".format(
-        gt_class_ids.dtype)
-    assert gt_boxes.dtype == np.int32, "Expected int but got {}".format(
-        gt_boxes.dtype)
-    assert gt_masks.dtype == np.bool_, "Expected bool but got {}".format(
-        gt_masks.dtype)
-
-    # It's common to add GT Boxes to ROIs but we don't do that here because
-    # according to XinLei Chen's paper, it doesn't help.
-
-    # Trim empty padding in gt_boxes and gt_masks parts
-    instance_ids = np.where(gt_class_ids > 0)[0]
-    assert instance_ids.shape[0] > 0, "Image must contain instances."
-    gt_class_ids = gt_class_ids[instance_ids]
-    gt_boxes = gt_boxes[instance_ids]
-    gt_masks = gt_masks[:, :, instance_ids]
-
-    # Compute areas of ROIs and ground truth boxes.
-    rpn_roi_area = (rpn_rois[:, 2] - rpn_rois[:, 0]) * \
-        (rpn_rois[:, 3] - rpn_rois[:, 1])
-    gt_box_area = (gt_boxes[:, 2] - gt_boxes[:, 0]) * \
-        (gt_boxes[:, 3] - gt_boxes[:, 1])
-
-    # Compute overlaps [rpn_rois, gt_boxes]
-    overlaps = np.zeros((rpn_rois.shape[0], gt_boxes.shape[0]))
-    for i in range(overlaps.shape[1]):
-        gt = gt_boxes[i]
-        overlaps[:, i] = utils.compute_iou(
-            gt, rpn_rois, gt_box_area[i], rpn_roi_area)
-
-    # Assign ROIs to GT boxes
-    rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
-    rpn_roi_iou_max = overlaps[np.arange(
-        overlaps.shape[0]), rpn_roi_iou_argmax]
-    # GT box assigned to each ROI
-    rpn_roi_gt_boxes = gt_boxes[rpn_roi_iou_argmax]
-    rpn_roi_gt_class_ids = gt_class_ids[rpn_roi_iou_argmax]
-
-    # Positive ROIs are those with >= 0.5 IoU with a GT box.
-    fg_ids = np.where(rpn_roi_iou_max > 0.5)[0]
-
-    # Negative ROIs are those with max IoU 0.1-0.5 (hard example mining)
-    # TODO: To hard example mine or not to hard example mine, that's the question
-    # bg_ids = np.where((rpn_roi_iou_max >= 0.1) & (rpn_roi_iou_max < 0.5))[0]
-    bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
-
-    # Subsample ROIs. Aim for 33% foreground.
-    # FG
-    fg_roi_count = int(config.TRAIN_ROIS_PER_IMAGE * config.ROI_POSITIVE_RATIO)
-    if fg_ids.shape[0] > fg_roi_count:
-        keep_fg_ids = np.random.choice(fg_ids, fg_roi_count, replace=False)
-    else:
-        keep_fg_ids = fg_ids
-    # BG
-    remaining = config.TRAIN_ROIS_PER_IMAGE - keep_fg_ids.shape[0]
-    if bg_ids.shape[0] > remaining:
-        keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
-    else:
-        keep_bg_ids = bg_ids
-    # Combine indices of ROIs to keep
-    keep = np.concatenate([keep_fg_ids, keep_bg_ids])
-    # Need more?
-    remaining = config.TRAIN_ROIS_PER_IMAGE - keep.shape[0]
-    if remaining > 0:
-        # Looks like we don't have enough samples to maintain the desired
-        # balance. Reduce requirements and fill in the rest. This is
-        # likely different from the Mask RCNN paper.
-
-        # There is a small chance we have neither fg nor bg samples.
-        if keep.shape[0] == 0:
-            # Pick bg regions with easier IoU threshold
-            bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
-            assert bg_ids.shape[0] >= remaining
-            keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
-            assert keep_bg_ids.shape[0] == remaining
-            keep = np.concatenate([keep, keep_bg_ids])
-        else:
-            # Fill the rest with repeated bg rois.
-            keep_extra_ids = np.random.choice(
-                keep_bg_ids, remaining, replace=True)
-            keep = np.concatenate([keep, keep_extra_ids])
-    assert keep.shape[0] == config.TRAIN_ROIS_PER_IMAGE, \
-        "keep doesn't match ROI batch size {}, {}".format(
-            keep.shape[0], config.TRAIN_ROIS_PER_IMAGE)
-
-    # Reset the gt boxes assigned to BG ROIs.
-    rpn_roi_gt_boxes[keep_bg_ids, :] = 0
-    rpn_roi_gt_class_ids[keep_bg_ids] = 0
-
-    # For each kept ROI, assign a class_id, and for FG ROIs also add bbox refinement.
-    rois = rpn_rois[keep]
-    roi_gt_boxes = rpn_roi_gt_boxes[keep]
-    roi_gt_class_ids = rpn_roi_gt_class_ids[keep]
-    roi_gt_assignment = rpn_roi_iou_argmax[keep]
-
-    # Class-aware bbox deltas. [y, x, log(h), log(w)]
-    bboxes = np.zeros((config.TRAIN_ROIS_PER_IMAGE,
-                       config.NUM_CLASSES, 4), dtype=np.float32)
-    pos_ids = np.where(roi_gt_class_ids > 0)[0]
-    bboxes[pos_ids, roi_gt_class_ids[pos_ids]] = utils.box_refinement(
-        rois[pos_ids], roi_gt_boxes[pos_ids, :4])
-    # Normalize bbox refinements
-    bboxes /= config.BBOX_STD_DEV
-
-    # Generate class-specific target masks
-    masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
-                     dtype=np.float32)
-    for i in pos_ids:
-        class_id = roi_gt_class_ids[i]
-        assert class_id > 0, "class id must be greater than 0"
-        gt_id = roi_gt_assignment[i]
-        class_mask = gt_masks[:, :, gt_id]
-
-        if config.USE_MINI_MASK:
-            # Create a mask placeholder, the size of the image
-            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
-            # GT box
-            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
-            gt_w = gt_x2 - gt_x1
-            gt_h = gt_y2 - gt_y1
-            # Resize mini mask to size of GT box
-            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
-                np.round(utils.resize(class_mask, (gt_h, gt_w))).astype(bool)
-            # Place the mini batch in the placeholder
-            class_mask = placeholder
-
-        # Pick part of the mask and resize it
-        y1, x1, y2, x2 = rois[i].astype(np.int32)
-        m = class_mask[y1:y2, x1:x2]
-        mask = utils.resize(m, config.MASK_SHAPE)
-        masks[i, :, :, class_id] = mask
-
-    return rois, roi_gt_class_ids, bboxes, masks
-
-
-def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config):
-    """Given the anchors and GT boxes, compute overlaps and identify positive
-    anchors and deltas to refine them to match their corresponding GT boxes.
-
-    anchors: [num_anchors, (y1, x1, y2, x2)]
-    gt_class_ids: [num_gt_boxes] Integer class IDs.
-    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
-
-    Returns:
-    rpn_match: [N] (int32) matches between anchors and GT boxes.
-               1 = positive anchor, -1 = negative anchor, 0 = neutral
-    rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
-    """
-    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
-    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
-    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
-    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
-
-    # Handle COCO crowds
-    # A crowd box in COCO is a bounding box around several instances. Exclude
-    # them from training. A crowd box is given a negative class ID.
-    crowd_ix = np.where(gt_class_ids < 0)[0]
-    if crowd_ix.shape[0] > 0:
-        # Filter out crowds from ground truth class IDs and boxes
-        non_crowd_ix = np.where(gt_class_ids > 0)[0]
-        crowd_boxes = gt_boxes[crowd_ix]
-        gt_class_ids = gt_class_ids[non_crowd_ix]
-        gt_boxes = gt_boxes[non_crowd_ix]
-        # Compute overlaps with crowd boxes [anchors, crowds]
-        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
-        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
-        no_crowd_bool = (crowd_iou_max < 0.001)
-    else:
-        # All anchors don't intersect a crowd
-        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
-
-    # Compute overlaps [num_anchors, num_gt_boxes]
-    overlaps = utils.compute_overlaps(anchors, gt_boxes)
-
-    # Match anchors to GT Boxes
-    # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
-    # If an anchor overlaps a GT box with IoU < 0.3 then it's negative.
-    # Neutral anchors are those that don't match the conditions above,
-    # and they don't influence the loss function.
-    # However, don't keep any GT box unmatched (rare, but happens). Instead,
-    # match it to the closest anchor (even if its max IoU is < 0.3).
-    #
-    # 1. Set negative anchors first. They get overwritten below if a GT box is
-    # matched to them. Skip boxes in crowd areas.
-    anchor_iou_argmax = np.argmax(overlaps, axis=1)
-    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
-    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
-    # 2. Set an anchor for each GT box (regardless of IoU value).
-    # If multiple anchors have the same IoU match all of them
-    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:,0]
-    rpn_match[gt_iou_argmax] = 1
-    # 3. Set anchors with high overlap as positive.
-    rpn_match[anchor_iou_max >= 0.7] = 1
-
-    # Subsample to balance positive and negative anchors
-    # Don't let positives be more than half the anchors
-    ids = np.where(rpn_match == 1)[0]
-    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
-    if extra > 0:
-        # Reset the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
-        rpn_match[ids] = 0
-    # Same for negative proposals
-    ids = np.where(rpn_match == -1)[0]
-    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
-                        np.sum(rpn_match == 1))
-    if extra > 0:
-        # Rest the extra ones to neutral
-        ids = np.random.choice(ids, extra, replace=False)
-        rpn_match[ids] = 0
-
-    # For positive anchors, compute shift and scale needed to transform them
-    # to match the corresponding GT boxes.
-    ids = np.where(rpn_match == 1)[0]
-    ix = 0  # index into rpn_bbox
-    # TODO: use box_refinement() rather than duplicating the code here
-    for i, a in zip(ids, anchors[ids]):
-        # Closest gt box (it might have IoU < 0.7)
-        gt = gt_boxes[anchor_iou_argmax[i]]
-
-        # Convert coordinates to center plus width/height.
-        # GT Box
-        gt_h = gt[2] - gt[0]
-        gt_w = gt[3] - gt[1]
-        gt_center_y = gt[0] + 0.5 * gt_h
-        gt_center_x = gt[1] + 0.5 * gt_w
-        # Anchor
-        a_h = a[2] - a[0]
-        a_w = a[3] - a[1]
-        a_center_y = a[0] + 0.5 * a_h
-        a_center_x = a[1] + 0.5 * a_w
-
-        # Compute the bbox refinement that the RPN should predict.
-        rpn_bbox[ix] = [
-            (gt_center_y - a_center_y) / a_h,
-            (gt_center_x - a_center_x) / a_w,
-            np.log(gt_h / a_h),
-            np.log(gt_w / a_w),
-        ]
-        # Normalize
-        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
-        ix += 1
-
-    return rpn_match, rpn_bbox
-
-
-def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
-    """Generates ROI proposals similar to what a region proposal network
-    would generate.
-
-    image_shape: [Height, Width, Depth]
-    count: Number of ROIs to generate
-    gt_class_ids: [N] Integer ground truth class IDs
-    gt_boxes: [N, (y1, x1, y2, x2)] Ground truth boxes in pixels.
-
-    Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
-    """
-    # placeholder
-    rois = np.zeros((count, 4), dtype=np.int32)
-
-    # Generate random ROIs around GT boxes (90% of count)
-    rois_per_box = int(0.9 * count / gt_boxes.shape[0])
-    for i in range(gt_boxes.shape[0]):
-        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i]
-        h = gt_y2 - gt_y1
-        w = gt_x2 - gt_x1
-        # random boundaries
-        r_y1 = max(gt_y1 - h, 0)
-        r_y2 = min(gt_y2 + h, image_shape[0])
-        r_x1 = max(gt_x1 - w, 0)
-        r_x2 = min(gt_x2 + w, image_shape[1])
-
-        # To avoid generating boxes with zero area, we generate double what
-        # we need and filter out the extra. If we get fewer valid boxes
-        # than we need, we loop and try again.
-        while True:
-            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
-            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
-            # Filter out zero area boxes
-            threshold = 1
-            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                        threshold][:rois_per_box]
-            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                        threshold][:rois_per_box]
-            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
-                break
-
-        # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-        # into x1, y1, x2, y2 order
-        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-        box_rois = np.hstack([y1, x1, y2, x2])
-        rois[rois_per_box * i:rois_per_box * (i + 1)] = box_rois
-
-    # Generate random ROIs anywhere in the image (10% of count)
-    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
-    # To avoid generating boxes with zero area, we generate double what
-    # we need and filter out the extra. If we get fewer valid boxes
-    # than we need, we loop and try again.
-    while True:
-        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
-        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
-        # Filter out zero area boxes
-        threshold = 1
-        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >=
-                    threshold][:remaining_count]
-        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >=
-                    threshold][:remaining_count]
-        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
-            break
-
-    # Sort on axis 1 to ensure x1 <= x2 and y1 <= y2 and then reshape
-    # into x1, y1, x2, y2 order
-    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
-    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
-    global_rois = np.hstack([y1, x1, y2, x2])
-    rois[-remaining_count:] = global_rois
-    return rois
-
-
 def data_generator(dataset, config, shuffle=True, augment=False, augmentation=None,
                    random_rois=0, batch_size=1, detection_targets=False,
                    no_augmentation_sources=None):
@@ -1670,20 +1333,23 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
         is True then the outputs list contains target class_ids, bbox deltas,
         and masks.
     """
-    b = 0  # batch item index
+    samples = []
     image_index = -1
     image_ids = np.copy(dataset.image_ids)
     error_count = 0
-    no_augmentation_sources = no_augmentation_sources or []
 
     # Anchors
     # [anchor_count, (y1, x1, y2, x2)]
     backbone_shapes = compute_backbone_shapes(config, config.IMAGE_SHAPE)
-    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES,
-                                             config.RPN_ANCHOR_RATIOS,
-                                             backbone_shapes,
-                                             config.BACKBONE_STRIDES,
-                                             config.RPN_ANCHOR_STRIDE)
+    anchors = utils.get_pyramid_anchors(config.RPN_ANCHOR_SCALES,
+                                        config.RPN_ANCHOR_RATIOS,
+                                        backbone_shapes,
+                                        config.BACKBONE_STRIDES,
+                                        config.RPN_ANCHOR_STRIDE,
+                                        cache_dir=config.ANCHOR_CACHE_DIR)
+    anchor_match_cache = {} if config.CACHE_ANCHOR_MATCHES else None
+    utils.set_resize_backend(config.RESIZE_BACKEND)
+    image_cache.attach_image_cache(dataset, config)
 
     # Keras requires a generator to run indefinitely.
     while True:
@@ -1695,113 +1361,23 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
 
             # Get GT bounding boxes and masks for image.
             image_id = image_ids[image_index]
-
-            # If the image source is not to be augmented pass None as augmentation
-            if dataset.image_info[image_id]['source'] in no_augmentation_sources:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                load_image_gt(dataset, config, image_id, augment=augment,
-                              augmentation=None,
-                              use_mini_mask=config.USE_MINI_MASK)
-            else:
-                image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
-                    load_image_gt(dataset, config, image_id, augment=augment,
-                                augmentation=augmentation,
-                                use_mini_mask=config.USE_MINI_MASK)
-
-            # Skip images that have no instances. This can happen in cases
-            # where we train on a subset of classes and the image doesn't
-            # have any of the classes we care about.
-            if not np.any(gt_class_ids > 0):
+            sample = load_training_sample(
+                dataset, config, image_id, anchors, augment=augment,
+                augmentation=augmentation, random_rois=random_rois,
+                detection_targets=detection_targets,
+                no_augmentation_sources=no_augmentation_sources,
+                anchor_match_cache=anchor_match_cache)
+            if sample is None:
                 continue
-
-            # RPN Targets
-            rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
-                                                    gt_class_ids, gt_boxes, config)
-
-            # Mask R-CNN Targets
-            if random_rois:
-                rpn_rois = generate_random_rois(
-                    image.shape, random_rois, gt_class_ids, gt_boxes)
-                if detection_targets:
-                    rois, mrcnn_class_ids, mrcnn_bbox, mrcnn_mask =\
-                        build_detection_targets(
-                            rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
-
-            # Init batch arrays
-            if b == 0:
-                batch_image_meta = np.zeros(
-                    (batch_size,) + image_meta.shape, dtype=image_meta.dtype)
-                batch_rpn_match = np.zeros(
-                    [batch_size, anchors.shape[0], 1], dtype=rpn_match.dtype)
-                batch_rpn_bbox = np.zeros(
-                    [batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4], dtype=rpn_bbox.dtype)
-                batch_images = np.zeros(
-                    (batch_size,) + image.shape, dtype=np.float32)
-                batch_gt_class_ids = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES), dtype=np.int32)
-                batch_gt_boxes = np.zeros(
-                    (batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32)
-                batch_gt_masks = np.zeros(
-                    (batch_size, gt_masks.shape[0], gt_masks.shape[1],
-                     config.MAX_GT_INSTANCES), dtype=gt_masks.dtype)
-                if random_rois:
-                    batch_rpn_rois = np.zeros(
-                        (batch_size, rpn_rois.shape[0], 4), dtype=rpn_rois.dtype)
-                    if detection_targets:
-                        batch_rois = np.zeros(
-                            (batch_size,) + rois.shape, dtype=rois.dtype)
-                        batch_mrcnn_class_ids = np.zeros(
-                            (batch_size,) + mrcnn_class_ids.shape, dtype=mrcnn_class_ids.dtype)
-                        batch_mrcnn_bbox = np.zeros(
-                            (batch_size,) + mrcnn_bbox.shape, dtype=mrcnn_bbox.dtype)
-                        batch_mrcnn_mask = np.zeros(
-                            (batch_size,) + mrcnn_mask.shape, dtype=mrcnn_mask.dtype)
-
-            # If more instances than fits in the array, sub-sample from them.
-            if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
-                ids = np.random.choice(
-                    np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
-                gt_class_ids = gt_class_ids[ids]
-                gt_boxes = gt_boxes[ids]
-                gt_masks = gt_masks[:, :, ids]
-
-            # Add to batch
-            batch_image_meta[b] = image_meta
-            batch_rpn_match[b] = rpn_match[:, np.newaxis]
-            batch_rpn_bbox[b] = rpn_bbox
-            batch_images[b] = mold_image(image.astype(np.float32), config)
-            batch_gt_class_ids[b, :gt_class_ids.shape[0]] = gt_class_ids
-            batch_gt_boxes[b, :gt_boxes.shape[0]] = gt_boxes
-            batch_gt_masks[b, :, :, :gt_masks.shape[-1]] = gt_masks
-            if random_rois:
-                batch_rpn_rois[b] = rpn_rois
-                if detection_targets:
-                    batch_rois[b] = rois
-                    batch_mrcnn_class_ids[b] = mrcnn_class_ids
-                    batch_mrcnn_bbox[b] = mrcnn_bbox
-                    batch_mrcnn_mask[b] = mrcnn_mask
-            b += 1
+            samples.append(sample)
 
             # Batch full?
-            if b >= batch_size:
-                inputs = [batch_images, batch_image_meta, batch_rpn_match, batch_rpn_bbox,
-                          batch_gt_class_ids, batch_gt_boxes, batch_gt_masks]
-                outputs = []
-
-                if random_rois:
-                    inputs.extend([batch_rpn_rois])
-                    if detection_targets:
-                        inputs.extend([batch_rois])
-                        # Keras requires that output and targets have the same number of dimensions
-                        batch_mrcnn_class_ids = np.expand_dims(
-                            batch_mrcnn_class_ids, -1)
-                        outputs.extend(
-                            [batch_mrcnn_class_ids, batch_mrcnn_bbox, batch_mrcnn_mask])
-
-                yield inputs, outputs
+            if len(samples) >= batch_size:
+                yield assemble_training_batch(samples, config, random_rois,
+                                              detection_targets)
 
                 # start a new batch
-                b = 0
+                samples = []
         except (GeneratorExit, KeyboardInterrupt):
             raise
         except:
@@ -1813,6 +1389,138 @@ def data_generator(dataset, config, shuffle=True, augment=False, augmentation=No
                 raise
 
 
+def load_training_sample(dataset, config, image_id, anchors, augment=False,
+                         augmentation=None, random_rois=0, detection_targets=False,
+                         no_augmentation_sources=None, anchor_match_cache=None):
+    """Loads one image and builds its training targets. Shared by
+    data_generator() and data_pipeline.DataPipeline.
+
+    anchors: [anchor_count, (y1, x1, y2, x2)] anchors of config.IMAGE_SHAPE
+    anchor_match_cache: Optional dict of image ID -> targets.match_anchors()
+        result. Used and filled for images that are not augmented.
+    Other arguments: see data_generator().
+
+    Returns a dict of the image's batch entries, or None if the image has
+    no instances of the classes being trained.
+    """
+    no_augmentation_sources = no_augmentation_sources or []
+    # If the image source is not to be augmented pass None as augmentation
+    if dataset.image_source(image_id) in no_augmentation_sources:
+        augmentation = None
+    image, image_meta, gt_class_ids, gt_boxes, gt_masks = \
+        load_image_gt(dataset, config, image_id, augment=augment,
+                      augmentation=augmentation,
+                      use_mini_mask=config.USE_MINI_MASK)
+
+    # Skip images that have no instances. This can happen in cases
+    # where we train on a subset of classes and the image doesn't
+    # have any of the classes we care about.
+    if not np.any(gt_class_ids > 0):
+        return None
+
+    # RPN Targets
+    # Without augmentation the boxes of an image are the same every epoch,
+    # and so is their match with the anchors.
+    anchor_match = None
+    if anchor_match_cache is not None and not augment and not augmentation \
+            and config.IMAGE_RESIZE_MODE != "crop":
+        anchor_match = anchor_match_cache.get(image_id)
+        if anchor_match is None:
+            anchor_match = match_anchors(anchors, gt_class_ids, gt_boxes)
+            anchor_match_cache[image_id] = anchor_match
+    rpn_match, rpn_bbox = build_rpn_targets(image.shape, anchors,
+                                            gt_class_ids, gt_boxes, config,
+                                            anchor_match=anchor_match)
+    sample = {"image": image, "image_meta": image_meta,
+              "rpn_match": rpn_match, "rpn_bbox": rpn_bbox}
+
+    # Mask R-CNN Targets
+    if random_rois:
+        rpn_rois = generate_random_rois(
+            image.shape, random_rois, gt_class_ids, gt_boxes)
+        sample["rpn_rois"] = rpn_rois
+        if detection_targets:
+            sample["rois"], sample["mrcnn_class_ids"], sample["mrcnn_bbox"], \
+                sample["mrcnn_mask"] = build_detection_targets(
+                    rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
+
+    # If more instances than fits in the array, sub-sample from them.
+    if gt_boxes.shape[0] > config.MAX_GT_INSTANCES:
+        ids = np.random.choice(
+            np.arange(gt_boxes.shape[0]), config.MAX_GT_INSTANCES, replace=False)
+        gt_class_ids = gt_class_ids[ids]
+        gt_boxes = gt_boxes[ids]
+        gt_masks = gt_masks[:, :, ids]
+    sample.update({"gt_class_ids": gt_class_ids, "gt_boxes": gt_boxes,
+                   "gt_masks": gt_masks})
+    return sample
+
+
+def assemble_training_batch(samples, config, random_rois=0, detection_targets=False,
+                            out=None):
+    """Stacks samples from load_training_sample() into the (inputs, outputs)
+    lists that data_generator() yields.
+
+    out: Optional (inputs, outputs) arrays to fill in place (e.g. shared
+        memory buffers) instead of allocating new ones. Must have the
+        shapes of a batch assembled from the same kind of samples.
+    """
+    batch_size = len(samples)
+    first = samples[0]
+    if out is None:
+        # Init batch arrays
+        inputs = [
+            np.zeros((batch_size,) + first["image"].shape, dtype=np.float32),
+            np.zeros((batch_size,) + first["image_meta"].shape,
+                     dtype=first["image_meta"].dtype),
+            np.zeros([batch_size, first["rpn_match"].shape[0], 1],
+                     dtype=first["rpn_match"].dtype),
+            np.zeros([batch_size, config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4],
+                     dtype=first["rpn_bbox"].dtype),
+            np.zeros((batch_size, config.MAX_GT_INSTANCES), dtype=np.int32),
+            np.zeros((batch_size, config.MAX_GT_INSTANCES, 4), dtype=np.int32),
+            np.zeros((batch_size, first["gt_masks"].shape[0], first["gt_masks"].shape[1],
+                      config.MAX_GT_INSTANCES), dtype=first["gt_masks"].dtype),
+        ]
+        outputs = []
+        if random_rois:
+            inputs.append(np.zeros((batch_size,) + first["rpn_rois"].shape,
+                                   dtype=first["rpn_rois"].dtype))
+            if detection_targets:
+                inputs.append(np.zeros((batch_size,) + first["rois"].shape,
+                                       dtype=first["rois"].dtype))
+                # Keras requires that output and targets have the same number of dimensions
+                outputs = [np.zeros((batch_size,) + first["mrcnn_class_ids"].shape + (1,),
+                                    dtype=first["mrcnn_class_ids"].dtype)]
+                outputs += [np.zeros((batch_size,) + first[k].shape, dtype=first[k].dtype)
+                            for k in ["mrcnn_bbox", "mrcnn_mask"]]
+    else:
+        inputs, outputs = out
+        # Zero the padded parts that are only partially overwritten below
+        for a in inputs[4:7]:
+            a[...] = 0
+
+    # Add to batch
+    for b, sample in enumerate(samples):
+        gt_class_ids, gt_boxes, gt_masks = \
+            sample["gt_class_ids"], sample["gt_boxes"], sample["gt_masks"]
+        inputs[0][b] = mold_image(sample["image"].astype(np.float32), config)
+        inputs[1][b] = sample["image_meta"]
+        inputs[2][b] = sample["rpn_match"][:, np.newaxis]
+        inputs[3][b] = sample["rpn_bbox"]
+        inputs[4][b, :gt_class_ids.shape[0]] = gt_class_ids
+        inputs[5][b, :gt_boxes.shape[0]] = gt_boxes
+        inputs[6][b, :, :, :gt_masks.shape[-1]] = gt_masks
+        if random_rois:
+            inputs[7][b] = sample["rpn_rois"]
+            if detection_targets:
+                inputs[8][b] = sample["rois"]
+                outputs[0][b] = sample["mrcnn_class_ids"][..., np.newaxis]
+                outputs[1][b] = sample["mrcnn_bbox"]
+                outputs[2][b] = sample["mrcnn_mask"]
+    return inputs, outputs
+
+
 ############################################################
 #  MaskRCNN Class
 ############################################################
@@ -1833,6 +1541,7 @@ class MaskRCNN():
         self.mode = mode
         self.config = config
         self.model_dir = model_dir
+        utils.set_resize_backend(config.RESIZE_BACKEND)
         self.set_log_dir()
         self.keras_model = self.build(mode=mode, config=config)
 
@@ -1926,10 +1635,8 @@ class MaskRCNN():
 
         # Anchors
         if mode == "training":
-            anchors = self.get_anchors(config.IMAGE_SHAPE)
-            # Duplicate across the batch dimension because Keras requires it
-            # TODO: can this be optimized to avoid duplicating the anchors?
-            anchors = np.broadcast_to(anchors, (config.BATCH_SIZE,) + anchors.shape)
+            # Duplicated across the batch dimension because Keras requires it
+            anchors = self.get_anchors(config.IMAGE_SHAPE, batch_size=config.BATCH_SIZE)
             # A hack to get around Keras's bad support for constants
             anchors = KL.Lambda(lambda x: tf.Variable(anchors), name="anchors")(input_image)
         else:
@@ -2324,12 +2031,32 @@ class MaskRCNN():
             layers = layer_regex[layers]
 
         # Data generators
-        train_generator = data_generator(train_dataset, self.config, shuffle=True,
-                                         augmentation=augmentation,
-                                         batch_size=self.config.BATCH_SIZE,
-                                         no_augmentation_sources=no_augmentation_sources)
-        val_generator = data_generator(val_dataset, self.config, shuffle=True,
-                                       batch_size=self.config.BATCH_SIZE)
+        pipelines = []
+        if self.config.DATA_PIPELINE_WORKERS > 0:
+            # Batches are built in worker processes into shared memory and
+            # consumed in this process (see data_pipeline.py)
+            from mrcnn.data_pipeline import DataPipeline
+            seed = self.config.DATA_PIPELINE_SEED
+            pipeline_args = dict(batch_size=self.config.BATCH_SIZE,
+                                 workers=self.config.DATA_PIPELINE_WORKERS,
+                                 prefetch=self.config.DATA_PIPELINE_PREFETCH,
+                                 instrument=self.config.DATA_PIPELINE_INSTRUMENT)
+            train_generator = DataPipeline(train_dataset, self.config, shuffle=True,
+                                           augmentation=augmentation,
+                                           no_augmentation_sources=no_augmentation_sources,
+                                           seed=seed, **pipeline_args)
+            pipelines.append(train_generator)
+            val_generator = DataPipeline(val_dataset, self.config, shuffle=True,
+                                         seed=seed + 1 if seed is not None else None,
+                                         **pipeline_args)
+            pipelines.append(val_generator)
+        else:
+            train_generator = data_generator(train_dataset, self.config, shuffle=True,
+                                             augmentation=augmentation,
+                                             batch_size=self.config.BATCH_SIZE,
+                                             no_augmentation_sources=no_augmentation_sources)
+            val_generator = data_generator(val_dataset, self.config, shuffle=True,
+                                           batch_size=self.config.BATCH_SIZE)
 
         # Create log_dir if it does not exist
         if not os.path.exists(self.log_dir):
@@ -2346,6 +2073,9 @@ class MaskRCNN():
         # Add custom callbacks to the list
         if custom_callbacks:
             callbacks += custom_callbacks
+        if pipelines and self.config.DATA_PIPELINE_INSTRUMENT:
+            from mrcnn.data_pipeline import PipelineMonitor
+            callbacks.append(PipelineMonitor(train_generator))
 
         # Train
         log("\nStarting at epoch {}. LR={}\n".format(self.epoch, learning_rate))
@@ -2360,19 +2090,27 @@ class MaskRCNN():
             workers = 0
         else:
             workers = multiprocessing.cpu_count()
+        if pipelines:
+            # The pipeline prefetches by itself. Its batches live in shared
+            # buffers that are reused, so Keras must consume them in order.
+            workers = 0
 
-        self.keras_model.fit_generator(
-            train_generator,
-            initial_epoch=self.epoch,
-            epochs=epochs,
-            steps_per_epoch=self.config.STEPS_PER_EPOCH,
-            callbacks=callbacks,
-            validation_data=val_generator,
-            validation_steps=self.config.VALIDATION_STEPS,
-            max_queue_size=100,
-            workers=workers,
-            use_multiprocessing=True,
-        )
+        try:
+            self.keras_model.fit_generator(
+                train_generator,
+                initial_epoch=self.epoch,
+                epochs=epochs,
+                steps_per_epoch=self.config.STEPS_PER_EPOCH,
+                callbacks=callbacks,
+                validation_data=val_generator,
+                validation_steps=self.config.VALIDATION_STEPS,
+                max_queue_size=100,
+                workers=workers,
+                use_multiprocessing=workers > 0,
+            )
+        finally:
+            for pipeline in pipelines:
+                pipeline.close()
         self.epoch = max(self.epoch, epochs)
 
     def mold_inputs(self, images):
@@ -2391,19 +2129,7 @@ class MaskRCNN():
         image_metas = []
         windows = []
         for image in images:
-            # Resize image
-            # TODO: move resizing to mold_image()
-            molded_image, window, scale, padding, crop = utils.resize_image(
-                image,
-                min_dim=self.config.IMAGE_MIN_DIM,
-                min_scale=self.config.IMAGE_MIN_SCALE,
-                max_dim=self.config.IMAGE_MAX_DIM,
-                mode=self.config.IMAGE_RESIZE_MODE)
-            molded_image = mold_image(molded_image, self.config)
-            # Build image_meta
-            image_meta = compose_image_meta(
-                0, image.shape, molded_image.shape, window, scale,
-                np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
+            molded_image, image_meta, window = self.mold_input(image)
             # Append
             molded_images.append(molded_image)
             windows.append(window)
@@ -2414,8 +2140,32 @@ class MaskRCNN():
         windows = np.stack(windows)
         return molded_images, image_metas, windows
 
+    def mold_input(self, image):
+        """Molds one image. See mold_inputs().
+
+        Returns:
+        molded_image: [h, w, 3]. Image resized and normalized.
+        image_meta: [length of meta data]. Details about the image.
+        window: (y1, x1, y2, x2). The portion of the image that has the
+            original image (padding excluded).
+        """
+        # Resize image
+        # TODO: move resizing to mold_image()
+        molded_image, window, scale, padding, crop = utils.resize_image(
+            image,
+            min_dim=self.config.IMAGE_MIN_DIM,
+            min_scale=self.config.IMAGE_MIN_SCALE,
+            max_dim=self.config.IMAGE_MAX_DIM,
+            mode=self.config.IMAGE_RESIZE_MODE)
+        molded_image = mold_image(molded_image, self.config)
+        # Build image_meta
+        image_meta = compose_image_meta(
+            0, image.shape, molded_image.shape, window, scale,
+            np.zeros([self.config.NUM_CLASSES], dtype=np.int32))
+        return molded_image, image_meta, window
+
     def unmold_detections(self, detections, mrcnn_mask, original_image_shape,
-                          image_shape, window):
+                          image_shape, window, mask_format="dense"):
         """Reformats the detections of one image from the format of the neural
         network output to a format suitable for use in the rest of the
         application.
@@ -2426,13 +2176,18 @@ class MaskRCNN():
         image_shape: [H, W, C] Shape of the image after resizing and padding
         window: [y1, x1, y2, x2] Pixel coordinates of box in the image where the real
                 image is excluding the padding.
+        mask_format: "dense" for a [height, width, num_instances] array,
+                "bbox" for utils.CompactMasks (one mask per box) or "rle"
+                for a list of run-length encodings (see utils.rle_encode).
+                The compact formats never allocate image-sized masks.
 
         Returns:
         boxes: [N, (y1, x1, y2, x2)] Bounding boxes in pixels
         class_ids: [N] Integer class IDs for each bounding box
         scores: [N] Float probability scores of the class_id
-        masks: [height, width, num_instances] Instance masks
+        masks: Instance masks in mask_format
         """
+        assert mask_format in ["dense", "bbox", "rle"]
         # How many detections do we have?
         # Detections array is padded with zeros. Find the first class_id == 0.
         zero_ix = np.where(detections[:, 4] == 0)[0]
@@ -2468,6 +2223,12 @@ class MaskRCNN():
             masks = np.delete(masks, exclude_ix, axis=0)
             N = class_ids.shape[0]
 
+        if mask_format != "dense":
+            # Resize masks to their box size only
+            local_masks = [utils.unmold_mask_local(masks[i], boxes[i]) for i in range(N)]
+            compact = utils.CompactMasks(boxes, local_masks, original_image_shape)
+            return boxes, class_ids, scores, compact.to_rle() if mask_format == "rle" else compact
+
         # Resize masks to original image size and set boundary threshold.
         full_masks = []
         for i in range(N):
@@ -2479,16 +2240,17 @@ class MaskRCNN():
 
         return boxes, class_ids, scores, full_masks
 
-    def detect(self, images, verbose=0):
+    def detect(self, images, verbose=0, mask_format="dense"):
         """Runs the detection pipeline.
 
         images: List of images, potentially of different sizes.
+        mask_format: "dense", "bbox" or "rle". See unmold_detections().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
         class_ids: [N] int class IDs
         scores: [N] float probability scores for the class IDs
-        masks: [H, W, N] instance binary masks
+        masks: [H, W, N] instance binary masks (or their compact form)
         """
         assert self.mode == "inference", "Create model in inference mode."
         assert len(
@@ -2509,41 +2271,25 @@ class MaskRCNN():
             assert g.shape == image_shape,\
                 "After resizing, all images must have the same size. Check IMAGE_RESIZE_MODE and image sizes."
 
-        # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
-
-        if verbose:
-            log("molded_images", molded_images)
-            log("image_metas", image_metas)
-            log("anchors", anchors)
         # Run object detection
-        detections, _, _, mrcnn_mask, _, _, _ =\
-            self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
+        detections, mrcnn_mask = self.predict_molded(molded_images, image_metas,
+                                                     verbose=verbose)
         # Process detections
         results = []
         for i, image in enumerate(images):
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       windows[i])
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
+            results.append(self.detection_result(detections[i], mrcnn_mask[i],
+                                                 image.shape, image_shape,
+                                                 windows[i], mask_format=mask_format))
         return results
 
-    def detect_molded(self, molded_images, image_metas, verbose=0):
+    def detect_molded(self, molded_images, image_metas, verbose=0, mask_format="dense"):
         """Runs the detection pipeline, but expect inputs that are
         molded already. Used mostly for debugging and inspecting
         the model.
 
         molded_images: List of images loaded using load_image_gt()
         image_metas: image meta data, also returned by load_image_gt()
+        mask_format: "dense", "bbox" or "rle". See unmold_detections().
 
         Returns a list of dicts, one dict per image. The dict contains:
         rois: [N, (y1, x1, y2, x2)] detection bounding boxes
@@ -2566,56 +2312,83 @@ class MaskRCNN():
         for g in molded_images[1:]:
             assert g.shape == image_shape, "Images must have the same size"
 
+        # Run object detection
+        detections, mrcnn_mask = self.predict_molded(molded_images, image_metas,
+                                                     verbose=verbose)
+        # Process detections
+        results = []
+        for i, image in enumerate(molded_images):
+            window = [0, 0, image.shape[0], image.shape[1]]
+            results.append(self.detection_result(detections[i], mrcnn_mask[i],
+                                                 image.shape, image_shape,
+                                                 window, mask_format=mask_format))
+        return results
+
+    def predict_molded(self, molded_images, image_metas, verbose=0):
+        """Runs the network on a full batch of molded images of the same
+        shape. Shared by detect(), detect_molded() and the dynamic batcher
+        (see batching.py).
+
+        molded_images: [BATCH_SIZE, h, w, 3]
+        image_metas: [BATCH_SIZE, length of meta data]
+
+        Returns:
+        detections: [BATCH_SIZE, DETECTION_MAX_INSTANCES, (y1, x1, y2, x2, class_id, score)]
+            in normalized coordinates
+        mrcnn_mask: [BATCH_SIZE, DETECTION_MAX_INSTANCES, height, width, num_classes]
+        """
+        assert len(molded_images) == self.config.BATCH_SIZE,\
+            "Number of images must be equal to BATCH_SIZE"
+        image_shape = molded_images[0].shape
+
         # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Duplicated across the batch dimension because Keras requires it. The
+        # batch array is cached, so repeated calls don't copy the anchors.
+        anchors = self.get_anchors(image_shape, batch_size=self.config.BATCH_SIZE)
 
         if verbose:
             log("molded_images", molded_images)
             log("image_metas", image_metas)
             log("anchors", anchors)
-        # Run object detection
         detections, _, _, mrcnn_mask, _, _, _ =\
             self.keras_model.predict([molded_images, image_metas, anchors], verbose=0)
-        # Process detections
-        results = []
-        for i, image in enumerate(molded_images):
-            window = [0, 0, image.shape[0], image.shape[1]]
-            final_rois, final_class_ids, final_scores, final_masks =\
-                self.unmold_detections(detections[i], mrcnn_mask[i],
-                                       image.shape, molded_images[i].shape,
-                                       window)
-            results.append({
-                "rois": final_rois,
-                "class_ids": final_class_ids,
-                "scores": final_scores,
-                "masks": final_masks,
-            })
-        return results
+        return detections, mrcnn_mask
+
+    def detection_result(self, detections, mrcnn_mask, original_image_shape,
+                         image_shape, window, mask_format="dense"):
+        """unmold_detections() of one image as a detect() result dict."""
+        final_rois, final_class_ids, final_scores, final_masks =\
+            self.unmold_detections(detections, mrcnn_mask, original_image_shape,
+                                   image_shape, window, mask_format=mask_format)
+        return {
+            "rois": final_rois,
+            "class_ids": final_class_ids,
+            "scores": final_scores,
+            "masks": final_masks,
+        }
+
+    def get_anchors(self, image_shape, batch_size=None):
+        """Returns anchor pyramid for the given image size, in normalized
+        coordinates. With batch_size, returns it repeated for each image of
+        a batch, [batch_size, anchors, 4].
 
-    def get_anchors(self, image_shape):
-        """Returns anchor pyramid for the given image size."""
+        Anchors come from the process-wide cache in utils.get_pyramid_anchors(),
+        shared with the data generators and other models, and are read-only.
+        """
         backbone_shapes = compute_backbone_shapes(self.config, image_shape)
-        # Cache anchors and reuse if image shape is the same
-        if not hasattr(self, "_anchor_cache"):
-            self._anchor_cache = {}
-        if not tuple(image_shape) in self._anchor_cache:
-            # Generate Anchors
-            a = utils.generate_pyramid_anchors(
-                self.config.RPN_ANCHOR_SCALES,
-                self.config.RPN_ANCHOR_RATIOS,
-                backbone_shapes,
-                self.config.BACKBONE_STRIDES,
-                self.config.RPN_ANCHOR_STRIDE)
-            # Keep a copy of the latest anchors in pixel coordinates because
-            # it's used in inspect_model notebooks.
-            # TODO: Remove this after the notebook are refactored to not use it
-            self.anchors = a
-            # Normalize coordinates
-            self._anchor_cache[tuple(image_shape)] = utils.norm_boxes(a, image_shape[:2])
-        return self._anchor_cache[tuple(image_shape)]
+        anchor_args = (self.config.RPN_ANCHOR_SCALES,
+                       self.config.RPN_ANCHOR_RATIOS,
+                       backbone_shapes,
+                       self.config.BACKBONE_STRIDES,
+                       self.config.RPN_ANCHOR_STRIDE)
+        # Keep a copy of the latest anchors in pixel coordinates because
+        # it's used in inspect_model notebooks.
+        # TODO: Remove this after the notebook are refactored to not use it
+        self.anchors = utils.get_pyramid_anchors(
+            *anchor_args, cache_dir=self.config.ANCHOR_CACHE_DIR)
+        return utils.get_pyramid_anchors(
+            *anchor_args, image_shape=image_shape, batch_size=batch_size,
+            cache_dir=self.config.ANCHOR_CACHE_DIR)
 
     def ancestor(self, tensor, name, checked=None):
         """Finds the ancestor of a TF tensor in the computation graph.
@@ -2699,10 +2472,9 @@ class MaskRCNN():
             molded_images = images
         image_shape = molded_images[0].shape
         # Anchors
-        anchors = self.get_anchors(image_shape)
-        # Duplicate across the batch dimension because Keras requires it
-        # TODO: can this be optimized to avoid duplicating the anchors?
-        anchors = np.broadcast_to(anchors, (self.config.BATCH_SIZE,) + anchors.shape)
+        # Duplicated across the batch dimension because Keras requires it. The
+        # batch array is cached, so repeated calls don't copy the anchors.
+        anchors = self.get_anchors(image_shape, batch_size=self.config.BATCH_SIZE)
         model_in = [molded_images, image_metas, anchors]
 
         # Run inference
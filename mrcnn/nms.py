@@ -0,0 +1,240 @@
+"""
+Mask R-CNN
+Non-maximum suppression in NumPy.
+
+Greedy NMS that returns exactly the indices of the original
+utils.non_max_suppression loop, plus class-aware NMS, soft-NMS and an
+output cap. Depends on NumPy only, so it can be benchmarked without
+TensorFlow: python -m mrcnn.nms
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+
+
+############################################################
+#  Greedy NMS
+############################################################
+
+def _iou_block(boxes, area, rows, cols):
+    """IoU matrix [len(rows), len(cols)] between boxes[rows] and boxes[cols].
+
+    Same arithmetic (and dtype) as utils.compute_iou, so thresholding gives
+    the same decisions as the per-box loop.
+    """
+    a = boxes[rows]
+    b = boxes[cols]
+    y1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    x1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+    union = area[rows][:, None] + area[cols][None, :] - intersection
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return intersection / union
+
+
+def non_max_suppression(boxes, scores, threshold, class_ids=None,
+                        max_output=None, block_size=32):
+    """Performs non-maximum suppression and returns indices of kept boxes.
+    boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
+    scores: 1-D array of box scores.
+    threshold: Float. IoU threshold to use for filtering.
+    class_ids: Optional [N] class IDs. Boxes of different classes never
+        suppress each other (per-class NMS in a single pass).
+    max_output: Optional cap on the number of kept boxes.
+    block_size: Number of candidate boxes resolved at once.
+
+    Candidates are taken in score order, block_size at a time. The greedy
+    decision inside a block walks a suppression bitmask built from the
+    block's own IoU matrix; the boxes it keeps then suppress all remaining
+    candidates with one [kept, remaining] IoU matrix, instead of one IoU
+    vector and two array copies per kept box. Returns the same indices, in
+    the same order, as the original per-box loop.
+    """
+    assert boxes.shape[0] > 0
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+
+    # Same visiting order as the original loop (including ties)
+    order = scores.argsort()[::-1]
+    boxes = boxes[order]
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    classes = np.asarray(class_ids)[order] if class_ids is not None else None
+    limit = boxes.shape[0] if max_output is None else max_output
+
+    def overlapping(rows, cols):
+        over = _iou_block(boxes, area, rows, cols) > threshold
+        if classes is not None:
+            # class-aware: boxes of different classes never overlap
+            over &= classes[rows][:, None] == classes[cols][None, :]
+        return over
+
+    alive = np.arange(boxes.shape[0])
+    pick = []
+    while len(alive) and len(pick) < limit:
+        block, alive = alive[:block_size], alive[block_size:]
+        # Greedy pass inside the block: only later boxes can be suppressed
+        over = overlapping(block, block)
+        block_suppressed = np.zeros(len(block), dtype=bool)
+        kept = []
+        for r in range(len(block)):
+            if block_suppressed[r]:
+                continue
+            kept.append(r)
+            if len(pick) + len(kept) >= limit:
+                break
+            block_suppressed[r + 1:] |= over[r, r + 1:]
+        pick.extend(block[kept])
+        # Kept boxes of this block suppress all remaining candidates at once
+        if len(alive) and len(pick) < limit:
+            alive = alive[~overlapping(block[kept], alive).any(axis=0)]
+    return order[np.array(pick, dtype=np.int64)].astype(np.int32)
+
+
+def _non_max_suppression_loop(boxes, scores, threshold):
+    """The original utils.non_max_suppression loop. Kept as the reference
+    implementation for the consistency check and benchmark below.
+    """
+    assert boxes.shape[0] > 0
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+
+    # Compute box areas
+    y1 = boxes[:, 0]
+    x1 = boxes[:, 1]
+    y2 = boxes[:, 2]
+    x2 = boxes[:, 3]
+    area = (y2 - y1) * (x2 - x1)
+
+    # Get indicies of boxes sorted by scores (highest first)
+    ixs = scores.argsort()[::-1]
+
+    pick = []
+    while len(ixs) > 0:
+        # Pick top box and add its index to the list
+        i = ixs[0]
+        pick.append(i)
+        # Compute IoU of the picked box with the rest
+        rest = ixs[1:]
+        iy1 = np.maximum(boxes[i, 0], boxes[rest, 0])
+        iy2 = np.minimum(boxes[i, 2], boxes[rest, 2])
+        ix1 = np.maximum(boxes[i, 1], boxes[rest, 1])
+        ix2 = np.minimum(boxes[i, 3], boxes[rest, 3])
+        intersection = np.maximum(ix2 - ix1, 0) * np.maximum(iy2 - iy1, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            iou = intersection / (area[i] + area[rest] - intersection)
+        # Identify boxes with IoU over the threshold. This
+        # returns indices into ixs[1:], so add 1 to get
+        # indices into ixs.
+        remove_ixs = np.where(iou > threshold)[0] + 1
+        # Remove indices of the picked and overlapped boxes.
+        ixs = np.delete(ixs, remove_ixs)
+        ixs = np.delete(ixs, 0)
+    return np.array(pick, dtype=np.int32)
+
+
+############################################################
+#  Soft-NMS
+############################################################
+
+def soft_non_max_suppression(boxes, scores, threshold=0.3, sigma=0.5,
+                             method="gaussian", score_threshold=0.001,
+                             class_ids=None, max_output=None):
+    """Soft-NMS (Bodla et al., 2017): overlapping boxes are down-weighted
+    instead of removed.
+
+    boxes: [N, (y1, x1, y2, x2)]
+    scores: [N] box scores.
+    threshold: IoU above which the linear method decays scores.
+    sigma: Spread of the gaussian decay exp(-iou^2 / sigma).
+    method: "gaussian" or "linear".
+    score_threshold: Boxes whose decayed score falls below this are dropped.
+    class_ids: Optional [N] class IDs; only boxes of the same class decay each other.
+    max_output: Optional cap on the number of kept boxes.
+
+    Returns:
+        indices: [K] int32 indices of kept boxes, in selection order.
+        scores: [K] their decayed scores.
+    """
+    assert method in ["gaussian", "linear"]
+    if boxes.dtype.kind != "f":
+        boxes = boxes.astype(np.float32)
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    current = np.asarray(scores, dtype=np.float64).copy()
+    alive = np.flatnonzero(current >= score_threshold)
+    limit = len(boxes) if max_output is None else max_output
+
+    pick, pick_scores = [], []
+    while len(alive) and len(pick) < limit:
+        best = np.argmax(current[alive])
+        i = alive[best]
+        pick.append(i)
+        pick_scores.append(current[i])
+        alive = np.delete(alive, best)
+        if not len(alive):
+            break
+        iou = _iou_block(boxes, area, np.array([i]), alive)[0]
+        iou = np.nan_to_num(iou)
+        if method == "linear":
+            decay = np.where(iou > threshold, 1 - iou, 1.0)
+        else:
+            decay = np.exp(-(iou * iou) / sigma)
+        if class_ids is not None:
+            decay = np.where(class_ids[alive] == class_ids[i], decay, 1.0)
+        current[alive] *= decay
+        alive = alive[current[alive] >= score_threshold]
+    return np.array(pick, dtype=np.int32), np.array(pick_scores, dtype=np.float32)
+
+
+############################################################
+#  Benchmark
+############################################################
+
+def random_boxes(count, image_size=1024, clusters=None, seed=0):
+    """Proposal-like boxes: jittered copies around a few object locations."""
+    rng = np.random.RandomState(seed)
+    clusters = clusters or max(1, count // 50)
+    centers = rng.uniform(0, image_size, (clusters, 2))
+    sizes = rng.uniform(20, 200, (clusters, 2))
+    k = rng.randint(0, clusters, count)
+    center = centers[k] + rng.normal(0, 0.15, (count, 2)) * sizes[k]
+    size = sizes[k] * rng.uniform(0.7, 1.3, (count, 2))
+    boxes = np.hstack([center - size / 2, center + size / 2]).astype(np.float32)
+    scores = rng.uniform(0, 1, count).astype(np.float32)
+    return np.clip(boxes, 0, image_size), scores
+
+
+def _best_time(fn, repeat=3):
+    """Best of `repeat` runs (ms) and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    for count in [1000, 10000]:
+        boxes, scores = random_boxes(count)
+        class_ids = np.random.RandomState(1).randint(1, 4, count)
+        for threshold in [0.3, 0.7]:
+            t_legacy, legacy = _best_time(lambda: _non_max_suppression_loop(boxes, scores, threshold))
+            t_fast, fast = _best_time(lambda: non_max_suppression(boxes, scores, threshold))
+            assert np.array_equal(legacy, fast), "NMS results differ"
+            print("{:6d} boxes, IoU {}: loop {:8.1f} ms, blocked {:7.1f} ms ({:.1f}x), {} kept".format(
+                count, threshold, t_legacy, t_fast, t_legacy / t_fast, len(fast)))
+        # Class-aware NMS equals running the loop on each class separately
+        per_class = non_max_suppression(boxes, scores, 0.5, class_ids=class_ids)
+        expected = np.concatenate([np.where(class_ids == c)[0][
+            _non_max_suppression_loop(boxes[class_ids == c], scores[class_ids == c], 0.5)]
+            for c in np.unique(class_ids)])
+        assert set(per_class) == set(expected), "class-aware NMS differs"
+        capped = non_max_suppression(boxes, scores, 0.5, max_output=100)
+        assert np.array_equal(capped, non_max_suppression(boxes, scores, 0.5)[:100])
+        t_soft, _ = _best_time(lambda: soft_non_max_suppression(boxes, scores, max_output=1000), 1)
+        print("{:6d} boxes: class-aware and capped NMS match, soft-NMS (1000 kept) {:.1f} ms".format(
+            count, t_soft))
@@ -25,6 +25,8 @@ class ParallelModel(KM.Model):
     the inputs and sends a slice to each copy of the model, and then
     merges the outputs together and applies the loss on the combined
     outputs.
+
+    For inference on CPU-only machines, see cpu_parallel.CPUParallelDetector.
     """
 
     def __init__(self, keras_model, gpu_count):
@@ -0,0 +1,252 @@
+"""
+Mask R-CNN
+Selectable resize backend for utils.resize() and utils.resize_mask().
+
+"skimage" is the reference implementation. "opencv" uses cv2.resize and
+keeps the semantics of the skimage calls made in this package:
+- bilinear interpolation at pixel centers, blending with cval=0 beyond the
+  image edge like skimage's mode="constant"
+- nearest neighbor for masks
+- the input dtype is kept when preserve_range=True (uint8 images stay
+  uint8 instead of being converted to float64 and back)
+Calls the OpenCV path can't reproduce (other modes, higher orders,
+anti-aliasing) fall back to skimage.
+
+Parity check and benchmark (molding a batch of 1024x1024 images):
+    python -m mrcnn.resize_backend
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+
+try:
+    import cv2
+except ImportError:  # OpenCV is optional: only the skimage backend is available
+    cv2 = None
+
+BACKENDS = ["skimage", "opencv"]
+
+# cv2.resize handles at most this many channels per call
+_CV_MAX_CHANNELS = 512
+
+_backend = "skimage"
+
+
+def set_resize_backend(backend):
+    """Selects the backend of utils.resize() and utils.resize_mask() for
+    this process: "skimage" or "opencv"."""
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError("Unknown resize backend: {} (expected one of {})".format(
+            backend, BACKENDS))
+    if backend == "opencv" and cv2 is None:
+        raise ImportError("The opencv resize backend requires opencv-python")
+    _backend = backend
+
+
+def get_resize_backend():
+    return _backend
+
+
+############################################################
+#  OpenCV Implementation
+############################################################
+
+def _cv_resize(image, size, interpolation):
+    """cv2.resize for [H, W] or [H, W, C] arrays of any channel count.
+    size: (height, width)."""
+    dsize = (int(size[1]), int(size[0]))
+    if image.ndim == 2:
+        return cv2.resize(image, dsize, interpolation=interpolation)
+    channels = image.shape[2]
+    out = np.empty(tuple(size[:2]) + (channels,), dtype=image.dtype)
+    for c in range(0, channels, _CV_MAX_CHANNELS):
+        part = np.ascontiguousarray(image[:, :, c:c + _CV_MAX_CHANNELS])
+        out[:, :, c:c + _CV_MAX_CHANNELS] = cv2.resize(
+            part, dsize, interpolation=interpolation).reshape(
+                tuple(size[:2]) + (part.shape[2],))
+    return out
+
+
+def _edge_weights(in_size, out_size):
+    """Weight of the image in output pixels that sample beyond its edge.
+
+    skimage (mode="constant", cval=0) interpolates those pixels with the
+    zero border, cv2 with the edge pixel: the skimage value is the cv2 value
+    times the weight. Only happens when upsampling. Returns (index, weight)
+    arrays of the affected output pixels.
+    """
+    coords = (np.arange(out_size) + 0.5) * (in_size / out_size) - 0.5
+    weights = np.where(coords < 0, 1 + coords,
+                       np.where(coords > in_size - 1, in_size - coords, 1.0))
+    index = np.where(weights < 1)[0]
+    return index, weights[index]
+
+
+def can_resize_opencv(image, output_shape, order=1, mode='constant', cval=0,
+                      anti_aliasing=False):
+    """Whether resize_opencv() reproduces this skimage resize() call."""
+    return (cv2 is not None and order in (0, 1) and mode == 'constant' and cval == 0
+            and not anti_aliasing and image.ndim in (2, 3)
+            and len(output_shape) in (2, image.ndim)
+            and all(s > 0 for s in image.shape[:2])
+            and image.dtype.kind in "biuf" and image.dtype.itemsize <= 8
+            and (image.dtype.kind != "i" or image.dtype.itemsize <= 2))
+
+
+def resize_opencv(image, output_shape, order=1, preserve_range=False):
+    """skimage.transform.resize(image, output_shape, order, mode="constant",
+    cval=0, clip=True, preserve_range, anti_aliasing=False) with cv2.
+
+    Returns the input dtype when preserve_range=True and the image isn't
+    bool; otherwise float like skimage (float32 stays float32, other types
+    become float64, integers are scaled to [0, 1] without preserve_range).
+    """
+    size = tuple(int(s) for s in output_shape[:2])
+    dtype = image.dtype
+    if dtype == bool:
+        image = image.astype(np.float32)
+    elif dtype.kind in "iu" and not preserve_range:
+        # skimage's img_as_float: scale integers to [0, 1]
+        image = image.astype(np.float64) / np.iinfo(dtype).max
+    elif dtype.kind == "f" and dtype != np.float32:
+        image = image.astype(np.float64)
+    elif dtype.kind in "iu" and (dtype == np.int8 or dtype.itemsize > 2):
+        # Integer types cv2.resize doesn't support
+        image = image.astype(np.float64)
+
+    if order == 0:
+        out = _cv_resize(image, size, cv2.INTER_NEAREST_EXACT)
+    else:
+        out = _cv_resize(image, size, cv2.INTER_LINEAR)
+        # Blend the pixels sampled beyond the edges with the zero border
+        rows, row_weights = _edge_weights(image.shape[0], size[0])
+        cols, col_weights = _edge_weights(image.shape[1], size[1])
+        if len(rows) or len(cols):
+            row_weights = row_weights.reshape((-1,) + (1,) * (out.ndim - 1))
+            col_weights = col_weights.reshape((1, -1) + (1,) * (out.ndim - 2))
+            if out.dtype.kind == "f":
+                out[rows] *= row_weights.astype(out.dtype)
+                out[:, cols] *= col_weights.astype(out.dtype)
+            else:
+                out[rows] = np.rint(out[rows] * row_weights)
+                out[:, cols] = np.rint(out[:, cols] * col_weights)
+    if out.ndim < len(output_shape):
+        out = out[..., np.newaxis]
+
+    if preserve_range and dtype != bool and out.dtype != dtype:
+        out = out.astype(dtype)
+    elif not preserve_range and out.dtype.kind not in "f":
+        out = out.astype(np.float64)
+    return out
+
+
+def zoom_mask_opencv(mask, scale):
+    """scipy.ndimage.zoom(mask, [scale, scale, 1], order=0) with cv2: same
+    output shape, nearest neighbor at pixel centers. bool and integer masks
+    keep their dtype. Sampling can differ from zoom()'s corner-aligned grid
+    by one source pixel along each axis."""
+    h, w = mask.shape[:2]
+    size = (int(round(h * scale)), int(round(w * scale)))
+    if mask.dtype == bool:
+        return _cv_resize(mask.view(np.uint8), size, cv2.INTER_NEAREST_EXACT).view(bool)
+    return _cv_resize(mask, size, cv2.INTER_NEAREST_EXACT)
+
+
+############################################################
+#  Parity Check and Benchmark
+############################################################
+
+def _skimage_resize(image, output_shape, order=1, preserve_range=False):
+    import skimage.transform
+    if image.dtype == bool:
+        image = image.astype(np.float64)
+    return skimage.transform.resize(image, output_shape, order=order, mode='constant',
+                                    cval=0, clip=True, preserve_range=preserve_range,
+                                    anti_aliasing=False)
+
+
+def _best_time(fn, repeat=3):
+    """Best of `repeat` runs (ms) and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    import warnings
+    import scipy.ndimage
+
+    rng = np.random.RandomState(0)
+
+    # Photos: smooth content plus noise, uint8, resized the way resize_image() does
+    def photo(h, w):
+        small = rng.randint(0, 256, (h // 16 + 2, w // 16 + 2, 3)).astype(np.float32)
+        image = cv2.resize(small, (w, h), interpolation=cv2.INTER_CUBIC)
+        return np.clip(image + rng.normal(0, 8, image.shape), 0, 255).astype(np.uint8)
+
+    for (h, w), (oh, ow) in [((1365, 2048), (683, 1024)), ((480, 640), (768, 1024)),
+                             ((37, 53), (101, 80))]:
+        image = photo(h, w)
+        reference = _skimage_resize(image, (oh, ow), preserve_range=True).astype(np.uint8)
+        fast = resize_opencv(image, (oh, ow), preserve_range=True)
+        diff = np.abs(fast.astype(int) - reference.astype(int))
+        assert fast.dtype == np.uint8 and fast.shape == reference.shape
+        # resize_image truncates skimage's float result; cv2 rounds
+        assert diff.max() <= 2 and diff.mean() < 1, (diff.max(), diff.mean())
+        print("image {}x{} -> {}x{}: max diff {} levels, mean {:.3f}".format(
+            h, w, oh, ow, diff.max(), diff.mean()))
+
+    # Soft masks (unmold_mask) and binary masks (minimize_mask / expand_mask)
+    for size in [(28, 28), (56, 56)]:
+        for out_shape in [(13, 9), (28, 28), (97, 211), (640, 480)]:
+            soft = cv2.resize(rng.rand(7, 7).astype(np.float32), size[::-1])
+            ref = _skimage_resize(soft, out_shape)
+            fast = resize_opencv(soft, out_shape)
+            diff = np.abs(fast - ref)
+            # scipy's zoom (behind skimage) samples a few rows of some
+            # non-integer scales a fraction of a pixel away
+            assert fast.dtype == np.float32 and diff.max() < 0.05
+            assert np.mean(diff > 1e-5) < 1e-2, np.mean(diff > 1e-5)
+            binary = soft > 0.5
+            ref = np.around(_skimage_resize(binary, out_shape))
+            fast = np.around(resize_opencv(binary, out_shape))
+            assert np.abs(fast - ref).mean() < 1e-3
+    print("masks: soft masks within 1e-5 on >99% of pixels, binary masks agree on >99.9% of pixels")
+
+    # Nearest neighbor masks (resize_mask)
+    mask = np.zeros((480, 640, 5), dtype=bool)
+    for i in range(5):
+        y, x = rng.randint(0, 400, 2)
+        mask[y:y + 80, x:x + 150, i] = True
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        reference = scipy.ndimage.zoom(mask, zoom=[1.6, 1.6, 1], order=0)
+    fast = zoom_mask_opencv(mask, 1.6)
+    assert fast.shape == reference.shape and fast.dtype == bool
+    # Boundaries move by at most one source pixel
+    assert np.abs(fast.sum(axis=(0, 1)).astype(int) - reference.sum(axis=(0, 1))).max() <= \
+        2 * 1.6 * (80 + 150) + 4
+    print("resize_mask: {:.2%} of pixels differ (edge positions)".format(
+        np.mean(fast != reference)))
+
+    # Benchmark: mold a batch of photos to 1024x1024 like mold_inputs()
+    batch = [photo(1365, 2048) for _ in range(4)]
+    t_sk, _ = _best_time(lambda: [_skimage_resize(im, (683, 1024), preserve_range=True)
+                                  .astype(np.uint8) for im in batch], 1)
+    t_cv, _ = _best_time(lambda: [resize_opencv(im, (683, 1024), preserve_range=True)
+                                  for im in batch])
+    print("molding {} images 1365x2048 -> 1024: skimage {:.0f} ms, opencv {:.0f} ms ({:.0f}x)".format(
+        len(batch), t_sk, t_cv, t_sk / t_cv))
+    masks = [rng.rand(28, 28).astype(np.float32) for _ in range(100)]
+    t_sk, _ = _best_time(lambda: [_skimage_resize(m, (150, 120)) for m in masks])
+    t_cv, _ = _best_time(lambda: [resize_opencv(m, (150, 120)) for m in masks])
+    print("unmolding 100 masks 28x28 -> 150x120: skimage {:.1f} ms, opencv {:.1f} ms".format(t_sk, t_cv))
+    t_sk, _ = _best_time(lambda: scipy.ndimage.zoom(mask, zoom=[1.6, 1.6, 1], order=0))
+    t_cv, _ = _best_time(lambda: zoom_mask_opencv(mask, 1.6))
+    print("resize_mask 480x640x5 x1.6: scipy {:.1f} ms, opencv {:.1f} ms".format(t_sk, t_cv))
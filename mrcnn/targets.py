@@ -0,0 +1,724 @@
+"""
+Mask R-CNN
+Training targets of the data generator, in NumPy.
+
+Vectorized versions of the RPN and detection target builders and of the
+random ROI generator. model.py imports them from here. The deterministic
+part of the RPN targets (anchor to GT matching) is split out in
+match_anchors() so that it can be cached per image when the image and its
+boxes don't change between epochs (no augmentation).
+
+Consistency check and per-image benchmark against the original loops:
+    python -m mrcnn.targets
+
+Licensed under the MIT License (see LICENSE for details)
+"""
+
+import time
+import numpy as np
+
+from mrcnn import utils
+
+
+############################################################
+#  RPN Targets
+############################################################
+
+# Anchors of the last match_anchors() call, grouped for the overlap search.
+# The data generators pass the same anchors array for every image.
+_anchor_groups = [None, None]
+
+
+def _group_anchors(anchors):
+    """Groups anchors by height, each group sorted by y1. Returns a list
+    of (height, anchor IDs, sorted y1) tuples, or None if anchors don't come
+    in a few sizes (then overlaps are computed densely)."""
+    if _anchor_groups[0] is anchors:
+        return _anchor_groups[1]
+    heights = anchors[:, 2] - anchors[:, 0]
+    values = np.unique(heights)
+    groups = None
+    if len(values) <= 64:
+        groups = []
+        for h in values:
+            ids = np.where(heights == h)[0]
+            ids = ids[np.argsort(anchors[ids, 0], kind="stable")]
+            groups.append((h, ids, anchors[ids, 0]))
+    _anchor_groups[:] = [anchors, groups]
+    return groups
+
+
+def _anchor_overlaps(anchors, boxes):
+    """Sparse utils.compute_overlaps(anchors, boxes). Yields, for each box,
+    the IDs of the anchors that intersect it and their IoU with the box.
+    The IoU of all other anchors is 0.
+    """
+    area1 = (anchors[:, 2] - anchors[:, 0]) * (anchors[:, 3] - anchors[:, 1])
+    area2 = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    groups = _group_anchors(anchors)
+    for i, box in enumerate(boxes):
+        if groups is None:
+            ids = np.arange(anchors.shape[0])
+        else:
+            # Anchors of height h intersect the box only if
+            # box_y1 - h < y1 < box_y2
+            ids = np.concatenate([
+                g_ids[np.searchsorted(y1, box[0] - h, "right"):
+                      np.searchsorted(y1, box[2], "left")]
+                for h, g_ids, y1 in groups])
+        yield i, ids, utils.compute_iou(box, anchors[ids], area2[i], area1[ids])
+
+
+def match_anchors(anchors, gt_class_ids, gt_boxes):
+    """Matches anchors to GT boxes. This is the deterministic part of
+    build_rpn_targets(): the result only depends on the anchors and the
+    boxes, so it can be cached and reused for images that are not augmented.
+
+    Gives the same match as computing the full [anchors, GT boxes] IoU
+    matrix, but only scores the anchors that can intersect each box.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [num_gt_boxes] Integer class IDs. Negative IDs are crowds.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+
+    Returns a compact description of the match (anchors not listed are
+    negative):
+    positive_ids: [P] int32 IDs of positive anchors
+    positive_gt_boxes: [P, (y1, x1, y2, x2)] GT box matched to each of them
+    neutral_ids: [Z] int32 IDs of neutral anchors
+    """
+    anchor_count = anchors.shape[0]
+    # Handle COCO crowds
+    # A crowd box in COCO is a bounding box around several instances. Exclude
+    # them from training. A crowd box is given a negative class ID.
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        # Filter out crowds from ground truth class IDs and boxes
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        # Max overlap of each anchor with the crowd boxes
+        crowd_iou_max = np.zeros([anchor_count])
+        for _, ids, iou in _anchor_overlaps(anchors, crowd_boxes):
+            crowd_iou_max[ids] = np.maximum(crowd_iou_max[ids], iou)
+        no_crowd_bool = (crowd_iou_max < 0.001)
+    else:
+        # All anchors don't intersect a crowd
+        no_crowd_bool = np.ones([anchor_count], dtype=bool)
+
+    # Match anchors to GT Boxes
+    # If an anchor overlaps a GT box with IoU >= 0.7 then it's positive.
+    # If an anchor overlaps a GT box with IoU < 0.3 then it's negative.
+    # Neutral anchors are those that don't match the conditions above,
+    # and they don't influence the loss function.
+    # However, don't keep any GT box unmatched (rare, but happens). Instead,
+    # match it to the closest anchor (even if its max IoU is < 0.3).
+    anchor_iou_max = np.zeros([anchor_count])
+    anchor_iou_argmax = np.zeros([anchor_count], dtype=np.int64)
+    gt_matches = []
+    for i, ids, iou in _anchor_overlaps(anchors, gt_boxes):
+        # Best GT box of each anchor (the first one on ties, like argmax)
+        better = iou > anchor_iou_max[ids]
+        anchor_iou_max[ids[better]] = iou[better]
+        anchor_iou_argmax[ids[better]] = i
+        # Best anchors of each GT box. If multiple anchors have the same IoU
+        # match all of them (with IoU 0, that's all anchors it misses).
+        gt_iou_max = iou.max() if len(iou) else 0
+        if gt_iou_max > 0:
+            gt_matches.append(ids[iou == gt_iou_max])
+        else:
+            missed = np.ones([anchor_count], dtype=bool)
+            missed[ids[iou > 0]] = False
+            gt_matches.append(np.where(missed)[0])
+
+    # 1. Set negative anchors first. They get overwritten below if a GT box is
+    # matched to them. Skip boxes in crowd areas.
+    rpn_match = np.zeros([anchor_count], dtype=np.int32)
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    # 2. Set an anchor for each GT box (regardless of IoU value).
+    for ids in gt_matches:
+        rpn_match[ids] = 1
+    # 3. Set anchors with high overlap as positive.
+    rpn_match[anchor_iou_max >= 0.7] = 1
+
+    positive_ids = np.where(rpn_match == 1)[0].astype(np.int32)
+    neutral_ids = np.where(rpn_match == 0)[0].astype(np.int32)
+    return positive_ids, gt_boxes[anchor_iou_argmax[positive_ids]], neutral_ids
+
+
+def build_rpn_targets(image_shape, anchors, gt_class_ids, gt_boxes, config,
+                      anchor_match=None):
+    """Given the anchors and GT boxes, compute overlaps and identify positive
+    anchors and deltas to refine them to match their corresponding GT boxes.
+
+    anchors: [num_anchors, (y1, x1, y2, x2)]
+    gt_class_ids: [num_gt_boxes] Integer class IDs.
+    gt_boxes: [num_gt_boxes, (y1, x1, y2, x2)]
+    anchor_match: Optional. The match_anchors() result for these anchors
+        and boxes (e.g. from a cache). Computed if not given.
+
+    Returns:
+    rpn_match: [N] (int32) matches between anchors and GT boxes.
+               1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_bbox: [N, (dy, dx, log(dh), log(dw))] Anchor bbox deltas.
+    """
+    if anchor_match is None:
+        anchor_match = match_anchors(anchors, gt_class_ids, gt_boxes)
+    positive_ids, positive_gt_boxes, neutral_ids = anchor_match
+
+    # RPN Match: 1 = positive anchor, -1 = negative anchor, 0 = neutral
+    rpn_match = np.full([anchors.shape[0]], -1, dtype=np.int32)
+    rpn_match[neutral_ids] = 0
+    rpn_match[positive_ids] = 1
+    # RPN bounding boxes: [max anchors per image, (dy, dx, log(dh), log(dw))]
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+
+    # Subsample to balance positive and negative anchors
+    # Don't let positives be more than half the anchors
+    ids = positive_ids
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        # Reset the extra ones to neutral
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    # Same for negative proposals
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        # Rest the extra ones to neutral
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+
+    # For positive anchors, compute shift and scale needed to transform them
+    # to match the corresponding GT boxes (closest GT box, it might have
+    # IoU < 0.7). Same arithmetic as the original per-anchor loop.
+    keep = rpn_match[positive_ids] == 1
+    a = anchors[positive_ids[keep]]
+    gt = positive_gt_boxes[keep]
+    # Convert coordinates to center plus width/height.
+    gt_h = gt[:, 2] - gt[:, 0]
+    gt_w = gt[:, 3] - gt[:, 1]
+    gt_center_y = gt[:, 0] + 0.5 * gt_h
+    gt_center_x = gt[:, 1] + 0.5 * gt_w
+    a_h = a[:, 2] - a[:, 0]
+    a_w = a[:, 3] - a[:, 1]
+    a_center_y = a[:, 0] + 0.5 * a_h
+    a_center_x = a[:, 1] + 0.5 * a_w
+    # Compute the bbox refinement that the RPN should predict and normalize
+    rpn_bbox[:len(a)] = np.stack([
+        (gt_center_y - a_center_y) / a_h,
+        (gt_center_x - a_center_x) / a_w,
+        np.log(gt_h / a_h),
+        np.log(gt_w / a_w),
+    ], axis=1)
+    rpn_bbox[:len(a)] /= config.RPN_BBOX_STD_DEV
+
+    return rpn_match, rpn_bbox
+
+
+############################################################
+#  Detection Targets
+############################################################
+
+def crop_and_resize_masks(masks, mask_ids, boxes, shape):
+    """Crops boxes out of masks and resizes the crops, all at once.
+
+    Same result (to float rounding) as utils.resize(masks[i][y1:y2, x1:x2],
+    shape) per box: bilinear sampling at the pixel centers, zero outside
+    the crop, clipped to [0, 1].
+
+    masks: [height, width, mask count] bool or float masks
+    mask_ids: [N] mask of each box
+    boxes: [N, (y1, x1, y2, x2)] integer crop boxes
+    shape: (height, width) of the output
+
+    Returns: [N, height, width] float64
+    """
+    n = len(boxes)
+    out = np.zeros((n,) + tuple(shape))
+    if not n:
+        return out
+    # Crops the way slicing cuts them
+    height, width = masks.shape[:2]
+    y1, y2 = [np.clip(boxes[:, i], 0, height) for i in (0, 2)]
+    x1, x2 = [np.clip(boxes[:, i], 0, width) for i in (1, 3)]
+    h, w = y2 - y1, x2 - x1
+
+    def sample_points(size, out_size):
+        # Input coordinates of output pixel centers, relative to the crop
+        coords = (np.arange(out_size) + 0.5)[None, :] * (size[:, None] / out_size) - 0.5
+        low = np.floor(coords).astype(np.int64)
+        return low, coords - low
+
+    y0, fy = sample_points(h, shape[0])
+    x0, fx = sample_points(w, shape[1])
+    ids = np.asarray(mask_ids)[:, None, None]
+
+    def gather(dy, dx):
+        # Crop pixels at (y0 + dy, x0 + dx), zero outside the crop
+        ry, rx = y0 + dy, x0 + dx
+        inside = ((ry >= 0) & (ry < h[:, None]))[:, :, None] & \
+            ((rx >= 0) & (rx < w[:, None]))[:, None, :]
+        yy = np.clip(y1[:, None] + ry, 0, height - 1)[:, :, None]
+        xx = np.clip(x1[:, None] + rx, 0, width - 1)[:, None, :]
+        return np.where(inside, masks[yy, xx, ids], 0)
+
+    fy = fy[:, :, None]
+    fx = fx[:, None, :]
+    out = (1 - fy) * ((1 - fx) * gather(0, 0) + fx * gather(0, 1)) + \
+        fy * ((1 - fx) * gather(1, 0) + fx * gather(1, 1))
+    out = np.clip(out, 0, 1)
+
+    # Crops one pixel thin (or empty) follow skimage's edge handling
+    for i in np.where((h < 2) | (w < 2))[0]:
+        crop = masks[y1[i]:y2[i], x1[i]:x2[i], mask_ids[i]]
+        out[i] = utils.resize(crop, shape) if crop.size else 0
+    return out
+
+
+def detection_masks(rois, roi_gt_class_ids, roi_gt_assignment, gt_boxes,
+                    gt_masks, config):
+    """Class-specific mask targets of the ROIs of build_detection_targets().
+
+    rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)]
+    roi_gt_class_ids: [TRAIN_ROIS_PER_IMAGE] Class IDs. 0 for background ROIs.
+    roi_gt_assignment: [TRAIN_ROIS_PER_IMAGE] GT box of each ROI
+    gt_boxes, gt_masks: GT boxes and (mini) masks
+
+    Returns: [TRAIN_ROIS_PER_IMAGE, height, width, NUM_CLASSES] float32
+    """
+    masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
+                     dtype=np.float32)
+    pos_ids = np.where(roi_gt_class_ids > 0)[0]
+    if pos_ids.shape[0] == 0:
+        return masks
+    # Image-sized mask of each GT box used by a positive ROI, made once
+    # per GT box rather than once per ROI
+    gt_ids, roi_mask_ids = np.unique(roi_gt_assignment[pos_ids], return_inverse=True)
+    if config.USE_MINI_MASK:
+        full_masks = np.zeros(tuple(config.IMAGE_SHAPE[:2]) + (len(gt_ids),), dtype=bool)
+        for j, gt_id in enumerate(gt_ids):
+            # Resize mini mask to size of GT box and place it in the image
+            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
+            full_masks[gt_y1:gt_y2, gt_x1:gt_x2, j] = np.round(utils.resize(
+                gt_masks[:, :, gt_id], (gt_y2 - gt_y1, gt_x2 - gt_x1))).astype(bool)
+    else:
+        full_masks, roi_mask_ids = gt_masks, gt_ids[roi_mask_ids]
+    # Pick part of each mask and resize it
+    masks[pos_ids, :, :, roi_gt_class_ids[pos_ids]] = crop_and_resize_masks(
+        full_masks, roi_mask_ids.ravel(), rois[pos_ids].astype(np.int32),
+        config.MASK_SHAPE)
+    return masks
+
+
+def build_detection_targets(rpn_rois, gt_class_ids, gt_boxes, gt_masks, config):
+    """Generate targets for training Stage 2 classifier and mask heads.
+    This is not used in normal training. It's useful for debugging or to train
+    the Mask RCNN heads without using the RPN head.
+
+    Inputs:
+    rpn_rois: [N, (y1, x1, y2, x2)] proposal boxes.
+    gt_class_ids: [instance count] Integer class IDs
+    gt_boxes: [instance count, (y1, x1, y2, x2)]
+    gt_masks: [height, width, instance count] Ground truth masks. Can be full
+              size or mini-masks.
+
+    Returns:
+    rois: [TRAIN_ROIS_PER_IMAGE, (y1, x1, y2, x2)]
+    class_ids: [TRAIN_ROIS_PER_IMAGE]. Integer class IDs.
+    bboxes: [TRAIN_ROIS_PER_IMAGE, NUM_CLASSES, (y, x, log(h), log(w))]. Class-specific
+            bbox refinements.
+    masks: [TRAIN_ROIS_PER_IMAGE, height, width, NUM_CLASSES). Class specific masks cropped
+           to bbox boundaries and resized to neural network output size.
+    """
+    assert rpn_rois.shape[0] > 0
+    assert gt_class_ids.dtype == np.int32, "Expected int but got {}".format(
+        gt_class_ids.dtype)
+    assert gt_boxes.dtype == np.int32, "Expected int but got {}".format(
+        gt_boxes.dtype)
+    assert gt_masks.dtype == np.bool_, "Expected bool but got {}".format(
+        gt_masks.dtype)
+
+    # It's common to add GT Boxes to ROIs but we don't do that here because
+    # according to XinLei Chen's paper, it doesn't help.
+
+    # Trim empty padding in gt_boxes and gt_masks parts
+    instance_ids = np.where(gt_class_ids > 0)[0]
+    assert instance_ids.shape[0] > 0, "Image must contain instances."
+    gt_class_ids = gt_class_ids[instance_ids]
+    gt_boxes = gt_boxes[instance_ids]
+    gt_masks = gt_masks[:, :, instance_ids]
+
+    # Compute overlaps [rpn_rois, gt_boxes]
+    overlaps = utils.compute_overlaps(rpn_rois, gt_boxes)
+
+    # Assign ROIs to GT boxes
+    rpn_roi_iou_argmax = np.argmax(overlaps, axis=1)
+    rpn_roi_iou_max = overlaps[np.arange(
+        overlaps.shape[0]), rpn_roi_iou_argmax]
+    # GT box assigned to each ROI
+    rpn_roi_gt_boxes = gt_boxes[rpn_roi_iou_argmax]
+    rpn_roi_gt_class_ids = gt_class_ids[rpn_roi_iou_argmax]
+
+    # Positive ROIs are those with >= 0.5 IoU with a GT box.
+    fg_ids = np.where(rpn_roi_iou_max > 0.5)[0]
+
+    # Negative ROIs are those with max IoU 0.1-0.5 (hard example mining)
+    # TODO: To hard example mine or not to hard example mine, that's the question
+    # bg_ids = np.where((rpn_roi_iou_max >= 0.1) & (rpn_roi_iou_max < 0.5))[0]
+    bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
+
+    # Subsample ROIs. Aim for 33% foreground.
+    # FG
+    fg_roi_count = int(config.TRAIN_ROIS_PER_IMAGE * config.ROI_POSITIVE_RATIO)
+    if fg_ids.shape[0] > fg_roi_count:
+        keep_fg_ids = np.random.choice(fg_ids, fg_roi_count, replace=False)
+    else:
+        keep_fg_ids = fg_ids
+    # BG
+    remaining = config.TRAIN_ROIS_PER_IMAGE - keep_fg_ids.shape[0]
+    if bg_ids.shape[0] > remaining:
+        keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+    else:
+        keep_bg_ids = bg_ids
+    # Combine indices of ROIs to keep
+    keep = np.concatenate([keep_fg_ids, keep_bg_ids])
+    # Need more?
+    remaining = config.TRAIN_ROIS_PER_IMAGE - keep.shape[0]
+    if remaining > 0:
+        # Looks like we don't have enough samples to maintain the desired
+        # balance. Reduce requirements and fill in the rest. This is
+        # likely different from the Mask RCNN paper.
+
+        # There is a small chance we have neither fg nor bg samples.
+        if keep.shape[0] == 0:
+            # Pick bg regions with easier IoU threshold
+            bg_ids = np.where(rpn_roi_iou_max < 0.5)[0]
+            assert bg_ids.shape[0] >= remaining
+            keep_bg_ids = np.random.choice(bg_ids, remaining, replace=False)
+            assert keep_bg_ids.shape[0] == remaining
+            keep = np.concatenate([keep, keep_bg_ids])
+        else:
+            # Fill the rest with repeated bg rois.
+            keep_extra_ids = np.random.choice(
+                keep_bg_ids, remaining, replace=True)
+            keep = np.concatenate([keep, keep_extra_ids])
+    assert keep.shape[0] == config.TRAIN_ROIS_PER_IMAGE, \
+        "keep doesn't match ROI batch size {}, {}".format(
+            keep.shape[0], config.TRAIN_ROIS_PER_IMAGE)
+
+    # Reset the gt boxes assigned to BG ROIs.
+    rpn_roi_gt_boxes[keep_bg_ids, :] = 0
+    rpn_roi_gt_class_ids[keep_bg_ids] = 0
+
+    # For each kept ROI, assign a class_id, and for FG ROIs also add bbox refinement.
+    rois = rpn_rois[keep]
+    roi_gt_boxes = rpn_roi_gt_boxes[keep]
+    roi_gt_class_ids = rpn_roi_gt_class_ids[keep]
+    roi_gt_assignment = rpn_roi_iou_argmax[keep]
+
+    # Class-aware bbox deltas. [y, x, log(h), log(w)]
+    bboxes = np.zeros((config.TRAIN_ROIS_PER_IMAGE,
+                       config.NUM_CLASSES, 4), dtype=np.float32)
+    pos_ids = np.where(roi_gt_class_ids > 0)[0]
+    bboxes[pos_ids, roi_gt_class_ids[pos_ids]] = utils.box_refinement(
+        rois[pos_ids], roi_gt_boxes[pos_ids, :4])
+    # Normalize bbox refinements
+    bboxes /= config.BBOX_STD_DEV
+
+    # Generate class-specific target masks
+    masks = detection_masks(rois, roi_gt_class_ids, roi_gt_assignment, gt_boxes,
+                            gt_masks, config)
+
+    return rois, roi_gt_class_ids, bboxes, masks
+
+
+############################################################
+#  Random ROIs
+############################################################
+
+def _random_spans(low, high, count):
+    """Draws `count` non-empty random spans (a, b), a < b, from each range
+    [low, high). Returns [len(low), count, 2] sorted int spans.
+
+    Like the original loop, draws twice as many as needed and keeps the
+    first valid ones; only ranges that came up short are drawn again.
+    """
+    spans = np.zeros((len(low), count, 2), dtype=np.int64)
+    todo = np.arange(len(low))
+    while len(todo):
+        draws = np.random.randint(low[todo, None, None], high[todo, None, None],
+                                  (len(todo), count * 2, 2))
+        # Filter out zero length spans and keep the first `count`
+        valid = draws[:, :, 0] != draws[:, :, 1]
+        done = valid.sum(axis=1) >= count
+        first = np.argsort(~valid[done], axis=1, kind="stable")[:, :count]
+        spans[todo[done]] = np.take_along_axis(draws[done], first[:, :, None], axis=1)
+        todo = todo[~done]
+    return np.sort(spans, axis=2)
+
+
+def generate_random_rois(image_shape, count, gt_class_ids, gt_boxes):
+    """Generates ROI proposals similar to what a region proposal network
+    would generate.
+
+    image_shape: [Height, Width, Depth]
+    count: Number of ROIs to generate
+    gt_class_ids: [N] Integer ground truth class IDs
+    gt_boxes: [N, (y1, x1, y2, x2)] Ground truth boxes in pixels.
+
+    Returns: [count, (y1, x1, y2, x2)] ROI boxes in pixels.
+    """
+    # placeholder
+    rois = np.zeros((count, 4), dtype=np.int32)
+
+    # Generate random ROIs around GT boxes (90% of count), all boxes at once.
+    # The random boundaries extend each box by its size on every side.
+    rois_per_box = int(0.9 * count / gt_boxes.shape[0])
+    if rois_per_box > 0:
+        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes.astype(np.int64).T
+        h = gt_y2 - gt_y1
+        w = gt_x2 - gt_x1
+        y = _random_spans(np.maximum(gt_y1 - h, 0),
+                          np.minimum(gt_y2 + h, image_shape[0]), rois_per_box)
+        x = _random_spans(np.maximum(gt_x1 - w, 0),
+                          np.minimum(gt_x2 + w, image_shape[1]), rois_per_box)
+        box_rois = np.stack([y[..., 0], x[..., 0], y[..., 1], x[..., 1]], axis=-1)
+        rois[:rois_per_box * gt_boxes.shape[0]] = box_rois.reshape(-1, 4)
+
+    # Generate random ROIs anywhere in the image (10% of count)
+    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
+    y = _random_spans(np.array([0]), np.array([image_shape[0]]), remaining_count)[0]
+    x = _random_spans(np.array([0]), np.array([image_shape[1]]), remaining_count)[0]
+    rois[-remaining_count:] = np.stack([y[:, 0], x[:, 0], y[:, 1], x[:, 1]], axis=1)
+    return rois
+
+
+############################################################
+#  Reference implementations
+############################################################
+
+# The original per-anchor / per-ROI loops, kept to check the vectorized
+# versions against (see __main__).
+
+def _build_rpn_targets_loop(image_shape, anchors, gt_class_ids, gt_boxes, config):
+    rpn_match = np.zeros([anchors.shape[0]], dtype=np.int32)
+    rpn_bbox = np.zeros((config.RPN_TRAIN_ANCHORS_PER_IMAGE, 4))
+    crowd_ix = np.where(gt_class_ids < 0)[0]
+    if crowd_ix.shape[0] > 0:
+        non_crowd_ix = np.where(gt_class_ids > 0)[0]
+        crowd_boxes = gt_boxes[crowd_ix]
+        gt_class_ids = gt_class_ids[non_crowd_ix]
+        gt_boxes = gt_boxes[non_crowd_ix]
+        crowd_overlaps = utils.compute_overlaps(anchors, crowd_boxes)
+        crowd_iou_max = np.amax(crowd_overlaps, axis=1)
+        no_crowd_bool = (crowd_iou_max < 0.001)
+    else:
+        no_crowd_bool = np.ones([anchors.shape[0]], dtype=bool)
+    overlaps = utils.compute_overlaps(anchors, gt_boxes)
+    anchor_iou_argmax = np.argmax(overlaps, axis=1)
+    anchor_iou_max = overlaps[np.arange(overlaps.shape[0]), anchor_iou_argmax]
+    rpn_match[(anchor_iou_max < 0.3) & (no_crowd_bool)] = -1
+    gt_iou_argmax = np.argwhere(overlaps == np.max(overlaps, axis=0))[:, 0]
+    rpn_match[gt_iou_argmax] = 1
+    rpn_match[anchor_iou_max >= 0.7] = 1
+    ids = np.where(rpn_match == 1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE // 2)
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == -1)[0]
+    extra = len(ids) - (config.RPN_TRAIN_ANCHORS_PER_IMAGE -
+                        np.sum(rpn_match == 1))
+    if extra > 0:
+        ids = np.random.choice(ids, extra, replace=False)
+        rpn_match[ids] = 0
+    ids = np.where(rpn_match == 1)[0]
+    ix = 0
+    for i, a in zip(ids, anchors[ids]):
+        gt = gt_boxes[anchor_iou_argmax[i]]
+        gt_h = gt[2] - gt[0]
+        gt_w = gt[3] - gt[1]
+        gt_center_y = gt[0] + 0.5 * gt_h
+        gt_center_x = gt[1] + 0.5 * gt_w
+        a_h = a[2] - a[0]
+        a_w = a[3] - a[1]
+        a_center_y = a[0] + 0.5 * a_h
+        a_center_x = a[1] + 0.5 * a_w
+        rpn_bbox[ix] = [
+            (gt_center_y - a_center_y) / a_h,
+            (gt_center_x - a_center_x) / a_w,
+            np.log(gt_h / a_h),
+            np.log(gt_w / a_w),
+        ]
+        rpn_bbox[ix] /= config.RPN_BBOX_STD_DEV
+        ix += 1
+    return rpn_match, rpn_bbox
+
+
+def _detection_masks_loop(rois, roi_gt_class_ids, roi_gt_assignment, gt_boxes,
+                          gt_masks, config):
+    """The mask part of the original build_detection_targets()."""
+    masks = np.zeros((config.TRAIN_ROIS_PER_IMAGE, config.MASK_SHAPE[0], config.MASK_SHAPE[1], config.NUM_CLASSES),
+                     dtype=np.float32)
+    for i in np.where(roi_gt_class_ids > 0)[0]:
+        class_id = roi_gt_class_ids[i]
+        gt_id = roi_gt_assignment[i]
+        class_mask = gt_masks[:, :, gt_id]
+        if config.USE_MINI_MASK:
+            placeholder = np.zeros(config.IMAGE_SHAPE[:2], dtype=bool)
+            gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[gt_id]
+            gt_w = gt_x2 - gt_x1
+            gt_h = gt_y2 - gt_y1
+            placeholder[gt_y1:gt_y2, gt_x1:gt_x2] = \
+                np.round(utils.resize(class_mask, (gt_h, gt_w))).astype(bool)
+            class_mask = placeholder
+        y1, x1, y2, x2 = rois[i].astype(np.int32)
+        m = class_mask[y1:y2, x1:x2]
+        mask = utils.resize(m, config.MASK_SHAPE)
+        masks[i, :, :, class_id] = mask
+    return masks
+
+
+def _generate_random_rois_loop(image_shape, count, gt_class_ids, gt_boxes):
+    rois = np.zeros((count, 4), dtype=np.int32)
+    rois_per_box = int(0.9 * count / gt_boxes.shape[0])
+    for i in range(gt_boxes.shape[0]):
+        gt_y1, gt_x1, gt_y2, gt_x2 = gt_boxes[i]
+        h = gt_y2 - gt_y1
+        w = gt_x2 - gt_x1
+        r_y1 = max(gt_y1 - h, 0)
+        r_y2 = min(gt_y2 + h, image_shape[0])
+        r_x1 = max(gt_x1 - w, 0)
+        r_x2 = min(gt_x2 + w, image_shape[1])
+        while True:
+            y1y2 = np.random.randint(r_y1, r_y2, (rois_per_box * 2, 2))
+            x1x2 = np.random.randint(r_x1, r_x2, (rois_per_box * 2, 2))
+            y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >= 1][:rois_per_box]
+            x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >= 1][:rois_per_box]
+            if y1y2.shape[0] == rois_per_box and x1x2.shape[0] == rois_per_box:
+                break
+        x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+        y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+        rois[rois_per_box * i:rois_per_box * (i + 1)] = np.hstack([y1, x1, y2, x2])
+    remaining_count = count - (rois_per_box * gt_boxes.shape[0])
+    while True:
+        y1y2 = np.random.randint(0, image_shape[0], (remaining_count * 2, 2))
+        x1x2 = np.random.randint(0, image_shape[1], (remaining_count * 2, 2))
+        y1y2 = y1y2[np.abs(y1y2[:, 0] - y1y2[:, 1]) >= 1][:remaining_count]
+        x1x2 = x1x2[np.abs(x1x2[:, 0] - x1x2[:, 1]) >= 1][:remaining_count]
+        if y1y2.shape[0] == remaining_count and x1x2.shape[0] == remaining_count:
+            break
+    x1, x2 = np.split(np.sort(x1x2, axis=1), 2, axis=1)
+    y1, y2 = np.split(np.sort(y1y2, axis=1), 2, axis=1)
+    rois[-remaining_count:] = np.hstack([y1, x1, y2, x2])
+    return rois
+
+
+############################################################
+#  Benchmark
+############################################################
+
+def random_instances(config, count, seed=0):
+    """Random GT boxes and masks for an image of config.IMAGE_SHAPE."""
+    rng = np.random.RandomState(seed)
+    height, width = config.IMAGE_SHAPE[:2]
+    size = rng.randint(16, min(height, width) // 3, (count, 2))
+    y1 = rng.randint(0, height - size[:, 0])
+    x1 = rng.randint(0, width - size[:, 1])
+    boxes = np.stack([y1, x1, y1 + size[:, 0], x1 + size[:, 1]], axis=1).astype(np.int32)
+    masks = np.zeros((height, width, count), dtype=bool)
+    for i, (a, b, c, d) in enumerate(boxes):
+        yy, xx = np.ogrid[a:c, b:d]
+        # an ellipse inside each box
+        masks[a:c, b:d, i] = ((yy - (a + c) / 2) / ((c - a) / 2)) ** 2 + \
+            ((xx - (b + d) / 2) / ((d - b) / 2)) ** 2 <= 1
+    class_ids = rng.randint(1, config.NUM_CLASSES, count).astype(np.int32)
+    return class_ids, boxes, masks
+
+
+def _best_time(fn, repeat=3):
+    """Best of `repeat` runs (ms) and the last result."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return min(times), result
+
+
+if __name__ == "__main__":
+    from mrcnn.config import Config
+
+    class BenchmarkConfig(Config):
+        NAME = "targets"
+        NUM_CLASSES = 5
+        TRAIN_ROIS_PER_IMAGE = 200
+
+    config = BenchmarkConfig()
+    shapes = np.array([[int(np.ceil(config.IMAGE_SHAPE[0] / s)),
+                        int(np.ceil(config.IMAGE_SHAPE[1] / s))]
+                       for s in config.BACKBONE_STRIDES])
+    anchors = utils.generate_pyramid_anchors(config.RPN_ANCHOR_SCALES, config.RPN_ANCHOR_RATIOS,
+                                             shapes, config.BACKBONE_STRIDES,
+                                             config.RPN_ANCHOR_STRIDE)
+    print("{} anchors, image {}".format(len(anchors), tuple(config.IMAGE_SHAPE)))
+
+    for count in [3, 30]:
+        class_ids, boxes, masks = random_instances(config, count, seed=count)
+        if count > 3:
+            class_ids[0] = -1  # a crowd box
+
+        # RPN targets: same anchors, same deltas, same random subsampling
+        def run(fn, **kwargs):
+            np.random.seed(1)
+            return fn(config.IMAGE_SHAPE, anchors, class_ids, boxes, config, **kwargs)
+        t_loop, (match_loop, bbox_loop) = _best_time(lambda: run(_build_rpn_targets_loop))
+        t_vec, (match_vec, bbox_vec) = _best_time(lambda: run(build_rpn_targets))
+        cached = match_anchors(anchors, class_ids, boxes)
+        t_cached, (match_cached, bbox_cached) = _best_time(
+            lambda: run(build_rpn_targets, anchor_match=cached))
+        assert np.array_equal(match_loop, match_vec) and np.array_equal(match_loop, match_cached)
+        assert np.allclose(bbox_loop, bbox_vec, rtol=0, atol=1e-12)
+        assert np.array_equal(bbox_vec, bbox_cached)
+        print("{:3d} GT boxes: build_rpn_targets loop {:6.1f} ms, vectorized {:6.1f} ms, "
+              "with cached anchor match {:5.1f} ms (max delta diff {:.1e})".format(
+                  count, t_loop, t_vec, t_cached, np.abs(bbox_loop - bbox_vec).max()))
+
+        # Random ROIs: a different random stream, same constraints
+        gt = boxes[class_ids > 0]
+        t_loop, _ = _best_time(lambda: _generate_random_rois_loop(config.IMAGE_SHAPE, 1000, None, gt))
+        t_vec, rois = _best_time(lambda: generate_random_rois(config.IMAGE_SHAPE, 1000, None, gt))
+        per_box = int(0.9 * 1000 / len(gt))
+        around = rois[:per_box * len(gt)].reshape(len(gt), per_box, 4)
+        h = (gt[:, 2] - gt[:, 0])[:, None]
+        w = (gt[:, 3] - gt[:, 1])[:, None]
+        assert (rois[:, 2] > rois[:, 0]).all() and (rois[:, 3] > rois[:, 1]).all()
+        assert (rois >= 0).all() and (rois[:, 2] < config.IMAGE_SHAPE[0]).all()
+        assert (around[..., 0] >= np.maximum(gt[:, 0:1] - h, 0)).all()
+        assert (around[..., 3] < np.minimum(gt[:, 3:4] + w, config.IMAGE_SHAPE[1])).all()
+        print("{:3d} GT boxes: generate_random_rois loop {:6.1f} ms, vectorized {:6.1f} ms".format(
+            len(gt), t_loop, t_vec))
+
+        # Detection targets: same ROI sampling, same deltas, masks to rounding
+        for mini_mask in [False, True]:
+            config.USE_MINI_MASK = mini_mask
+            gt_class_ids, gt_boxes, gt_masks = class_ids[class_ids > 0], gt, masks[..., class_ids > 0]
+            if mini_mask:
+                gt_masks = utils.minimize_mask(gt_boxes, gt_masks, config.MINI_MASK_SHAPE)
+            rpn_rois = generate_random_rois(config.IMAGE_SHAPE, 500, gt_class_ids, gt_boxes)
+
+            np.random.seed(2)
+            rois, roi_class_ids, bboxes, mrcnn_masks = build_detection_targets(
+                rpn_rois, gt_class_ids, gt_boxes, gt_masks, config)
+            assignment = np.argmax(utils.compute_overlaps(rois, gt_boxes), axis=1)
+            args = (rois, roi_class_ids, assignment, gt_boxes, gt_masks, config)
+            t_loop, loop_masks = _best_time(lambda: _detection_masks_loop(*args))
+            t_vec, vec_masks = _best_time(lambda: detection_masks(*args))
+            assert np.allclose(mrcnn_masks, loop_masks, rtol=0, atol=1e-6)
+            assert np.array_equal(mrcnn_masks, vec_masks)
+            print("{:3d} GT boxes, {}: detection mask targets loop {:6.1f} ms, "
+                  "vectorized {:6.1f} ms ({} positive ROIs)".format(
+                      len(gt), "mini masks" if mini_mask else "full masks", t_loop, t_vec,
+                      int((roi_class_ids > 0).sum())))
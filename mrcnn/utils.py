@@ -12,6 +12,8 @@ import os
 import logging
 import math
 import random
+import hashlib
+import tempfile
 import numpy as np
 import tensorflow as tf
 import scipy
@@ -23,6 +25,10 @@ import shutil
 import warnings
 from distutils.version import LooseVersion
 
+from mrcnn import nms
+from mrcnn import resize_backend
+from mrcnn.resize_backend import set_resize_backend, get_resize_backend
+
 # URL from which to download the latest COCO trained weights
 COCO_MODEL_URL = "https://github.com/matterport/Mask_RCNN/releases/download/v2.0/mask_rcnn_coco.h5"
 
@@ -89,22 +95,36 @@ def compute_overlaps(boxes1, boxes2):
     area2 = (boxes2[:, 2] - boxes2[:, 0]) * (boxes2[:, 3] - boxes2[:, 1])
 
     # Compute overlaps to generate matrix [boxes1 count, boxes2 count]
-    # Each cell contains the IoU value.
+    # Each cell contains the IoU value. Broadcast over chunks of boxes2 to
+    # bound the temporary arrays to about 2**18 cells each (~12 MB in all).
     overlaps = np.zeros((boxes1.shape[0], boxes2.shape[0]))
-    for i in range(overlaps.shape[1]):
-        box2 = boxes2[i]
-        overlaps[:, i] = compute_iou(box2, boxes1, area2[i], area1)
+    chunk = max(1, 2 ** 18 // max(boxes1.shape[0], 1))
+    for i in range(0, boxes2.shape[0], chunk):
+        b2 = boxes2[i:i + chunk]
+        y1 = np.maximum(boxes1[:, None, 0], b2[None, :, 0])
+        y2 = np.minimum(boxes1[:, None, 2], b2[None, :, 2])
+        x1 = np.maximum(boxes1[:, None, 1], b2[None, :, 1])
+        x2 = np.minimum(boxes1[:, None, 3], b2[None, :, 3])
+        intersection = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        union = area1[:, None] + area2[None, i:i + chunk] - intersection
+        overlaps[:, i:i + chunk] = intersection / union
     return overlaps
 
 
 def compute_overlaps_masks(masks1, masks2):
     """Computes IoU overlaps between two sets of masks.
-    masks1, masks2: [Height, Width, instances]
+    masks1, masks2: [Height, Width, instances], CompactMasks or lists of
+        RLE dicts. Compact inputs are compared inside their boxes only.
     """
     
     # If either set of masks is empty return empty result
-    if masks1.shape[-1] == 0 or masks2.shape[-1] == 0:
-        return np.zeros((masks1.shape[-1], masks2.shape[-1]))
+    count1 = len(masks1) if isinstance(masks1, list) else masks1.shape[-1]
+    count2 = len(masks2) if isinstance(masks2, list) else masks2.shape[-1]
+    if count1 == 0 or count2 == 0:
+        return np.zeros((count1, count2))
+    if not isinstance(masks1, np.ndarray) or not isinstance(masks2, np.ndarray):
+        return compute_overlaps_compact_masks(as_compact_masks(masks1),
+                                              as_compact_masks(masks2))
     # flatten masks and compute their areas
     masks1 = np.reshape(masks1 > .5, (-1, masks1.shape[-1])).astype(np.float32)
     masks2 = np.reshape(masks2 > .5, (-1, masks2.shape[-1])).astype(np.float32)
@@ -119,41 +139,19 @@ def compute_overlaps_masks(masks1, masks2):
     return overlaps
 
 
-def non_max_suppression(boxes, scores, threshold):
+def non_max_suppression(boxes, scores, threshold, class_ids=None, max_output=None):
     """Performs non-maximum suppression and returns indices of kept boxes.
     boxes: [N, (y1, x1, y2, x2)]. Notice that (y2, x2) lays outside the box.
     scores: 1-D array of box scores.
     threshold: Float. IoU threshold to use for filtering.
+    class_ids: Optional [N] class IDs for per-class NMS in one pass.
+    max_output: Optional cap on the number of kept boxes.
+
+    Blocked implementation in mrcnn/nms.py; returns the same indices as the
+    original per-box loop. See nms.soft_non_max_suppression for soft-NMS.
     """
-    assert boxes.shape[0] > 0
-    if boxes.dtype.kind != "f":
-        boxes = boxes.astype(np.float32)
-
-    # Compute box areas
-    y1 = boxes[:, 0]
-    x1 = boxes[:, 1]
-    y2 = boxes[:, 2]
-    x2 = boxes[:, 3]
-    area = (y2 - y1) * (x2 - x1)
-
-    # Get indicies of boxes sorted by scores (highest first)
-    ixs = scores.argsort()[::-1]
-
-    pick = []
-    while len(ixs) > 0:
-        # Pick top box and add its index to the list
-        i = ixs[0]
-        pick.append(i)
-        # Compute IoU of the picked box with the rest
-        iou = compute_iou(boxes[i], boxes[ixs[1:]], area[i], area[ixs[1:]])
-        # Identify boxes with IoU over the threshold. This
-        # returns indices into ixs[1:], so add 1 to get
-        # indices into ixs.
-        remove_ixs = np.where(iou > threshold)[0] + 1
-        # Remove indices of the picked and overlapped boxes.
-        ixs = np.delete(ixs, remove_ixs)
-        ixs = np.delete(ixs, 0)
-    return np.array(pick, dtype=np.int32)
+    return nms.non_max_suppression(boxes, scores, threshold,
+                                   class_ids=class_ids, max_output=max_output)
 
 
 def apply_box_deltas(boxes, deltas):
@@ -236,6 +234,60 @@ def box_refinement(box, gt_box):
 #  Dataset
 ############################################################
 
+class ImageIndex(object):
+    """Columnar view of Dataset.image_info, built by Dataset.prepare().
+
+    Looking up or filtering images by a field scans one array instead of
+    a list of dicts.
+
+    sources: Sorted list of image source names.
+    source: [num_images] int32 index into sources of each image.
+    columns: Dict of field name -> [num_images] array, for all other
+        fields of the info dicts. Fields that are numbers in every image
+        get numeric arrays, others object arrays (None where missing).
+    """
+
+    def __init__(self, image_info):
+        self.sources = sorted(set(info["source"] for info in image_info))
+        codes = {source: i for i, source in enumerate(self.sources)}
+        self.source = np.array([codes[info["source"]] for info in image_info], dtype=np.int32)
+        names = []
+        for info in image_info:
+            names += [name for name in info if name != "source" and name not in names]
+        self.columns = {}
+        for name in names:
+            values = [info.get(name) for info in image_info]
+            if all(isinstance(v, (int, float, np.number)) and not isinstance(v, bool)
+                   for v in values):
+                self.columns[name] = np.array(values)
+            else:
+                column = np.empty(len(values), dtype=object)
+                for i, value in enumerate(values):
+                    column[i] = value
+                self.columns[name] = column
+
+    def __len__(self):
+        return len(self.source)
+
+    def column(self, name):
+        return self.columns[name]
+
+    def source_of(self, image_id):
+        return self.sources[self.source[image_id]]
+
+    def select(self, source=None, **fields):
+        """IDs of the images of the given source (name or list of names)
+        whose fields equal the given values."""
+        keep = np.ones(len(self), dtype=bool)
+        if source is not None:
+            names = [source] if isinstance(source, str) else source
+            codes = [self.sources.index(s) for s in names if s in self.sources]
+            keep &= np.isin(self.source, codes)
+        for name, value in fields.items():
+            keep &= self.columns[name] == value
+        return np.where(keep)[0]
+
+
 class Dataset(object):
     """The base class for dataset classes.
     To use it, create a new class that adds functions specific to the dataset
@@ -258,6 +310,8 @@ class Dataset(object):
         # Background is always the first class
         self.class_info = [{"source": "", "id": 0, "name": "BG"}]
         self.source_class_ids = {}
+        self.image_index = None
+        self.image_cache = None
 
     def add_class(self, source, class_id, class_name):
         assert "." not in source, "Source name cannot contain a dot"
@@ -314,6 +368,7 @@ class Dataset(object):
                                       for info, id in zip(self.class_info, self.class_ids)}
         self.image_from_source_map = {"{}.{}".format(info['source'], info['id']): id
                                       for info, id in zip(self.image_info, self.image_ids)}
+        self.image_index = ImageIndex(self.image_info)
 
         # Map sources to class_ids they support
         self.sources = list(set([i['source'] for i in self.class_info]))
@@ -365,6 +420,37 @@ class Dataset(object):
             image = image[..., :3]
         return image
 
+    def image_source(self, image_id):
+        """Source name of an image."""
+        if getattr(self, "image_index", None) is not None and \
+                len(self.image_index) == len(self.image_info):
+            return self.image_index.source_of(image_id)
+        return self.image_info[image_id]["source"]
+
+    def set_image_cache(self, cache):
+        """Caches the images returned by load_cached_image().
+        cache: image_cache.ImageCache, image_cache.DiskImageCache or None.
+        """
+        self.image_cache = cache
+
+    def image_cache_key(self, image_id):
+        """Identifies the decoded image in the cache. Override if
+        load_image() depends on more than the image's source, ID and path."""
+        info = self.image_info[image_id]
+        return "{}.{}:{}".format(info["source"], info["id"], info.get("path"))
+
+    def load_cached_image(self, image_id):
+        """load_image() through the image cache, if one is set. Cached
+        images are read-only."""
+        cache = getattr(self, "image_cache", None)
+        if cache is None:
+            return self.load_image(image_id)
+        key = self.image_cache_key(image_id)
+        image = cache.get(key)
+        if image is None:
+            image = cache.put(key, self.load_image(image_id))
+        return image
+
     def load_mask(self, image_id):
         """Load instance masks for the given image.
 
@@ -501,11 +587,14 @@ def resize_mask(mask, scale, padding, crop=None):
     padding: Padding to add to the mask in the form
             [(top, bottom), (left, right), (0, 0)]
     """
-    # Suppress warning from scipy 0.13.0, the output shape of zoom() is
-    # calculated with round() instead of int()
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
+    if resize_backend.get_resize_backend() == "opencv":
+        mask = resize_backend.zoom_mask_opencv(mask, scale)
+    else:
+        # Suppress warning from scipy 0.13.0, the output shape of zoom() is
+        # calculated with round() instead of int()
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            mask = scipy.ndimage.zoom(mask, zoom=[scale, scale, 1], order=0)
     if crop is not None:
         y, x, h, w = crop
         mask = mask[y:y + h, x:x + w]
@@ -557,6 +646,20 @@ def mold_mask(mask, config):
     pass
 
 
+def unmold_mask_local(mask, bbox):
+    """Converts a mask generated by the neural network to a binary mask
+    covering only its bounding box.
+    mask: [height, width] of type float. A small, typically 28x28 mask.
+    bbox: [y1, x1, y2, x2]. The box to fit the mask in.
+
+    Returns a binary mask of shape [y2 - y1, x2 - x1].
+    """
+    threshold = 0.5
+    y1, x1, y2, x2 = bbox
+    mask = resize(mask, (y2 - y1, x2 - x1))
+    return mask >= threshold
+
+
 def unmold_mask(mask, bbox, image_shape):
     """Converts a mask generated by the neural network to a format similar
     to its original shape.
@@ -565,17 +668,165 @@ def unmold_mask(mask, bbox, image_shape):
 
     Returns a binary mask with the same size as the original image.
     """
-    threshold = 0.5
     y1, x1, y2, x2 = bbox
-    mask = resize(mask, (y2 - y1, x2 - x1))
-    mask = np.where(mask >= threshold, 1, 0).astype(np.bool)
-
     # Put the mask in the right location.
-    full_mask = np.zeros(image_shape[:2], dtype=np.bool)
-    full_mask[y1:y2, x1:x2] = mask
+    full_mask = np.zeros(image_shape[:2], dtype=bool)
+    full_mask[y1:y2, x1:x2] = unmold_mask_local(mask, bbox)
     return full_mask
 
 
+############################################################
+#  Compact Masks
+############################################################
+
+def rle_encode(mask):
+    """Run-length encodes a binary mask, COCO style (uncompressed).
+    mask: [height, width]
+
+    Returns a dict {"size": [height, width], "counts": [...]}: lengths of
+    alternating runs of 0s and 1s in column-major order, starting with 0s.
+    """
+    return CompactMasks.from_dense(mask[..., None]).to_rle()[0]
+
+
+def rle_decode(rle):
+    """Decodes a mask encoded by rle_encode(). Returns [height, width] bool."""
+    height, width = rle["size"]
+    counts = np.asarray(rle["counts"], dtype=np.int64)
+    values = np.zeros(len(counts), dtype=bool)
+    values[1::2] = True
+    flat = np.repeat(values, counts)
+    return flat.reshape((width, height)).T
+
+
+class CompactMasks(object):
+    """Instance masks stored inside their bounding boxes.
+
+    A dense [height, width, N] mask array costs height * width * N bytes
+    even though each instance only covers its box. CompactMasks keeps one
+    bool array per instance, the size of its box, and expands on demand.
+
+    It behaves like the dense array where the rest of the code needs it:
+    shape is (height, width, N), masks[..., ix] selects instances, and
+    compute_overlaps_masks() and visualize.display_instances() accept it.
+
+    boxes: [N, (y1, x1, y2, x2)] int pixel boxes
+    masks: list of N bool arrays, masks[i] of shape [y2 - y1, x2 - x1]
+    image_shape: [height, width, ...] of the full image
+    """
+
+    def __init__(self, boxes, masks, image_shape):
+        self.boxes = np.asarray(boxes, dtype=np.int32).reshape(-1, 4)
+        self.masks = [np.asarray(m, dtype=bool) for m in masks]
+        self.image_shape = tuple(image_shape[:2])
+        assert len(self.masks) == self.boxes.shape[0]
+
+    @classmethod
+    def from_dense(cls, masks):
+        """masks: [height, width, N] binary masks."""
+        masks = masks > .5 if masks.dtype != bool else masks
+        boxes = extract_bboxes(masks)
+        local = [masks[y1:y2, x1:x2, i] for i, (y1, x1, y2, x2) in enumerate(boxes)]
+        return cls(boxes, local, masks.shape)
+
+    @classmethod
+    def from_rle(cls, rles):
+        """rles: list of dicts as returned by rle_encode()."""
+        boxes, local = [], []
+        for rle in rles:
+            mask = rle_decode(rle)
+            y1, x1, y2, x2 = extract_bboxes(mask[..., None])[0]
+            boxes.append([y1, x1, y2, x2])
+            local.append(mask[y1:y2, x1:x2])
+        shape = rles[0]["size"] if rles else (0, 0)
+        return cls(np.array(boxes).reshape(-1, 4), local, shape)
+
+    @property
+    def shape(self):
+        return self.image_shape + (len(self.masks),)
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, key):
+        """Instance selection with the dense indexing form: masks[..., ix]."""
+        if not (isinstance(key, tuple) and len(key) == 2 and key[0] is Ellipsis):
+            raise IndexError("CompactMasks only supports masks[..., instances]")
+        ix = np.arange(len(self.masks))[key[1]]
+        if np.ndim(ix) == 0:
+            return self.expand(int(ix))
+        return CompactMasks(self.boxes[ix], [self.masks[i] for i in ix], self.image_shape)
+
+    def areas(self):
+        return np.array([m.sum() for m in self.masks], dtype=np.int64)
+
+    def expand(self, i):
+        """Full image-sized bool mask of instance i."""
+        full = np.zeros(self.image_shape, dtype=bool)
+        y1, x1, y2, x2 = self.boxes[i]
+        full[y1:y2, x1:x2] = self.masks[i]
+        return full
+
+    def to_dense(self):
+        """[height, width, N] bool array."""
+        full = np.zeros(self.shape, dtype=bool)
+        for i, (y1, x1, y2, x2) in enumerate(self.boxes):
+            full[y1:y2, x1:x2, i] = self.masks[i]
+        return full
+
+    def to_rle(self):
+        """List of N run-length encodings (see rle_encode)."""
+        height, width = self.image_shape
+        rles = []
+        for (y1, x1, y2, x2), mask in zip(self.boxes, self.masks):
+            # Run boundaries inside each box column, as flat column-major indices
+            padded = np.zeros((y2 - y1 + 2, x2 - x1), dtype=np.int8)
+            padded[1:-1] = mask
+            change = np.diff(padded, axis=0)
+            starts_y, starts_x = np.nonzero(change.T == 1)[::-1]
+            ends_y, ends_x = np.nonzero(change.T == -1)[::-1]
+            starts = (starts_x + x1) * height + starts_y + y1
+            ends = (ends_x + x1) * height + ends_y + y1
+            # Runs that continue from the bottom of one column into the next
+            join = ends[:-1] == starts[1:]
+            starts = np.concatenate([starts[:1], starts[1:][~join]])
+            ends = np.concatenate([ends[:-1][~join], ends[-1:]])
+            bounds = np.concatenate([[0], np.stack([starts, ends], 1).ravel(), [height * width]])
+            rles.append({"size": [height, width], "counts": np.diff(bounds).tolist()})
+        return rles
+
+
+def as_compact_masks(masks):
+    """CompactMasks from CompactMasks, a list of RLE dicts or a dense array."""
+    if isinstance(masks, CompactMasks):
+        return masks
+    if isinstance(masks, (list, tuple)):
+        return CompactMasks.from_rle(masks)
+    return CompactMasks.from_dense(masks)
+
+
+def compute_overlaps_compact_masks(masks1, masks2):
+    """Computes IoU overlaps between two sets of CompactMasks.
+    Only pairs whose boxes intersect are compared, inside the intersection.
+    """
+    area1 = masks1.areas().astype(np.float32)
+    area2 = masks2.areas().astype(np.float32)
+    b1, b2 = masks1.boxes, masks2.boxes
+    y1 = np.maximum(b1[:, None, 0], b2[None, :, 0])
+    x1 = np.maximum(b1[:, None, 1], b2[None, :, 1])
+    y2 = np.minimum(b1[:, None, 2], b2[None, :, 2])
+    x2 = np.minimum(b1[:, None, 3], b2[None, :, 3])
+    intersections = np.zeros((len(masks1), len(masks2)), dtype=np.float32)
+    for i, j in zip(*np.nonzero((y2 > y1) & (x2 > x1))):
+        m1 = masks1.masks[i][y1[i, j] - b1[i, 0]:y2[i, j] - b1[i, 0],
+                             x1[i, j] - b1[i, 1]:x2[i, j] - b1[i, 1]]
+        m2 = masks2.masks[j][y1[i, j] - b2[j, 0]:y2[i, j] - b2[j, 0],
+                             x1[i, j] - b2[j, 1]:x2[i, j] - b2[j, 1]]
+        intersections[i, j] = np.count_nonzero(m1 & m2)
+    union = area1[:, None] + area2[None, :] - intersections
+    return intersections / union
+
+
 ############################################################
 #  Anchors
 ############################################################
@@ -639,6 +890,103 @@ def generate_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
     return np.concatenate(anchors, axis=0)
 
 
+# Anchor pyramids shared by all data generators and models of the process.
+# Key: see anchor_cache_key(). Value: dict of the pixel anchors and their
+# normalized and batch-broadcast variants.
+_anchor_cache = {}
+
+
+def anchor_cache_key(scales, ratios, feature_shapes, feature_strides, anchor_stride):
+    """Hashable key of an anchor pyramid, made of plain Python numbers."""
+    return (tuple(float(s) for s in np.ravel(scales)),
+            tuple(float(r) for r in np.ravel(ratios)),
+            tuple(tuple(int(d) for d in shape) for shape in feature_shapes),
+            tuple(int(s) for s in np.ravel(feature_strides)),
+            int(anchor_stride))
+
+
+def _anchor_file(cache_dir, key, variant):
+    digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, "anchors_{}_{}.npy".format(digest, variant))
+
+
+def _load_or_build(path, build):
+    """Loads an array saved by an earlier call (memory-mapped, read-only),
+    or builds it and saves it atomically."""
+    if path and os.path.exists(path):
+        return np.load(path, mmap_mode="r")
+    array = build()
+    if path:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+    array.flags.writeable = False
+    return array
+
+
+def get_pyramid_anchors(scales, ratios, feature_shapes, feature_strides,
+                        anchor_stride, image_shape=None, batch_size=None,
+                        cache_dir=None):
+    """Cached generate_pyramid_anchors().
+
+    Anchors are generated once per process for each combination of
+    scales, ratios, feature shapes, strides and anchor stride, and shared
+    by every caller. The returned arrays are read-only.
+
+    image_shape: Optional [height, width, ...]. If given, returns the anchors
+        in normalized coordinates (see norm_boxes()) instead of pixels.
+    batch_size: Optional, with image_shape. Returns the normalized anchors
+        repeated for each image of a batch, [batch_size, N, 4], as one
+        contiguous array that is reused by every call.
+    cache_dir: Optional directory to persist the anchors in as .npy files,
+        so other processes and later runs load them instead of generating
+        them. None keeps them in memory only.
+
+    Returns:
+    anchors: [N, (y1, x1, y2, x2)] or [batch_size, N, (y1, x1, y2, x2)]
+    """
+    key = anchor_cache_key(scales, ratios, feature_shapes, feature_strides,
+                           anchor_stride)
+    entry = _anchor_cache.setdefault(key, {})
+    if "pixels" not in entry:
+        path = _anchor_file(cache_dir, key, "pixels") if cache_dir else None
+        entry["pixels"] = _load_or_build(path, lambda: generate_pyramid_anchors(
+            scales, ratios, feature_shapes, feature_strides, anchor_stride))
+    if image_shape is None:
+        return entry["pixels"]
+
+    height, width = int(image_shape[0]), int(image_shape[1])
+    norm_key = ("normalized", height, width)
+    if norm_key not in entry:
+        path = _anchor_file(cache_dir, key, "norm{}x{}".format(height, width)) \
+            if cache_dir else None
+        entry[norm_key] = _load_or_build(
+            path, lambda: norm_boxes(np.asarray(entry["pixels"]), (height, width)))
+    if batch_size is None:
+        return entry[norm_key]
+
+    batch_key = ("batch", height, width, int(batch_size))
+    if batch_key not in entry:
+        batch = np.empty((batch_size,) + entry[norm_key].shape,
+                         dtype=entry[norm_key].dtype)
+        batch[:] = entry[norm_key]
+        batch.flags.writeable = False
+        entry[batch_key] = batch
+    return entry[batch_key]
+
+
+def clear_anchor_cache():
+    """Drops the in-memory anchor cache (files in cache_dir are kept)."""
+    _anchor_cache.clear()
+
+
 ############################################################
 #  Miscellaneous
 ############################################################
@@ -653,6 +1001,123 @@ def trim_zeros(x):
     return x[~np.all(x == 0, axis=1)]
 
 
+# COCO IoU thresholds 0.5:0.95
+COCO_IOU_THRESHOLDS = np.round(np.arange(0.5, 1.0, 0.05), 2)
+
+
+def match_predictions(overlaps, pred_class_ids, gt_class_ids, iou_thresholds,
+                      score_threshold=0.0):
+    """The greedy matching of compute_matches() at several IoU
+    thresholds at once.
+
+    overlaps: [pred_count, gt_count] IoU, predictions sorted by score from
+        high to low.
+    pred_class_ids, gt_class_ids: [pred_count], [gt_count]
+    iou_thresholds: list of T IoU thresholds.
+    score_threshold: Ignore pairs with a lower IoU (see compute_matches()).
+
+    Each prediction, in score order, is matched to the unmatched GT instance
+    of its class with the highest IoU, if that IoU reaches the threshold.
+
+    Returns:
+        gt_match: [T, gt_count] int. Index of the matched prediction or -1.
+        pred_match: [T, pred_count] int. Index of the matched GT or -1.
+    """
+    iou_thresholds = np.asarray(iou_thresholds, dtype=np.float64).reshape(-1, 1)
+    pred_count, gt_count = overlaps.shape
+    gt_match = -np.ones((len(iou_thresholds), gt_count), dtype=np.int64)
+    pred_match = -np.ones((len(iou_thresholds), pred_count), dtype=np.int64)
+    if pred_count == 0 or gt_count == 0:
+        return gt_match, pred_match
+
+    eligible = (np.asarray(pred_class_ids)[:, None] == np.asarray(gt_class_ids)[None, :]) & \
+        (overlaps >= score_threshold) & (overlaps >= iou_thresholds.min())
+    thresholds = np.arange(len(iou_thresholds))
+    # Equal IoUs go to the highest GT index, like compute_matches()'
+    # reversed argsort: argmax over the reversed columns.
+    reversed_overlaps = overlaps[:, ::-1]
+    for i in np.nonzero(eligible.any(axis=1))[0]:
+        # [T, gt_count] candidates of this prediction at every threshold
+        candidates = (gt_match < 0) & eligible[i] & (overlaps[i] >= iou_thresholds)
+        found = candidates.any(axis=1)
+        if not found.any():
+            continue
+        scores = np.where(candidates[:, ::-1], reversed_overlaps[i], -1)
+        j = gt_count - 1 - np.argmax(scores, axis=1)
+        t = thresholds[found]
+        gt_match[t, j[found]] = i
+        pred_match[t, i] = j[found]
+    return gt_match, pred_match
+
+
+def image_ap(pred_match, gt_count):
+    """Per-image AP of compute_ap() for each row of pred_match.
+
+    pred_match: [T, pred_count] as returned by match_predictions()
+    gt_count: Number of GT instances in the image.
+
+    Returns [T] AP values, NaN if the image has no GT instances.
+    """
+    if gt_count == 0:
+        return np.full(len(pred_match), np.nan)
+    matched = np.cumsum(pred_match > -1, axis=1)
+    precisions = matched / np.arange(1, pred_match.shape[1] + 1)
+    recalls = matched / gt_count
+    # Pad with start and end values, then make precision non-increasing
+    zeros = np.zeros((len(pred_match), 1))
+    precisions = np.concatenate([zeros, precisions, zeros], axis=1)
+    recalls = np.concatenate([zeros, recalls, zeros + 1], axis=1)
+    precisions = np.maximum.accumulate(precisions[:, ::-1], axis=1)[:, ::-1]
+    # Steps where the recall doesn't change add nothing
+    return np.sum(np.diff(recalls, axis=1) * precisions[:, 1:], axis=1)
+
+
+def evaluate_image(gt_boxes, gt_class_ids, gt_masks,
+                   pred_boxes, pred_class_ids, pred_scores, pred_masks,
+                   iou_thresholds=None, score_threshold=0.0):
+    """Matches the predictions of one image at all IoU thresholds.
+
+    gt_masks, pred_masks: [height, width, N] arrays, CompactMasks or lists
+        of RLE dicts. If either is None, boxes are matched instead.
+    iou_thresholds: Defaults to COCO_IOU_THRESHOLDS (0.5:0.95).
+
+    Zero boxes (padding) are dropped. Returns a dict:
+        scores: [P] prediction scores, sorted high to low
+        class_ids: [P] prediction class IDs in the same order
+        pred_match: [T, P] index of the matched GT instance or -1
+        gt_class_ids: [G]
+        gt_match: [T, G] index of the matched prediction or -1
+        ap: [T] per-image AP as computed by compute_ap()
+    """
+    iou_thresholds = COCO_IOU_THRESHOLDS if iou_thresholds is None else \
+        np.asarray(iou_thresholds, dtype=np.float64)
+    use_masks = gt_masks is not None and pred_masks is not None
+    if use_masks and (not isinstance(gt_masks, np.ndarray) or
+                      not isinstance(pred_masks, np.ndarray)):
+        gt_masks = as_compact_masks(gt_masks)
+        pred_masks = as_compact_masks(pred_masks)
+
+    gt_keep = np.where(np.any(gt_boxes != 0, axis=1))[0]
+    pred_keep = np.where(np.any(pred_boxes != 0, axis=1))[0]
+    # Sort predictions by score from high to low
+    order = pred_keep[np.argsort(pred_scores[pred_keep])[::-1]]
+    gt_class_ids = np.asarray(gt_class_ids)[gt_keep]
+    pred_class_ids = np.asarray(pred_class_ids)[order]
+    if use_masks:
+        overlaps = compute_overlaps_masks(pred_masks[..., order], gt_masks[..., gt_keep])
+    else:
+        overlaps = compute_overlaps(pred_boxes[order], gt_boxes[gt_keep])
+
+    gt_match, pred_match = match_predictions(overlaps, pred_class_ids, gt_class_ids,
+                                             iou_thresholds, score_threshold)
+    return {"scores": np.asarray(pred_scores)[order],
+            "class_ids": pred_class_ids,
+            "pred_match": pred_match,
+            "gt_class_ids": gt_class_ids,
+            "gt_match": gt_match,
+            "ap": image_ap(pred_match, len(gt_keep))}
+
+
 def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     pred_boxes, pred_class_ids, pred_scores, pred_masks,
                     iou_threshold=0.5, score_threshold=0.0):
@@ -665,6 +1130,10 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
                     the matched ground truth box.
         overlaps: [pred_boxes, gt_boxes] IoU overlaps.
     """
+    # Compact masks (CompactMasks or RLE lists) support the slicing below
+    if not isinstance(gt_masks, np.ndarray) or not isinstance(pred_masks, np.ndarray):
+        gt_masks = as_compact_masks(gt_masks)
+        pred_masks = as_compact_masks(pred_masks)
     # Trim zero padding
     # TODO: cleaner to do zero unpadding upstream
     gt_boxes = trim_zeros(gt_boxes)
@@ -681,33 +1150,12 @@ def compute_matches(gt_boxes, gt_class_ids, gt_masks,
     # Compute IoU overlaps [pred_masks, gt_masks]
     overlaps = compute_overlaps_masks(pred_masks, gt_masks)
 
-    # Loop through predictions and find matching ground truth boxes
-    match_count = 0
-    pred_match = -1 * np.ones([pred_boxes.shape[0]])
-    gt_match = -1 * np.ones([gt_boxes.shape[0]])
-    for i in range(len(pred_boxes)):
-        # Find best matching ground truth box
-        # 1. Sort matches by score
-        sorted_ixs = np.argsort(overlaps[i])[::-1]
-        # 2. Remove low scores
-        low_score_idx = np.where(overlaps[i, sorted_ixs] < score_threshold)[0]
-        if low_score_idx.size > 0:
-            sorted_ixs = sorted_ixs[:low_score_idx[0]]
-        # 3. Find the match
-        for j in sorted_ixs:
-            # If ground truth box is already matched, go to next one
-            if gt_match[j] > -1:
-                continue
-            # If we reach IoU smaller than the threshold, end the loop
-            iou = overlaps[i, j]
-            if iou < iou_threshold:
-                break
-            # Do we have a match?
-            if pred_class_ids[i] == gt_class_ids[j]:
-                match_count += 1
-                gt_match[j] = i
-                pred_match[i] = j
-                break
+    # Greedy matching in score order (see match_predictions())
+    gt_match, pred_match = match_predictions(
+        overlaps, pred_class_ids, gt_class_ids[:gt_boxes.shape[0]], [iou_threshold],
+        score_threshold)
+    gt_match = gt_match[0].astype(np.float64)
+    pred_match = pred_match[0].astype(np.float64)
 
     return gt_match, pred_match, overlaps
 
@@ -758,16 +1206,14 @@ def compute_ap_range(gt_box, gt_class_id, gt_mask,
     # Default is 0.5 to 0.95 with increments of 0.05
     iou_thresholds = iou_thresholds or np.arange(0.5, 1.0, 0.05)
     
-    # Compute AP over range of IoU thresholds
-    AP = []
-    for iou_threshold in iou_thresholds:
-        ap, precisions, recalls, overlaps =\
-            compute_ap(gt_box, gt_class_id, gt_mask,
+    # Compute AP over range of IoU thresholds. Overlaps are computed once
+    # and matched at all thresholds (see evaluate_image()).
+    AP = evaluate_image(gt_box, gt_class_id, gt_mask,
                         pred_box, pred_class_id, pred_score, pred_mask,
-                        iou_threshold=iou_threshold)
-        if verbose:
+                        iou_thresholds=iou_thresholds)["ap"]
+    if verbose:
+        for iou_threshold, ap in zip(iou_thresholds, AP):
             print("AP @{:.2f}:\t {:.3f}".format(iou_threshold, ap))
-        AP.append(ap)
     AP = np.array(AP).mean()
     if verbose:
         print("AP @{:.2f}-{:.2f}:\t {:.3f}".format(
@@ -892,7 +1338,20 @@ def resize(image, output_shape, order=1, mode='constant', cval=0, clip=True,
     receive the right parameters. The right parameters depend on the version
     of skimage. This solves the problem by using different parameters per
     version. And it provides a central place to control resizing defaults.
+
+    With the "opencv" backend (see set_resize_backend()), calls OpenCV can
+    reproduce run through cv2.resize and keep the input dtype when
+    preserve_range=True.
     """
+    if resize_backend.get_resize_backend() == "opencv" and \
+            resize_backend.can_resize_opencv(image, output_shape, order, mode, cval,
+                                             anti_aliasing):
+        return resize_backend.resize_opencv(image, output_shape, order=order,
+                                            preserve_range=preserve_range)
+    if image.dtype == bool:
+        # skimage < 0.19 interpolated boolean masks as floats. Newer versions
+        # refuse bool input for order > 0, so convert the same way here.
+        image = image.astype(np.float64)
     if LooseVersion(skimage.__version__) >= LooseVersion("0.14"):
         # New in 0.14: anti_aliasing. Default it to False for backward
         # compatibility with skimage 0.13.
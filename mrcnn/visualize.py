@@ -87,7 +87,8 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                       colors=None, captions=None):
     """
     boxes: [num_instance, (y1, x1, y2, x2, class_id)] in image coordinates.
-    masks: [height, width, num_instances]
+    masks: [height, width, num_instances], utils.CompactMasks or a list of
+        RLE dicts. Compact masks are drawn inside their boxes only.
     class_ids: [num_instances]
     class_names: list of class names of the dataset
     scores: (optional) confidence scores for each box
@@ -97,6 +98,8 @@ def display_instances(image, boxes, masks, class_ids, class_names,
     colors: (optional) An array or colors to use with each object
     captions: (optional) A list of strings to use as captions for each object
     """
+    if not isinstance(masks, np.ndarray):
+        masks = utils.as_compact_masks(masks)
     # Number of instances
     N = boxes.shape[0]
     if not N:
@@ -147,9 +150,17 @@ def display_instances(image, boxes, masks, class_ids, class_names,
                 color='w', size=11, backgroundcolor="none")
 
         # Mask
-        mask = masks[:, :, i]
-        if show_mask:
-            masked_image = apply_mask(masked_image, mask, color)
+        if isinstance(masks, utils.CompactMasks):
+            # Work inside the mask's own box: (my1, mx1) offsets the polygon
+            my1, mx1, my2, mx2 = masks.boxes[i]
+            mask = masks.masks[i]
+            if show_mask:
+                apply_mask(masked_image[my1:my2, mx1:mx2], mask, color)
+        else:
+            my1 = mx1 = 0
+            mask = masks[:, :, i]
+            if show_mask:
+                masked_image = apply_mask(masked_image, mask, color)
 
         # Mask Polygon
         # Pad to ensure proper polygons for masks that touch image edges.
@@ -159,7 +170,7 @@ def display_instances(image, boxes, masks, class_ids, class_names,
         contours = find_contours(padded_mask, 0.5)
         for verts in contours:
             # Subtract the padding and flip (y, x) to (x, y)
-            verts = np.fliplr(verts) - 1
+            verts = np.fliplr(verts) - 1 + [mx1, my1]
             p = Polygon(verts, facecolor="none", edgecolor=color)
             ax.add_patch(p)
     ax.imshow(masked_image.astype(np.uint8))
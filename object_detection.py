@@ -1,18 +1,22 @@
 import cv2
 import numpy as np
-from ultralytics import YOLO
 import time
 from datetime import datetime
 import os
+from model_registry import get_model
+from quality_controller import AdaptiveQualityController
 
 class UrineStripDetector:
-    def __init__(self, model_path="runs/detect/train/weights/best.pt", confidence_threshold=0.5):
+    def __init__(self, model_path="runs/detect/train/weights/best.pt", confidence_threshold=0.5,
+                 warmup_sizes=(640,)):
         """
         Initialize the urine strip detector
         
         Args:
-            model_path: Path to the trained YOLO model
+            model_path: Path to the trained YOLO model (.pt weights or an exported
+                        model directory, e.g. the INT8 OpenVINO model from quantize_model.py)
             confidence_threshold: Minimum confidence for detections
+            warmup_sizes: Input sizes to warm up before the detector reports ready
         """
         
         if not os.path.exists(model_path):
@@ -22,7 +26,9 @@ class UrineStripDetector:
             )
         
         print(f"Loading model from: {model_path}")
-        self.model = YOLO(model_path)
+        # Weights are loaded and warmed up once per process and shared by all detectors
+        self._model_entry = get_model(model_path, warmup_sizes=warmup_sizes)
+        self.model = self._model_entry.model
         self.confidence_threshold = confidence_threshold
         self.detection_history = []
         
@@ -32,70 +38,202 @@ class UrineStripDetector:
         print(f"✓ Model loaded successfully!")
         print(f"  Classes: {self.model.names}")
         print(f"  Confidence threshold: {confidence_threshold}")
+        timings = self._model_entry.timings()
+        if timings['load_s'] is not None:
+            print(f"  Load time: {timings['load_s']*1000:.0f} ms, warm-up: "
+                  + ", ".join(f"{s}px {t*1000:.0f} ms" for s, t in timings['warmup_s'].items()))
         
-    def detect_strips(self, frame, verbose=False):
+    def detect_strips(self, frame, verbose=False, mode="direct", imgsz=640):
         """
         Detect urine strips in a frame
         
         Args:
             frame: Input image frame
             verbose: Print detection details
+            mode: "direct" (whole frame at the model input size), "coarse_to_fine"
+                  (low-resolution pass, then re-detection on native-resolution crops)
+                  or "tiled" (overlapping native-resolution tiles with box merging).
+                  Boxes are always in native frame coordinates, so pad colors can be
+                  sampled from the full-resolution pixels.
+            imgsz: Model input size (coarse pass size in "coarse_to_fine" mode)
             
         Returns:
             annotated_frame: Frame with detections drawn
             detections: List of detection information
         """
-        # Run inference
-        results = self.model(frame, conf=self.confidence_threshold, verbose=False)
+        raw = self._detect_raw(frame, mode, imgsz)
+        return self._annotate(frame, raw, verbose)
+    
+    def _detect_raw(self, frame, mode="direct", imgsz=640):
+        """Raw (N, 6) boxes for the given detection mode"""
+        if mode == "direct":
+            return self._predict(frame, imgsz=imgsz)
+        elif mode == "coarse_to_fine":
+            return self._detect_coarse_to_fine(frame, coarse_size=imgsz)
+        elif mode == "tiled":
+            return self._detect_tiled(frame, imgsz=imgsz)
+        raise ValueError(f"Unknown detection mode: {mode}")
+    
+    def _annotate(self, frame, raw, verbose=False):
+        """Draw raw boxes on a copy of the frame and build the detection list"""
         annotated_frame = frame.copy()
         detections = []
         
-        for r in results:
-            boxes = r.boxes
-            if boxes is not None and len(boxes) > 0:
-                for box in boxes:
-                    # Extract box coordinates and confidence
-                    x1, y1, x2, y2 = box.xyxy[0].cpu().numpy()
-                    conf = float(box.conf[0])
-                    cls = int(box.cls[0])
-                    label = self.model.names[cls]
-                    
-                    # Only process detections above threshold
-                    if conf >= self.confidence_threshold:
-                        detections.append({
-                            'bbox': (int(x1), int(y1), int(x2), int(y2)),
-                            'confidence': conf,
-                            'class': label,
-                            'timestamp': datetime.now()
-                        })
-                        
-                        # Draw bounding box
-                        color = self._get_color(cls)
-                        cv2.rectangle(annotated_frame, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
-                        
-                        # Draw label with background
-                        label_text = f"{label}: {conf:.2f}"
-                        label_size = cv2.getTextSize(label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
-                        cv2.rectangle(annotated_frame, 
-                                    (int(x1), int(y1) - label_size[1] - 10),
-                                    (int(x1) + label_size[0], int(y1)), 
-                                    color, -1)
-                        cv2.putText(annotated_frame, label_text, 
-                                  (int(x1), int(y1) - 5),
-                                  cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
-                        
-                        # Draw center point
-                        center_x, center_y = int((x1 + x2) / 2), int((y1 + y2) / 2)
-                        cv2.circle(annotated_frame, (center_x, center_y), 5, color, -1)
-                        
-                        if verbose:
-                            print(f"  Detection: {label} at ({int(x1)}, {int(y1)}, {int(x2)}, {int(y2)}) - Confidence: {conf:.3f}")
+        for x1, y1, x2, y2, conf, cls in raw:
+            cls = int(cls)
+            label = self.model.names[cls]
+            
+            # Only process detections above threshold
+            if conf >= self.confidence_threshold:
+                detections.append({
+                    'bbox': (int(x1), int(y1), int(x2), int(y2)),
+                    'confidence': float(conf),
+                    'class': label,
+                    'timestamp': datetime.now()
+                })
+                
+                # Draw bounding box
+                color = self._get_color(cls)
+                cv2.rectangle(annotated_frame, (int(x1), int(y1)), (int(x2), int(y2)), color, 2)
+                
+                # Draw label with background
+                label_text = f"{label}: {conf:.2f}"
+                label_size = cv2.getTextSize(label_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 2)[0]
+                cv2.rectangle(annotated_frame, 
+                            (int(x1), int(y1) - label_size[1] - 10),
+                            (int(x1) + label_size[0], int(y1)), 
+                            color, -1)
+                cv2.putText(annotated_frame, label_text, 
+                          (int(x1), int(y1) - 5),
+                          cv2.FONT_HERSHEY_SIMPLEX, 0.6, (255, 255, 255), 2)
+                
+                # Draw center point
+                center_x, center_y = int((x1 + x2) / 2), int((y1 + y2) / 2)
+                cv2.circle(annotated_frame, (center_x, center_y), 5, color, -1)
+                
+                if verbose:
+                    print(f"  Detection: {label} at ({int(x1)}, {int(y1)}, {int(x2)}, {int(y2)}) - Confidence: {conf:.3f}")
         
         if verbose and len(detections) == 0:
             print("  No detections found above threshold")
         
         return annotated_frame, detections
     
+    def _predict(self, images, imgsz=640, conf=None, offsets=None):
+        """
+        Run the model and return raw boxes as an (N, 6) array [x1, y1, x2, y2, conf, cls]
+        
+        Args:
+            images: One frame or a list of frames (lists are inferred as one batch)
+            imgsz: Model input size
+            conf: Confidence threshold (defaults to the detector threshold)
+            offsets: Optional (x, y) per image added to its boxes (crop/tile origin)
+        """
+        if not isinstance(images, list):
+            images = [images]
+        conf = self.confidence_threshold if conf is None else conf
+        # Run inference (the model may be shared with other detectors/threads)
+        with self._model_entry.lock:
+            results = self.model(images, imgsz=imgsz, conf=conf, verbose=False)
+        raw = []
+        for i, r in enumerate(results):
+            boxes = r.boxes
+            if boxes is None or len(boxes) == 0:
+                continue
+            dets = np.hstack([boxes.xyxy.cpu().numpy(),
+                              boxes.conf.cpu().numpy()[:, None],
+                              boxes.cls.cpu().numpy()[:, None]])
+            if offsets is not None:
+                ox, oy = offsets[i]
+                dets[:, [0, 2]] += ox
+                dets[:, [1, 3]] += oy
+            raw.append(dets)
+        return np.vstack(raw) if raw else np.zeros((0, 6), dtype=np.float32)
+    
+    def _detect_coarse_to_fine(self, frame, coarse_size=640, fine_size=640, margin=0.25):
+        """
+        Low-resolution pass to find candidate regions, then re-detect on
+        native-resolution crops of those regions only
+        """
+        h, w = frame.shape[:2]
+        scale = coarse_size / max(h, w)
+        if scale >= 1.0:
+            # Frame is already small enough for a single pass
+            return self._predict(frame, imgsz=coarse_size)
+        
+        small = cv2.resize(frame, (int(round(w * scale)), int(round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+        # Lower threshold in the coarse pass: small strips score lower at low resolution
+        candidates = self._predict(small, imgsz=coarse_size, conf=self.confidence_threshold * 0.5)
+        if len(candidates) == 0:
+            return candidates
+        candidates[:, :4] /= scale
+        
+        crops, offsets = [], []
+        for x1, y1, x2, y2, _, _ in self._merge_boxes(candidates):
+            mx, my = (x2 - x1) * margin, (y2 - y1) * margin
+            cx1, cy1 = int(max(0, x1 - mx)), int(max(0, y1 - my))
+            cx2, cy2 = int(min(w, x2 + mx)), int(min(h, y2 + my))
+            if cx2 - cx1 < 2 or cy2 - cy1 < 2:
+                continue
+            crops.append(frame[cy1:cy2, cx1:cx2])
+            offsets.append((cx1, cy1))
+        if not crops:
+            return np.zeros((0, 6), dtype=np.float32)
+        
+        fine = self._predict(crops, imgsz=fine_size, offsets=offsets)
+        return self._merge_boxes(fine)
+    
+    def _detect_tiled(self, frame, tile_size=1280, overlap=0.2, imgsz=640):
+        """Detect on overlapping native-resolution tiles and merge boxes across tiles"""
+        h, w = frame.shape[:2]
+        if max(h, w) <= tile_size:
+            return self._predict(frame, imgsz=imgsz)
+        
+        step = max(1, int(tile_size * (1.0 - overlap)))
+        ys = list(range(0, max(1, h - tile_size), step)) + [max(0, h - tile_size)]
+        xs = list(range(0, max(1, w - tile_size), step)) + [max(0, w - tile_size)]
+        tiles, offsets = [], []
+        for ty in sorted(set(ys)):
+            for tx in sorted(set(xs)):
+                tiles.append(frame[ty:ty + tile_size, tx:tx + tile_size])
+                offsets.append((tx, ty))
+        
+        raw = self._predict(tiles, imgsz=imgsz, offsets=offsets)
+        return self._merge_boxes(raw)
+    
+    @staticmethod
+    def _merge_boxes(raw, iou_threshold=0.5, containment_threshold=0.8):
+        """
+        Merge duplicate boxes from overlapping crops/tiles (greedy, highest confidence first)
+        
+        Boxes of the same class are merged when their IoU exceeds iou_threshold or when
+        one is mostly contained in the other (pieces of an object cut at a tile seam).
+        The merged box is the union of the group and keeps the highest confidence.
+        """
+        if len(raw) < 2:
+            return raw
+        raw = raw[np.argsort(-raw[:, 4])]
+        x1, y1, x2, y2 = raw[:, 0], raw[:, 1], raw[:, 2], raw[:, 3]
+        areas = np.maximum(x2 - x1, 0) * np.maximum(y2 - y1, 0)
+        used = np.zeros(len(raw), dtype=bool)
+        merged = []
+        for i in range(len(raw)):
+            if used[i]:
+                continue
+            iw = np.maximum(0, np.minimum(x2[i], x2) - np.maximum(x1[i], x1))
+            ih = np.maximum(0, np.minimum(y2[i], y2) - np.maximum(y1[i], y1))
+            inter = iw * ih
+            iou = inter / np.maximum(areas[i] + areas - inter, 1e-6)
+            contained = inter / np.maximum(np.minimum(areas[i], areas), 1e-6)
+            group = (~used) & (raw[:, 5] == raw[i, 5]) & \
+                    ((iou > iou_threshold) | (contained > containment_threshold))
+            group[i] = True
+            used |= group
+            merged.append([x1[group].min(), y1[group].min(), x2[group].max(), y2[group].max(),
+                           raw[i, 4], raw[i, 5]])
+        return np.array(merged, dtype=np.float32)
+    
     def _get_color(self, class_id):
         """Generate consistent colors for different classes"""
         colors = [(0, 255, 0), (255, 0, 0), (0, 0, 255), (255, 255, 0), 
@@ -112,13 +250,18 @@ class UrineStripDetector:
             return filename
         return None
     
-    def run_camera_detection(self, camera_id=0, save_detections=False):
+    def run_camera_detection(self, camera_id=0, save_detections=False, target_fps=None,
+                             target_latency_ms=None, mode="direct"):
         """
         Run real-time detection on camera feed
         
         Args:
             camera_id: Camera device ID (0 for default camera)
             save_detections: Whether to save frames with detections
+            target_fps: If set, an AdaptiveQualityController adjusts the inference
+                        size and detection frame skip to hold this frame rate
+            target_latency_ms: Alternative target: per-frame processing budget
+            mode: Detection mode, see detect_strips()
         """
         cap = cv2.VideoCapture(camera_id)
         
@@ -136,6 +279,15 @@ class UrineStripDetector:
         start_time = time.time()
         fps = 0
         
+        controller = None
+        if target_fps is not None or target_latency_ms is not None:
+            controller = AdaptiveQualityController(target_fps=target_fps,
+                                                   target_latency_ms=target_latency_ms)
+            # sizes already warmed up are skipped by the registry
+            get_model(self._model_entry.model_path, warmup_sizes=controller.sizes)
+        frame_index = 0
+        raw = None
+        
         print("\n" + "="*60)
         print("CAMERA DETECTION STARTED")
         print("="*60)
@@ -152,8 +304,15 @@ class UrineStripDetector:
                     print("Failed to read from camera")
                     break
                 
-                # Perform detection
-                annotated_frame, detections = self.detect_strips(frame)
+                # Perform detection (on skipped frames, reuse the last boxes)
+                fresh = controller is None or raw is None or controller.should_detect(frame_index)
+                t0 = time.perf_counter()
+                if fresh:
+                    imgsz = controller.imgsz if controller is not None else 640
+                    raw = self._detect_raw(frame, mode, imgsz)
+                t1 = time.perf_counter()
+                annotated_frame, detections = self._annotate(frame, raw)
+                frame_index += 1
                 
                 # Calculate and display FPS
                 fps_counter += 1
@@ -162,15 +321,24 @@ class UrineStripDetector:
                     fps = fps_counter / elapsed
                     fps_counter = 0
                     start_time = time.time()
+                    if controller is not None:
+                        controller.update(fps)
                 
                 # Add FPS and detection count to frame
                 cv2.putText(annotated_frame, f"FPS: {fps:.1f}", (10, 30),
                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
                 cv2.putText(annotated_frame, f"Detections: {len(detections)}", (10, 70),
                            cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 255, 0), 2)
+                if controller is not None:
+                    cv2.putText(annotated_frame, f"Quality: {controller.level} (imgsz {controller.imgsz})",
+                               (10, 110), cv2.FONT_HERSHEY_SIMPLEX, 0.7, (0, 255, 0), 2)
                 
                 # Display frame
                 cv2.imshow("Urine Strip Detection", annotated_frame)
+                if controller is not None:
+                    controller.record("detect", t1 - t0)
+                    controller.record("draw", time.perf_counter() - t1)
+                    controller.end_frame()
                 
                 # Handle key presses
                 key = cv2.waitKey(1) & 0xFF
@@ -182,11 +350,11 @@ class UrineStripDetector:
                         print(f"Frame saved: {saved_path}")
                 
                 # Auto-save if enabled
-                if save_detections and detections:
+                if save_detections and detections and fresh:
                     self.save_detection(annotated_frame, detections)
                 
                 # Store detection history
-                if detections:
+                if detections and fresh:
                     self.detection_history.extend(detections)
         
         except KeyboardInterrupt:
@@ -197,7 +365,7 @@ class UrineStripDetector:
             
             print(f"\nDetection session completed. Total detections: {len(self.detection_history)}")
     
-    def detect_on_image(self, image_path, output_path=None, show=False):
+    def detect_on_image(self, image_path, output_path=None, show=False, mode="direct"):
         """
         Detect urine strips on a single image
         
@@ -205,6 +373,8 @@ class UrineStripDetector:
             image_path: Path to input image
             output_path: Path to save annotated image (optional)
             show: Display the image (optional)
+            mode: Detection mode, see detect_strips(). "coarse_to_fine" or "tiled"
+                  keep small strips in 12MP phone photos detectable.
         
         Returns:
             annotated_frame: Annotated image
@@ -221,7 +391,7 @@ class UrineStripDetector:
         print(f"Image size: {frame.shape[1]}x{frame.shape[0]}")
         
         # Perform detection
-        annotated_frame, detections = self.detect_strips(frame, verbose=True)
+        annotated_frame, detections = self.detect_strips(frame, verbose=True, mode=mode)
         
         print(f"Found {len(detections)} detection(s)")
         
@@ -240,7 +410,7 @@ class UrineStripDetector:
         return annotated_frame, detections
     
     def batch_detect(self, input_dir, output_dir="detection_results/batch", 
-                     save_all=False, min_confidence=None):
+                     save_all=False, min_confidence=None, mode="direct"):
         """
         Process multiple images in batch
         
@@ -249,6 +419,7 @@ class UrineStripDetector:
             output_dir: Directory to save results
             save_all: Save all images (not just those with detections)
             min_confidence: Override confidence threshold for this batch
+            mode: Detection mode, see detect_strips()
         """
         os.makedirs(output_dir, exist_ok=True)
         
@@ -277,7 +448,8 @@ class UrineStripDetector:
             output_path = os.path.join(output_dir, f"annotated_{image_file}")
             
             _, detections = self.detect_on_image(image_path, 
-                                                 output_path if (save_all or detections) else None)
+                                                 output_path if (save_all or detections) else None,
+                                                 mode=mode)
             
             if detections:
                 images_with_detections += 1
@@ -0,0 +1,138 @@
+import warnings
+import numpy as np
+
+
+class PadAggregator:
+    """
+    Temporal aggregation of one strip's pad LAB readings across frames
+
+    Each frame adds an (N, 3) array of pad LAB values (NaN for pads that could
+    not be sampled). The aggregate is a median over a sliding window or an
+    exponential moving average. Matching/interpretation (match_fn) is only
+    re-run when some pad's aggregate has moved more than rematch_threshold
+    (Euclidean LAB distance) since the last match, so the overlay stops
+    flickering and steady frames skip the interpretation cost. Once the
+    aggregate has stayed within rematch_threshold of the matched reading for
+    settle_frames frames a single "settled" event is emitted; the event
+    re-arms after a reset or a re-match.
+    """
+
+    def __init__(self, window=8, method="median", alpha=0.3, rematch_threshold=3.0,
+                 settle_frames=10, max_missing=5):
+        """
+        Args:
+            window: Frames kept for the sliding median
+            method: "median" (sliding window) or "ema"
+            alpha: EMA factor
+            rematch_threshold: Aggregate movement (LAB units) that triggers a new match
+            settle_frames: Consecutive stable frames needed for the settled event
+            max_missing: Consecutive frames without the strip before the state is reset
+        """
+        if method not in ("median", "ema"):
+            raise ValueError(f"Unknown aggregation method: {method}")
+        self.window = window
+        self.method = method
+        self.alpha = alpha
+        self.rematch_threshold = rematch_threshold
+        self.settle_frames = settle_frames
+        self.max_missing = max_missing
+        self.reset()
+
+    def reset(self):
+        """Forget the current strip (call when a new strip is presented)"""
+        self._buffer = None      # (window, N, 3) ring buffer of raw readings
+        self._count = 0
+        self.value = None        # current aggregate (N, 3)
+        self.result = None       # last match_fn output
+        self.settled = False
+        self.frames = 0
+        self.matches = 0         # number of match_fn calls (for stats)
+        self._matched_value = None
+        self._stable = 0
+        self._missing = 0
+
+    def _aggregate(self, labs):
+        if self.method == "ema":
+            if self.value is None:
+                return labs.copy()
+            # NaN readings keep the previous aggregate; NaN aggregates take the new reading
+            value = self.value + self.alpha * (labs - self.value)
+            value = np.where(np.isnan(labs), self.value, value)
+            return np.where(np.isnan(self.value), labs, value)
+        if self._buffer is None:
+            self._buffer = np.full((self.window,) + labs.shape, np.nan)
+        self._buffer[self._count % self.window] = labs
+        self._count += 1
+        filled = self._buffer[:min(self._count, self.window)]
+        if not np.isnan(filled).any():
+            return np.median(filled, axis=0)
+        with warnings.catch_warnings():
+            # pads missing in every buffered frame stay NaN
+            warnings.simplefilter("ignore", RuntimeWarning)
+            return np.nanmedian(filled, axis=0)
+
+    @staticmethod
+    def _movement(a, b):
+        """Largest per-pad LAB distance between two aggregates (inf if pads became (un)available)"""
+        if a is None or b is None:
+            return float('inf')
+        if not np.array_equal(np.isnan(a).any(axis=1), np.isnan(b).any(axis=1)):
+            return float('inf')
+        d = np.linalg.norm(a - b, axis=1)
+        d = d[~np.isnan(d)]
+        return float(d.max()) if len(d) else 0.0
+
+    def update(self, pad_labs, match_fn):
+        """
+        Add one frame's pad readings
+
+        Args:
+            pad_labs: (N, 3) LAB values of the pads, NaN rows for missing pads
+            match_fn: Called with the aggregate (N, 3) when it has moved enough;
+                      its return value is cached as self.result
+
+        Returns:
+            (result, settled_event): the current (possibly cached) match result and
+            True on the single frame on which the reading settled
+        """
+        labs = np.asarray(pad_labs, dtype=np.float64)
+        if self.value is not None and labs.shape != self.value.shape:
+            self.reset()  # different layout / pad count
+        self._missing = 0
+        self.frames += 1
+
+        self.value = self._aggregate(labs)
+
+        moved = self._movement(self.value, self._matched_value) > self.rematch_threshold
+        if moved or self.result is None:
+            self.result = match_fn(self.value)
+            self._matched_value = self.value.copy()
+            self.matches += 1
+        if moved:
+            self.settled = False  # reading changed: allow a new settled event
+            self._stable = 0
+        else:
+            self._stable += 1
+
+        settled_event = False
+        if not self.settled and self._stable >= self.settle_frames:
+            self.settled = True
+            settled_event = True
+        return self.result, settled_event
+
+    def invalidate(self):
+        """
+        Re-run match_fn on the next update without dropping the readings
+
+        For a new reference or color correction applied inside match_fn (the
+        readings must be raw). The settled event re-arms for the new result.
+        """
+        self.result = None
+        self.settled = False
+        self._stable = 0
+
+    def miss(self):
+        """Report a frame without the strip; resets after max_missing consecutive misses"""
+        self._missing += 1
+        if self._missing > self.max_missing and self.value is not None:
+            self.reset()
@@ -0,0 +1,192 @@
+import cv2
+import numpy as np
+
+# Pixels outside these per-pad lightness quantiles are treated as specular
+# highlights / shadows and dropped by the robust statistics
+HIGHLIGHT_QUANTILE = 0.95
+SHADOW_QUANTILE = 0.05
+
+
+def _inner_boxes(pads, roi_shape, inner=0.15):
+    """
+    Clip pad boxes to the ROI and shrink them to their inner region
+
+    Mirrors the per-pad slicing of the original loop: crop = roi[py:py+ph, px:px+pw],
+    inner = crop[int(inner*ch):int((1-inner)*ch), ...], falling back to the whole
+    crop when the inner region is empty.
+
+    Returns (N, 4) int array of x0, y0, x1, y1 (empty boxes have x1 <= x0 or y1 <= y0).
+    """
+    H, W = roi_shape[:2]
+    boxes = np.asarray(pads, dtype=np.int64).reshape(-1, 4)
+    px, py, pw, ph = boxes.T
+    # numpy slice semantics: negative starts count from the end, stops are clipped
+    x0 = np.clip(np.where(px < 0, px + W, px), 0, W)
+    y0 = np.clip(np.where(py < 0, py + H, py), 0, H)
+    x1 = np.clip(px + pw, 0, W)
+    y1 = np.clip(py + ph, 0, H)
+    cw = np.maximum(x1 - x0, 0)
+    ch = np.maximum(y1 - y0, 0)
+
+    ix0 = x0 + (inner * cw).astype(np.int64)
+    ix1 = x0 + ((1 - inner) * cw).astype(np.int64)
+    iy0 = y0 + (inner * ch).astype(np.int64)
+    iy1 = y0 + ((1 - inner) * ch).astype(np.int64)
+    inner_empty = (ix1 <= ix0) | (iy1 <= iy0)
+    ix0 = np.where(inner_empty, x0, ix0)
+    ix1 = np.where(inner_empty, x1, ix1)
+    iy0 = np.where(inner_empty, y0, iy0)
+    iy1 = np.where(inner_empty, y1, iy1)
+    return np.stack([ix0, iy0, ix1, iy1], axis=1)
+
+
+def _inner_means(strip_roi, pads, inner=0.15):
+    """
+    Mean BGR of the inner region of every pad, NaN rows for pads outside the ROI
+
+    cv2.mean on views of strip_roi, sliced like the original loop; per-pad
+    numpy box arithmetic costs more than it saves for a dozen pads.
+    """
+    means = np.full((len(pads), 3), np.nan)
+    for idx, (px, py, pw, ph) in enumerate(pads):
+        crop = strip_roi[py:py+ph, px:px+pw]
+        if crop.size == 0:
+            continue
+        ch, cw = crop.shape[:2]
+        sub = crop[int(inner*ch):int((1-inner)*ch), int(inner*cw):int((1-inner)*cw)]
+        if sub.size == 0:
+            sub = crop
+        means[idx] = cv2.mean(sub)[:3]
+    return means
+
+
+def _hist_quantile_index(cum, q_count):
+    """First bin whose cumulative count exceeds q_count, per row of cum"""
+    return np.argmax(cum > q_count[:, None], axis=1)
+
+
+def _robust_lab(lab, boxes, statistic, shadow_q, highlight_q):
+    """
+    Trimmed mean / median LAB of every box in one pass over the gathered pixels
+
+    LAB is uint8, so every per-pad quantile comes from a 256-bin histogram built
+    with a single bincount over (pad index, value). Pixels whose lightness falls
+    below the pad's shadow_q quantile or above its highlight_q quantile are
+    dropped; the statistic is computed from the remaining pixels the same way.
+    """
+    n = len(boxes)
+    out = np.full((n, 3), np.nan)
+    areas = np.maximum(boxes[:, 2] - boxes[:, 0], 0) * np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+    valid = np.flatnonzero(areas > 0)
+    if len(valid) == 0:
+        return out
+    m = len(valid)
+
+    pixels = np.concatenate([lab[y0:y1, x0:x1].reshape(-1, 3) for x0, y0, x1, y1 in boxes[valid]])
+    labels = np.repeat(np.arange(m), areas[valid])
+    offset = labels * 256
+
+    # per-pad lightness cut-offs
+    counts = areas[valid]
+    cum = np.cumsum(np.bincount(offset + pixels[:, 0], minlength=m * 256).reshape(m, 256), axis=1)
+    lo = _hist_quantile_index(cum, np.floor(shadow_q * counts).astype(np.int64))
+    hi = _hist_quantile_index(cum, np.ceil(highlight_q * counts).astype(np.int64) - 1)
+    L = pixels[:, 0]
+    keep = (L >= lo[labels]) & (L <= hi[labels])
+    pixels, labels, offset = pixels[keep], labels[keep], offset[keep]
+    kept = np.bincount(labels, minlength=m)
+
+    if statistic == "trimmed":
+        for c in range(3):
+            out[valid, c] = np.bincount(labels, weights=pixels[:, c], minlength=m) / kept
+        return out
+
+    # median: middle element(s) of each pad's per-channel histogram
+    for c in range(3):
+        cum = np.cumsum(np.bincount(offset + pixels[:, c], minlength=m * 256).reshape(m, 256), axis=1)
+        lower = _hist_quantile_index(cum, (kept - 1) // 2)
+        upper = _hist_quantile_index(cum, kept // 2)
+        out[valid, c] = (lower + upper) / 2.0
+    return out
+
+
+def sample_pad_colors(strip_roi, pads, inner=0.15, statistic="mean",
+                      shadow_q=SHADOW_QUANTILE, highlight_q=HIGHLIGHT_QUANTILE):
+    """
+    Sample the LAB color of every pad of a strip with one batched LAB conversion
+
+    Args:
+        strip_roi: BGR uint8 crop of the strip
+        pads: List of (x, y, w, h) pad boxes relative to strip_roi
+        inner: Fraction trimmed from each side of a pad to avoid its borders
+        statistic: "mean"    - mean BGR of each inner crop, converted to LAB together
+                               (same values as the per-pad cv2.mean loop)
+                   "trimmed" - mean LAB after dropping shadow/highlight pixels
+                   "median"  - per-channel median LAB after the same rejection
+        shadow_q, highlight_q: Per-pad lightness quantiles kept by the robust statistics
+
+    Returns:
+        (N, 3) float array of OpenCV LAB values (0..255 scale), NaN rows for pads
+        that fall outside the ROI
+    """
+    if len(pads) == 0:
+        return np.zeros((0, 3))
+
+    if statistic == "mean":
+        means = _inner_means(strip_roi, pads, inner)
+        empty = np.isnan(means).any(axis=1)
+        # np.uint8 truncation and a single batched LAB conversion for all pads
+        bgr = np.uint8(np.nan_to_num(means)).reshape(-1, 1, 3)
+        lab = cv2.cvtColor(bgr, cv2.COLOR_BGR2LAB).reshape(-1, 3).astype(float)
+        lab[empty] = np.nan
+        return lab
+
+    if statistic not in ("trimmed", "median"):
+        raise ValueError(f"Unknown pad statistic: {statistic}")
+    boxes = _inner_boxes(pads, strip_roi.shape, inner)
+    # one LAB conversion of the region covered by the pads
+    nonempty = (boxes[:, 2] > boxes[:, 0]) & (boxes[:, 3] > boxes[:, 1])
+    if not nonempty.any():
+        return np.full((len(boxes), 3), np.nan)
+    bx0, by0 = boxes[nonempty, :2].min(axis=0)
+    bx1, by1 = boxes[nonempty, 2:].max(axis=0)
+    lab = cv2.cvtColor(np.ascontiguousarray(strip_roi[by0:by1, bx0:bx1]), cv2.COLOR_BGR2LAB)
+    return _robust_lab(lab, boxes - [bx0, by0, bx0, by0], statistic, shadow_q, highlight_q)
+
+
+def _sample_pad_colors_loop(strip_roi, pads, inner=0.15):
+    """The original per-pad loop of urine_diagnosis.main (one LAB conversion per pad), for the benchmark"""
+    out = _inner_means(strip_roi, pads, inner)
+    for idx, mean_bgr in enumerate(out):
+        if not np.isnan(mean_bgr).any():
+            out[idx] = cv2.cvtColor(np.uint8([[mean_bgr]]), cv2.COLOR_BGR2LAB).reshape(3).astype(float)
+    return out
+
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(0)
+    # roughly the size of a strip crop from a 1080p frame
+    roi = rng.integers(0, 256, size=(1200, 160, 3), dtype=np.uint8)
+    pads = [(0, i * 120, 160, 120) for i in range(10)] + [(0, 1300, 160, 120)]
+
+    ref = _sample_pad_colors_loop(roi, pads)
+    fast = sample_pad_colors(roi, pads)
+    assert np.array_equal(np.isnan(ref), np.isnan(fast))
+    assert np.allclose(np.nan_to_num(ref), np.nan_to_num(fast), atol=1.0)
+    print(f"Max |loop - vectorized| on mean LAB: {np.nanmax(np.abs(ref - fast)):.2f}")
+
+    for name, fn in [("loop", lambda: _sample_pad_colors_loop(roi, pads)),
+                     ("mean", lambda: sample_pad_colors(roi, pads)),
+                     ("trimmed", lambda: sample_pad_colors(roi, pads, statistic="trimmed")),
+                     ("median", lambda: sample_pad_colors(roi, pads, statistic="median"))]:
+        # best of 5 rounds, so scheduler noise doesn't decide the comparison
+        runs = 200
+        best = float("inf")
+        for _ in range(5):
+            start = time.perf_counter()
+            for _ in range(runs):
+                fn()
+            best = min(best, (time.perf_counter() - start) / runs)
+        print(f"{name:8s}: {best * 1000:.3f} ms per strip")
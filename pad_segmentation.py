@@ -0,0 +1,203 @@
+import cv2
+import numpy as np
+
+# Length every strip's lightness profile is resampled to, so a batch of strips
+# of different sizes can be smoothed and searched as one (B, PROFILE_LEN) array
+PROFILE_LEN = 256
+
+
+def _even_split(h, w, expected_pads):
+    ph = h // expected_pads
+    return [(0, i*ph, w, ph if i < expected_pads-1 else h - i*ph) for i in range(expected_pads)]
+
+
+def strip_profiles(strips, profile_len=PROFILE_LEN):
+    """
+    Top-to-bottom lightness profile of every strip, resampled to profile_len
+
+    Each strip is downscaled by 2 (as the original segmentation did), converted
+    to LAB and its L channel averaged across the width.
+    """
+    profiles = np.empty((len(strips), profile_len), dtype=np.float32)
+    grid = np.linspace(0.0, 1.0, profile_len)
+    for i, strip in enumerate(strips):
+        h, w = strip.shape[:2]
+        small = cv2.resize(strip, (max(20, w//2), max(20, h//2)), interpolation=cv2.INTER_AREA)
+        L = cv2.cvtColor(small, cv2.COLOR_BGR2LAB)[:, :, 0]
+        proj = cv2.reduce(L, 1, cv2.REDUCE_AVG, dtype=cv2.CV_32F).ravel()
+        profiles[i] = np.interp(grid, np.linspace(0.0, 1.0, len(proj)), proj)
+    return profiles
+
+
+def find_local_minima(profiles, window):
+    """
+    O(n) local minima of every row of a (B, n) profile array
+
+    Returns a boolean (B, n) mask of minima and a (B, n) depth array: the
+    difference between the highest value within +-window/2 and the value
+    itself (a cheap prominence estimate computed with one running-max pass).
+    """
+    s = profiles
+    mask = np.zeros(s.shape, dtype=bool)
+    # strict on the left, non-strict on the right: a flat-bottomed valley yields one minimum
+    mask[:, 1:-1] = (s[:, 1:-1] < s[:, :-2]) & (s[:, 1:-1] <= s[:, 2:])
+    window = max(3, int(window) | 1)
+    running_max = cv2.dilate(s, np.ones((1, window), np.uint8), borderType=cv2.BORDER_REPLICATE)
+    return mask, running_max - s
+
+
+def segment_pads_batch(strips, expected_pads=10, profile_len=PROFILE_LEN, sigma=3.0,
+                       min_depth=2.0, min_separation=0.6):
+    """
+    Split a batch of cropped strip ROIs into pad boxes
+
+    All profiles are smoothed with a single Gaussian pass and searched for local
+    minima (pads are darker than the strip backing) in one vectorized step. For
+    each strip the expected_pads deepest minima that are at least
+    min_separation * pad pitch apart become the pad centers; strips where not
+    enough minima are found fall back to an even top-to-bottom split.
+
+    Args:
+        strips: List of BGR strip crops (any sizes)
+        expected_pads: Number of pads on the strip
+        profile_len: Resampled profile length
+        sigma: Gaussian smoothing in profile samples
+        min_depth: Minimum valley depth in L units (0..255 scale)
+        min_separation: Minimum distance between pad centers relative to the pad pitch
+
+    Returns:
+        One list of (x, y, w, h) pad boxes per strip, top to bottom, same contract
+        as segment_strip_into_pads()
+    """
+    if len(strips) == 0:
+        return []
+    profiles = strip_profiles(strips, profile_len)
+    ksize = int(6 * sigma) | 1
+    smooth = cv2.GaussianBlur(profiles, (ksize, 1), sigmaX=sigma, sigmaY=0,
+                              borderType=cv2.BORDER_REPLICATE)
+    pitch = profile_len / expected_pads
+    minima, depth = find_local_minima(smooth, pitch)
+    depth = np.where(minima & (depth >= min_depth), depth, 0.0)
+
+    results = []
+    min_gap = min_separation * pitch
+    for i, strip in enumerate(strips):
+        h, w = strip.shape[:2]
+        candidates = np.flatnonzero(depth[i])
+        centers = []
+        # deepest first, skipping minima too close to an accepted one
+        for c in candidates[np.argsort(-depth[i, candidates], kind='stable')]:
+            if all(abs(c - a) >= min_gap for a in centers):
+                centers.append(c)
+                if len(centers) == expected_pads:
+                    break
+        if len(centers) < expected_pads:
+            results.append(_even_split(h, w, expected_pads))
+            continue
+        pad_half = int(h/(2*expected_pads))
+        pads = []
+        for c in sorted(centers):
+            cy = int(c * (h / profile_len))
+            y0 = max(0, cy - pad_half)
+            y1 = min(h, cy + pad_half)
+            pads.append((0, y0, w, y1-y0))
+        results.append(pads)
+    return results
+
+
+def _segment_strip_legacy(strip_img, expected_pads=10):
+    """
+    Previous implementation of segment_strip_into_pads, kept for the benchmark
+
+    It called skimage.measure.find_peaks_cwt, which does not exist (the function
+    lives in scipy.signal), so every strip that got past the gradient check
+    raised AttributeError. scipy's version is used here to time what it meant.
+    """
+    from skimage import filters
+    from scipy.signal import find_peaks_cwt
+    h, w = strip_img.shape[:2]
+    small = cv2.resize(strip_img, (max(20, w//2), max(20, h//2)))
+    lab = cv2.cvtColor(small, cv2.COLOR_BGR2LAB)
+    L = lab[:,:,0].astype(float)
+    proj = np.mean(L, axis=1)
+    smooth = filters.gaussian(proj, sigma=3)
+    grad = np.abs(np.gradient(smooth))
+    thr = np.mean(grad) + 0.5*np.std(grad)
+    idxs = np.where(grad > thr)[0]
+    idxs_full = sorted(list(set([int(i*(h/smooth.shape[0])) for i in idxs])))
+    if len(idxs_full) < expected_pads-1:
+        return _even_split(h, w, expected_pads)
+    minima = find_peaks_cwt(-smooth, widths=np.arange(3,25))
+    minima_coords = [int(m*(h/smooth.shape[0])) for m in minima if 0 < m < smooth.shape[0]]
+    if len(minima_coords) >= expected_pads:
+        minima_coords = minima_coords[:expected_pads]
+        pad_half = int(h/(2*expected_pads))
+        return [(0, max(0, c - pad_half), w, min(h, c + pad_half) - max(0, c - pad_half))
+                for c in minima_coords]
+    return _even_split(h, w, expected_pads)
+
+
+def _synthetic_strip(rng, expected_pads=10):
+    """White strip with darker colored pads at jittered positions; returns (img, true centers)"""
+    h = int(rng.integers(300, 900))
+    w = int(rng.integers(30, 120))
+    img = np.full((h, w, 3), 235, np.uint8)
+    pitch = h / expected_pads
+    pad_h = int(pitch * 0.6)
+    centers = []
+    for k in range(expected_pads):
+        cy = int((k + 0.5) * pitch + rng.uniform(-0.1, 0.1) * pitch)
+        color = rng.integers(40, 200, size=3).tolist()
+        cv2.rectangle(img, (2, cy - pad_h//2), (w - 3, cy + pad_h//2), color, -1)
+        centers.append(cy)
+    noise = rng.normal(0, 6, img.shape)
+    img = np.clip(img + noise, 0, 255).astype(np.uint8)
+    return img, np.array(centers)
+
+
+if __name__ == "__main__":
+    import time
+
+    rng = np.random.default_rng(0)
+    strips, truth = zip(*[_synthetic_strip(rng) for _ in range(1000)])
+
+    def score(results):
+        hits = fallbacks = 0
+        for pads, centers, strip in zip(results, truth, strips):
+            if pads == _even_split(strip.shape[0], strip.shape[1], len(centers)):
+                fallbacks += 1
+            found = np.array([y + h / 2 for _, y, _, h in pads])
+            pitch = strip.shape[0] / len(centers)
+            hits += int(np.all(np.abs(found - centers) < 0.25 * pitch))
+        return hits, fallbacks
+
+    # per-strip latency
+    runs = 200
+    start = time.perf_counter()
+    for i in range(runs):
+        segment_pads_batch([strips[i]])
+    single_ms = (time.perf_counter() - start) / runs * 1000
+    print(f"Per strip (batch of 1):   {single_ms:.3f} ms")
+
+    # whole batch in one call
+    start = time.perf_counter()
+    results = segment_pads_batch(list(strips))
+    batch_s = time.perf_counter() - start
+    hits, fallbacks = score(results)
+    print(f"Batch of {len(strips)} crops:     {batch_s*1000:.1f} ms "
+          f"({batch_s/len(strips)*1000:.3f} ms/strip), all pads located: {hits}/{len(strips)}, "
+          f"even-split fallbacks: {fallbacks}")
+
+    try:
+        import skimage  # noqa: F401
+        import scipy  # noqa: F401
+    except ImportError:
+        print("scikit-image/scipy not installed; skipping the legacy comparison")
+    else:
+        n_legacy = 100
+        start = time.perf_counter()
+        legacy = [_segment_strip_legacy(s) for s in strips[:n_legacy]]
+        legacy_ms = (time.perf_counter() - start) / n_legacy * 1000
+        hits, fallbacks = score(legacy)
+        print(f"Legacy (skimage, {n_legacy} crops): {legacy_ms:.3f} ms/strip, "
+              f"all pads located: {hits}/{n_legacy}, even-split fallbacks: {fallbacks}")
@@ -0,0 +1,157 @@
+import time
+
+# Quality levels from best to cheapest:
+# (inference imgsz, run detection every Nth frame, run diagnosis every Nth frame)
+QUALITY_LEVELS = [
+    (640, 1, 1),
+    (512, 1, 2),
+    (416, 2, 3),
+    (320, 2, 5),
+    (320, 3, 8),
+]
+
+
+def quality_sizes(levels=QUALITY_LEVELS):
+    """Distinct inference sizes of a quality ladder, largest first (the sizes to warm up)"""
+    return tuple(sorted({level[0] for level in levels}, reverse=True))
+
+
+class AdaptiveQualityController:
+    """
+    Feedback controller that holds a target FPS (or per-frame latency) in a live loop
+
+    The loop reports how long each stage took (record()) and the measured FPS
+    (update()). When the frame budget is exceeded the controller steps down to
+    a cheaper quality level (smaller inference size, detection on fewer frames,
+    less frequent diagnosis); when there is headroom again it steps back up.
+    A cooldown between changes keeps it from oscillating.
+    """
+
+    def __init__(self, target_fps=None, target_latency_ms=None, levels=QUALITY_LEVELS,
+                 start_level=0, headroom=0.7, tolerance=0.9, cooldown_s=2.0, smoothing=0.3):
+        """
+        Args:
+            target_fps: FPS to hold (used when target_latency_ms is None)
+            target_latency_ms: Per-frame processing budget in milliseconds
+            levels: List of (imgsz, detect_every, diagnose_every), best quality first
+            start_level: Index of the initial level
+            headroom: Recover a level when load < headroom (load = frame cost / budget)
+            tolerance: Degrade when measured FPS < tolerance * target_fps
+            cooldown_s: Minimum time between two level changes
+            smoothing: EMA factor for stage latencies
+        """
+        if target_fps is None and target_latency_ms is None:
+            raise ValueError("Set target_fps or target_latency_ms")
+        self.target_fps = target_fps
+        self.budget_s = (target_latency_ms / 1000.0) if target_latency_ms is not None else 1.0 / target_fps
+        self.levels = list(levels)
+        self.level = min(max(0, start_level), len(self.levels) - 1)
+        self.headroom = headroom
+        self.tolerance = tolerance
+        self.cooldown_s = cooldown_s
+        self.smoothing = smoothing
+        self.stage_ms = {}      # stage name -> EMA of latency in ms
+        self.frame_cost_s = None  # EMA of total processing time per frame
+        self.history = []       # (timestamp, old_level, new_level, reason)
+        self._frame_cost = 0.0
+        self._last_change = 0.0
+
+    @property
+    def imgsz(self):
+        return self.levels[self.level][0]
+
+    @property
+    def sizes(self):
+        """Every inference size the controller may switch to; warm the model up at all of
+        them, or the first frame at a new size looks slow and triggers another step down"""
+        return quality_sizes(self.levels)
+
+    @property
+    def detect_every(self):
+        return self.levels[self.level][1]
+
+    @property
+    def diagnose_every(self):
+        return self.levels[self.level][2]
+
+    def should_detect(self, frame_index):
+        return frame_index % self.detect_every == 0
+
+    def should_diagnose(self, frame_index):
+        return frame_index % self.diagnose_every == 0
+
+    def record(self, stage, seconds):
+        """Report the latency of one stage of the current frame"""
+        ms = seconds * 1000.0
+        prev = self.stage_ms.get(stage)
+        self.stage_ms[stage] = ms if prev is None else prev + self.smoothing * (ms - prev)
+        self._frame_cost += seconds
+
+    def end_frame(self):
+        """Close the current frame: fold the summed stage latencies into the frame cost"""
+        cost = self._frame_cost
+        self._frame_cost = 0.0
+        if self.frame_cost_s is None:
+            self.frame_cost_s = cost
+        else:
+            self.frame_cost_s += self.smoothing * (cost - self.frame_cost_s)
+
+    @property
+    def load(self):
+        """Average frame processing cost relative to the budget (>1 means too slow)"""
+        if self.frame_cost_s is None:
+            return 0.0
+        return self.frame_cost_s / self.budget_s
+
+    def _relative_cost(self, level):
+        """Detection work per frame of a level: input pixels / frames between detections"""
+        imgsz, detect_every, _ = self.levels[level]
+        return imgsz * imgsz / detect_every
+
+    def predicted_load(self, level):
+        """Load expected at another level, scaling the current cost by the work per frame"""
+        return self.load * self._relative_cost(level) / self._relative_cost(self.level)
+
+    def update(self, fps=None):
+        """
+        Re-evaluate the quality level; call this whenever a new FPS value is available
+
+        Returns True when the level changed.
+        """
+        now = time.time()
+        if now - self._last_change < self.cooldown_s:
+            return False
+
+        load = self.load
+        too_slow = load > 1.0
+        if fps is not None and self.target_fps is not None:
+            # FPS below target only counts when our own processing is the bottleneck
+            # (not e.g. a camera capped below the target)
+            too_slow = too_slow or (fps < self.tolerance * self.target_fps and load > self.headroom)
+
+        if too_slow and self.level < len(self.levels) - 1:
+            reason = f"load {load:.2f}" + (f", fps {fps:.1f}" if fps is not None else "")
+            return self._set_level(self.level + 1, reason, now)
+        if not too_slow and self.level > 0:
+            # Recover only when the better level itself is expected to fit in the headroom,
+            # otherwise it is too slow again after the cooldown and the levels flap
+            predicted = self.predicted_load(self.level - 1)
+            if predicted < self.headroom:
+                return self._set_level(self.level - 1,
+                                       f"headroom, load {load:.2f} -> {predicted:.2f}", now)
+        return False
+
+    def _set_level(self, new_level, reason, now):
+        old = self.level
+        if self.frame_cost_s is not None:
+            # Reseed the cost for the new level so the next decision doesn't use the old one's
+            self.frame_cost_s *= self._relative_cost(new_level) / self._relative_cost(old)
+        self.level = new_level
+        self._last_change = now
+        self.history.append((now, old, new_level, reason))
+        direction = "Degrading" if new_level > old else "Recovering"
+        imgsz, detect_every, diagnose_every = self.levels[new_level]
+        stages = ", ".join(f"{k}={v:.1f}ms" for k, v in self.stage_ms.items())
+        print(f"[quality] {direction} {old} -> {new_level} ({reason}): imgsz={imgsz}, "
+              f"detect every {detect_every}, diagnose every {diagnose_every} [{stages}]")
+        return True
@@ -0,0 +1,181 @@
+from ultralytics import YOLO
+import cv2
+import numpy as np
+import time
+import os
+import csv
+
+FP32_MODEL_PATH = 'runs/detect/train/weights/best.pt'
+REPORT_DIR = 'runs/quantize'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+def _path_size_mb(path):
+    """Size of a weights file or an exported model directory in MB"""
+    if os.path.isfile(path):
+        return os.path.getsize(path) / (1024 * 1024)
+    total = 0
+    for root, _, files in os.walk(path):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total / (1024 * 1024)
+
+
+def _rss_mb():
+    """Resident memory of this process in MB (None when psutil is missing)"""
+    try:
+        import psutil
+    except ImportError:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024)
+
+
+def _test_images(data_yaml):
+    """Resolve the test image directory from data.yaml"""
+    import yaml
+    with open(data_yaml) as f:
+        data = yaml.safe_load(f)
+    test_dir = data.get('test')
+    if not test_dir or not os.path.isdir(test_dir):
+        raise FileNotFoundError(f"Test split not found (data.yaml 'test': {test_dir})")
+    return [os.path.join(test_dir, f) for f in sorted(os.listdir(test_dir))
+            if f.lower().endswith(IMAGE_EXTENSIONS)]
+
+
+def benchmark_model(model_path, data_yaml='data.yaml', imgsz=640, max_images=50, warmup=3):
+    """
+    Evaluate one model variant on the test split and time CPU inference
+
+    Args:
+        model_path: .pt weights or an exported model directory
+        data_yaml: Dataset description (the 'test' split is used)
+        imgsz: Inference size
+        max_images: Number of test images used for latency timing
+        warmup: Untimed inferences before measuring
+
+    Returns:
+        dict with mAP50, mAP50-95, latency (ms) and memory figures
+    """
+    rss_before = _rss_mb()
+    model = YOLO(model_path, task='detect')
+
+    metrics = model.val(data=data_yaml, split='test', imgsz=imgsz, device='cpu',
+                        plots=False, verbose=False)
+
+    images = [cv2.imread(p) for p in _test_images(data_yaml)[:max_images]]
+    images = [img for img in images if img is not None]
+    if not images:
+        raise RuntimeError("No readable test images found for latency timing")
+
+    for _ in range(warmup):
+        model.predict(images[0], imgsz=imgsz, device='cpu', verbose=False)
+
+    latencies = []
+    for img in images:
+        start = time.perf_counter()
+        model.predict(img, imgsz=imgsz, device='cpu', verbose=False)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+    rss_after = _rss_mb()
+
+    return {
+        'model': model_path,
+        'map50': float(metrics.box.map50),
+        'map50_95': float(metrics.box.map),
+        'latency_ms_median': float(np.median(latencies)),
+        'latency_ms_p95': float(np.percentile(latencies, 95)),
+        'model_size_mb': _path_size_mb(model_path),
+        'rss_delta_mb': (rss_after - rss_before) if rss_before is not None else None,
+    }
+
+
+def export_int8(model_path=FP32_MODEL_PATH, data_yaml='data.yaml', imgsz=640):
+    """
+    Export an OpenVINO INT8 model. Calibration images come from the 'val'
+    split of data.yaml (datasets-for-local-training/valid).
+
+    Returns the path of the exported model directory, which can be passed
+    straight to UrineStripDetector(model_path=...).
+    """
+    model = YOLO(model_path)
+    print(f"Exporting INT8 OpenVINO model (calibration data: {data_yaml} 'val' split)...")
+    exported = model.export(format='openvino', int8=True, data=data_yaml,
+                            imgsz=imgsz, device='cpu')
+    print(f"✓ INT8 model exported to: {exported}")
+    return exported
+
+
+def write_report(rows, target_ms, report_dir=REPORT_DIR):
+    """Print the accuracy/latency table and save it as CSV and Markdown"""
+    os.makedirs(report_dir, exist_ok=True)
+    baseline = rows[0]
+    header = ['Model', 'mAP50', 'ΔmAP50', 'mAP50-95', 'Latency median (ms)',
+              'Latency p95 (ms)', 'Size (MB)', 'RSS Δ (MB)', f'< {target_ms:g} ms']
+    table = []
+    for r in rows:
+        rss = f"{r['rss_delta_mb']:.1f}" if r['rss_delta_mb'] is not None else "n/a"
+        table.append([
+            os.path.basename(os.path.normpath(r['model'])),
+            f"{r['map50']:.4f}",
+            f"{r['map50'] - baseline['map50']:+.4f}",
+            f"{r['map50_95']:.4f}",
+            f"{r['latency_ms_median']:.1f}",
+            f"{r['latency_ms_p95']:.1f}",
+            f"{r['model_size_mb']:.1f}",
+            rss,
+            "yes" if r['latency_ms_median'] < target_ms else "no",
+        ])
+
+    csv_path = os.path.join(report_dir, 'quantization_report.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(header)
+        writer.writerows(table)
+
+    md_path = os.path.join(report_dir, 'quantization_report.md')
+    with open(md_path, 'w') as f:
+        f.write("| " + " | ".join(header) + " |\n")
+        f.write("|" + "|".join([":---"] * len(header)) + "|\n")
+        for row in table:
+            f.write("| " + " | ".join(row) + " |\n")
+
+    print("\n" + "="*60)
+    print("QUANTIZATION REPORT (CPU)")
+    print("="*60)
+    with open(md_path) as f:
+        print(f.read())
+    print(f"📁 Report saved to: {csv_path}")
+    print(f"📁 Report saved to: {md_path}")
+
+
+def quantize_urine_strip_detector(model_path=FP32_MODEL_PATH, data_yaml='data.yaml',
+                                  imgsz=640, target_ms=30.0, max_images=50):
+    """Export INT8, evaluate it against the FP32 weights and write the report"""
+    if not os.path.exists(model_path):
+        print(f"ERROR: FP32 model not found at: {model_path}")
+        print("Please train the model first using: python train_model.py")
+        return None
+
+    int8_path = export_int8(model_path, data_yaml, imgsz)
+
+    rows = []
+    for path in (model_path, int8_path):
+        print(f"\nEvaluating {path} on the test split...")
+        rows.append(benchmark_model(path, data_yaml, imgsz, max_images))
+
+    write_report(rows, target_ms)
+    print("\nUse the quantized model with:")
+    print(f"  UrineStripDetector(model_path=\"{int8_path}\")")
+    return rows
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="INT8 post-training quantization for the urine strip detector")
+    parser.add_argument('--model', default=FP32_MODEL_PATH, help="FP32 weights (best.pt)")
+    parser.add_argument('--data', default='data.yaml', help="Dataset yaml (val = calibration, test = evaluation)")
+    parser.add_argument('--imgsz', type=int, default=640)
+    parser.add_argument('--target-ms', type=float, default=30.0, help="Per-frame CPU latency target")
+    parser.add_argument('--max-images', type=int, default=50, help="Test images used for latency timing")
+    args = parser.parse_args()
+
+    quantize_urine_strip_detector(args.model, args.data, args.imgsz, args.target_ms, args.max_images)
@@ -0,0 +1,225 @@
+import time
+import numpy as np
+from color_metrics import ciede2000, ciede2000_bound_scales, opencv_lab_to_cielab
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:  # scipy is optional: fall back to a linear scan
+    cKDTree = None
+
+
+class _LinearTree:
+    """Brute-force stand-in for cKDTree (query / query_ball_point only)"""
+
+    def __init__(self, data):
+        self.data = np.asarray(data, dtype=np.float64)
+
+    def query(self, x, k=1):
+        d = np.linalg.norm(self.data - x, axis=1)
+        idx = np.argsort(d, kind="stable")[:k]
+        return d[idx], idx
+
+    def query_ball_point(self, x, r):
+        return np.flatnonzero(np.linalg.norm(self.data - x, axis=1) <= r)
+
+
+def _build_tree(points):
+    return cKDTree(points) if cKDTree is not None else _LinearTree(points)
+
+
+class ReferenceIndex:
+    """
+    Nearest reference level search over a large swatch library
+
+    All swatches (any number of brands/lots, analytes and levels) are stored
+    once in CIELAB, with a KD-tree over all of them and one per analyte. The
+    trees hold axis-scaled LAB coordinates in which Euclidean distance is a
+    lower bound of CIEDE2000 for the colors involved (see
+    color_metrics.ciede2000_bound_scales). A query takes the k nearest
+    swatches in that space and scores them with CIEDE2000; every swatch that
+    could still beat the best of them lies within that distance in the tree,
+    so one ball query fetches all remaining candidates and an exact rerank
+    gives the same result as a full CIEDE2000 scan.
+
+    Inputs are OpenCV 8-bit LAB by default (space="opencv") and converted to
+    CIELAB before indexing; distances are CIEDE2000 on CIELAB values. Pass
+    space="cielab" for values that are already decoded.
+    """
+
+    def __init__(self, labs, analytes, labels, sources=None, space="opencv", k=4, linear_below=256):
+        """
+        Args:
+            labs: (K, 3) swatch colors
+            analytes, labels: K analyte names and level labels
+            sources: K brand/lot identifiers (optional)
+            space: "opencv" or "cielab", the encoding of labs and of query colors
+            k: Nearest Euclidean candidates scored before the ball query
+            linear_below: Groups with fewer swatches are scanned directly (one
+                          vectorized CIEDE2000 call beats the tree there)
+        """
+        if space not in ("opencv", "cielab"):
+            raise ValueError(f"Unknown LAB space: {space}")
+        self.space = space
+        self.k = k
+        self.linear_below = linear_below
+        self.labs = self._decode(np.asarray(labs, dtype=np.float64).reshape(-1, 3))
+        self.analytes = list(analytes)
+        self.labels = list(labels)
+        self.sources = list(sources) if sources is not None else [None] * len(self.labels)
+        if not (len(self.labs) == len(self.analytes) == len(self.labels) == len(self.sources)):
+            raise ValueError("labs, analytes, labels and sources must have the same length")
+        self.stats = {'queries': 0, 'candidates': 0}
+
+        self._groups = {None: self._group(np.arange(len(self.labs)))}
+        by_analyte = {}
+        for i, analyte in enumerate(self.analytes):
+            by_analyte.setdefault(analyte, []).append(i)
+        for analyte, idx in by_analyte.items():
+            self._groups[analyte] = self._group(np.array(idx))
+
+    def _decode(self, labs):
+        return opencv_lab_to_cielab(labs) if self.space == "opencv" else labs
+
+    def _group(self, idx):
+        labs = self.labs[idx]
+        max_l_dev = float(np.abs(labs[:, 0] - 50).max()) if len(idx) else 0.0
+        max_chroma = float(np.hypot(labs[:, 1], labs[:, 2]).max()) if len(idx) else 0.0
+        scale = np.array(ciede2000_bound_scales(max_l_dev, max_chroma))[[0, 1, 1]]
+        return {
+            'idx': idx,
+            'tree': _build_tree(labs * scale) if len(idx) >= max(self.linear_below, 1) else None,
+            'scale': scale,
+            'max_l_dev': max_l_dev,
+            'max_chroma': max_chroma,
+        }
+
+    @classmethod
+    def from_mapping(cls, mapping, source=None, **kwargs):
+        """Index a calibration mapping analyte -> [(label, lab), ...]"""
+        return cls.from_mappings({source: mapping}, **kwargs)
+
+    @classmethod
+    def from_mappings(cls, mappings, **kwargs):
+        """Index several mappings, e.g. {brand/lot: mapping}"""
+        labs, analytes, labels, sources = [], [], [], []
+        for source, mapping in mappings.items():
+            for analyte, levels in mapping.items():
+                for label, lab in levels:
+                    labs.append(np.asarray(lab, dtype=np.float64))
+                    analytes.append(analyte)
+                    labels.append(label)
+                    sources.append(source)
+        return cls(np.array(labs).reshape(-1, 3), analytes, labels, sources, **kwargs)
+
+    def __len__(self):
+        return len(self.labs)
+
+    def query(self, lab, analyte=None):
+        """
+        Best matching swatch for one color
+
+        Args:
+            lab: Query color (in the index's input space)
+            analyte: Restrict the search to this analyte's swatches (None: all)
+
+        Returns:
+            (index, distance) into the swatch arrays, (None, inf) when nothing matches
+        """
+        group = self._groups.get(analyte)
+        q = self._decode(np.asarray(lab, dtype=np.float64).reshape(3))
+        if group is None or not len(group['idx']) or np.isnan(q).any():
+            return None, float('inf')
+        if group['tree'] is None:
+            return self.brute_force(lab, analyte)
+        idx, tree, scale = group['idx'], group['tree'], group['scale']
+
+        _, near = tree.query(q * scale, k=min(self.k, len(idx)))
+        near = np.atleast_1d(near)
+        best = float(ciede2000(q, self.labs[idx[near]]).min())
+
+        # a query outside the library's L / chroma range loosens the bound
+        l_scale, ab_scale = ciede2000_bound_scales(max(abs(q[0] - 50), group['max_l_dev']),
+                                                   max(float(np.hypot(q[1], q[2])), group['max_chroma']))
+        ratio = min(l_scale / scale[0], ab_scale / scale[1])
+        # small slack: the ball query must not lose the boundary swatch to rounding
+        cand = np.sort(tree.query_ball_point(q * scale, best / ratio * (1 + 1e-9) + 1e-9))
+        self.stats['queries'] += 1
+        self.stats['candidates'] += len(cand)
+        d = ciede2000(q, self.labs[idx[cand]])
+        j = int(np.argmin(d))
+        return int(idx[cand[j]]), float(d[j])
+
+    def match(self, pad_labs, analytes):
+        """
+        Per-pad best level, like urine_diagnosis.match_pad_labs
+
+        Returns analyte -> (best_label, distance), (None, inf) for missing pads.
+        """
+        results = {}
+        for analyte, lab in zip(analytes, pad_labs):
+            i, d = self.query(lab, analyte)
+            results[analyte] = (self.labels[i] if i is not None else None, d)
+        return results
+
+    def brute_force(self, lab, analyte=None):
+        """Full CIEDE2000 scan, for verification"""
+        group = self._groups.get(analyte)
+        q = self._decode(np.asarray(lab, dtype=np.float64).reshape(3))
+        if group is None or not len(group['idx']) or np.isnan(q).any():
+            return None, float('inf')
+        d = ciede2000(q, self.labs[group['idx']])
+        j = int(np.argmin(d))
+        return int(group['idx'][j]), float(d[j])
+
+
+def _synthetic_library(rng, brands=40, analytes=10, levels=8, jitter=6.0):
+    """Library of `brands` strip brands/lots whose swatches vary around shared level colors (OpenCV LAB)"""
+    base = rng.uniform([60, 90, 90], [240, 180, 200], size=(analytes, levels, 3))
+    mappings = {}
+    for b in range(brands):
+        shift = rng.normal(0, jitter, size=(analytes, levels, 3))
+        mappings[f"brand{b:02d}"] = {
+            f"A{a}": [(f"L{l}", np.clip(base[a, l] + shift[a, l], 0, 255)) for l in range(levels)]
+            for a in range(analytes)
+        }
+    return mappings
+
+
+if __name__ == "__main__":
+    # Benchmark and consistency check against a full CIEDE2000 scan
+    from urine_diagnosis import ciede2000 as scalar_ciede2000
+
+    rng = np.random.default_rng(0)
+    a, b = rng.uniform(0, 255, (2, 2000, 3))
+    ref = np.array([scalar_ciede2000(x, y) for x, y in zip(a, b)])
+    print(f"Vectorized vs scalar CIEDE2000: max abs diff {np.abs(ciede2000(a, b) - ref).max():.2e}")
+
+    mappings = _synthetic_library(rng, brands=200)
+    index = ReferenceIndex.from_mappings(mappings)
+    # pad readings: library swatches seen with sensor noise and lighting error
+    pick = rng.integers(0, len(index), 2000)
+    queries = np.clip(index.labs[pick] * [2.55, 1, 1] + [0, 128, 128] + rng.normal(0, 4, (2000, 3)), 0, 255)
+    query_analytes = [index.analytes[i] for i in pick]
+    print(f"Library: {len(index)} swatches ({'cKDTree' if cKDTree is not None else 'linear scan'})")
+
+    for analyte_filter in (False, True):
+        scope = "per analyte" if analyte_filter else "whole library"
+        an = query_analytes if analyte_filter else [None] * len(queries)
+        start = time.perf_counter()
+        brute = [index.brute_force(q, x) for q, x in zip(queries, an)]
+        t_brute = (time.perf_counter() - start) / len(queries) * 1e3
+        index.stats = {'queries': 0, 'candidates': 0}
+        start = time.perf_counter()
+        fast = [index.query(q, x) for q, x in zip(queries, an)]
+        t_fast = (time.perf_counter() - start) / len(queries) * 1e3
+        mismatches = sum(f[0] != r[0] or abs(f[1] - r[1]) > 1e-9 for f, r in zip(fast, brute))
+        print(f"{scope}: full scan {t_brute:.3f} ms/query, index {t_fast:.3f} ms/query, "
+              f"{index.stats['candidates'] / max(index.stats['queries'], 1):.1f} candidates reranked, "
+              f"{mismatches} mismatches")
+
+    # the linear scalar scan of match_lab_to_levels, over the whole library
+    start = time.perf_counter()
+    for q in opencv_lab_to_cielab(queries[:20]):
+        min(index.labs, key=lambda lab: scalar_ciede2000(q, lab))
+    print(f"Scalar linear scan (match_lab_to_levels style), whole library: "
+          f"{(time.perf_counter() - start) / 20 * 1e3:.3f} ms/query")
@@ -0,0 +1,243 @@
+import os
+import json
+import struct
+import tempfile
+import contextlib
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: concurrent add/remove are not serialized
+    fcntl = None
+
+# File layout (little endian):
+#   MAGIC (8 bytes) | format version (uint32) | header length (uint32) | JSON header
+#   | zero padding to DATA_ALIGN | float32 swatch array (swatch_count, 3)
+# The header indexes the swatch rows: chart (brand/lot) -> analyte -> [start, start + count).
+MAGIC = b"KAELREF\0"
+FORMAT_VERSION = 1
+DATA_ALIGN = 64
+_PREFIX = struct.Struct("<8sII")
+
+DEFAULT_LIBRARY_PATH = os.environ.get(
+    "KAELION_REFERENCE_LIBRARY",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "reference_library.klib"))
+
+
+def write_library(path, charts):
+    """
+    Write a complete library file, atomically
+
+    Args:
+        path: Output file
+        charts: List of dicts with 'id', 'mapping' (analyte -> [(label, lab), ...],
+                OpenCV LAB) and optional 'brand', 'lot'
+
+    The file is written next to path and moved into place with os.replace, so
+    readers either see the old or the new library; processes that already
+    mapped the old file keep reading it until they reopen.
+    """
+    ids = [c['id'] for c in charts]
+    if len(set(ids)) != len(ids):
+        raise ValueError("Duplicate chart ids in library")
+    header_charts, rows = [], []
+    for chart in charts:
+        analytes = []
+        for analyte, levels in chart['mapping'].items():
+            analytes.append({'name': analyte, 'start': len(rows), 'count': len(levels),
+                             'labels': [str(label) for label, _ in levels]})
+            rows.extend(np.asarray(lab, dtype=np.float32).reshape(3) for _, lab in levels)
+        header_charts.append({'id': chart['id'], 'brand': chart.get('brand'), 'lot': chart.get('lot'),
+                              'analytes': analytes})
+    swatches = np.array(rows, dtype='<f4').reshape(-1, 3)
+
+    header = {'swatch_count': len(swatches), 'charts': header_charts}
+    blob = json.dumps(header).encode("utf-8")
+    data_offset = -(-(_PREFIX.size + len(blob)) // DATA_ALIGN) * DATA_ALIGN
+    fd, tmp = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(_PREFIX.pack(MAGIC, FORMAT_VERSION, len(blob)))
+            f.write(blob)
+            f.write(b"\0" * (data_offset - _PREFIX.size - len(blob)))
+            f.write(swatches.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file 0600; workers running as other users must read it.
+        # A fixed mode: reading the umask means setting it, which races with other threads
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return path
+
+
+class ReferenceLibrary:
+    """
+    Read-only view of a reference library file
+
+    The swatch array is memory-mapped, not loaded: opening is a header read,
+    and every process that opens the same file shares one copy of it through
+    the page cache. Mappings returned by mapping() hold views into the map.
+    """
+
+    def __init__(self, path=DEFAULT_LIBRARY_PATH):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, version, header_len = _PREFIX.unpack(f.read(_PREFIX.size))
+            if magic != MAGIC:
+                raise ValueError(f"Not a reference library file: {path}")
+            if version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported reference library version {version} in {path}")
+            header = json.loads(f.read(header_len).decode("utf-8"))
+        self._charts = {c['id']: c for c in header['charts']}
+        count = header['swatch_count']
+        data_offset = -(-(_PREFIX.size + header_len) // DATA_ALIGN) * DATA_ALIGN
+        if count:
+            self.swatches = np.memmap(path, dtype='<f4', mode='r', offset=data_offset, shape=(count, 3))
+        else:
+            self.swatches = np.empty((0, 3), dtype='<f4')
+        self._index = None
+
+    @property
+    def charts(self):
+        return list(self._charts)
+
+    def __len__(self):
+        return len(self.swatches)
+
+    def chart_info(self, chart_id):
+        """Brand, lot and analyte -> level count of one chart"""
+        chart = self._charts[chart_id]
+        return {'id': chart_id, 'brand': chart['brand'], 'lot': chart['lot'],
+                'analytes': {a['name']: a['count'] for a in chart['analytes']}}
+
+    def mapping(self, chart_id):
+        """Calibration mapping analyte -> [(label, lab), ...] of one chart (labs are views into the file)"""
+        mapping = {}
+        for a in self._charts[chart_id]['analytes']:
+            rows = self.swatches[a['start']:a['start'] + a['count']]
+            mapping[a['name']] = list(zip(a['labels'], rows))
+        return mapping
+
+    def mappings(self):
+        return {chart_id: self.mapping(chart_id) for chart_id in self._charts}
+
+    def index(self, **kwargs):
+        """ReferenceIndex over all charts, built on first use (swatch sources are chart ids)"""
+        if self._index is None:
+            from reference_index import ReferenceIndex
+            analytes, labels, sources = [], [], []
+            for chart_id, chart in self._charts.items():
+                for a in chart['analytes']:
+                    analytes.extend([a['name']] * a['count'])
+                    labels.extend(a['labels'])
+                    sources.extend([chart_id] * a['count'])
+            self._index = ReferenceIndex(self.swatches, analytes, labels, sources, **kwargs)
+        return self._index
+
+    def to_charts(self):
+        """Charts as write_library() input (copies, independent of the map)"""
+        return [{'id': c['id'], 'brand': c['brand'], 'lot': c['lot'],
+                 'mapping': {a: [(lbl, np.array(lab)) for lbl, lab in levels]
+                             for a, levels in self.mapping(c['id']).items()}}
+                for c in self._charts.values()]
+
+    def close(self):
+        mm = getattr(self.swatches, '_mmap', None)
+        self.swatches = np.empty((0, 3), dtype='<f4')
+        self._index = None
+        if mm is not None:
+            mm.close()
+
+
+def _existing_charts(path):
+    if not os.path.exists(path):
+        return []
+    library = ReferenceLibrary(path)
+    try:
+        return library.to_charts()
+    finally:
+        library.close()
+
+
+@contextlib.contextmanager
+def _library_lock(path):
+    """
+    Exclusive lock on <path>.lock, held while a library is read and rewritten
+
+    Without it two concurrent add/remove calls both read the old charts and the
+    last writer silently drops the other's change. Readers don't need it: the
+    file is replaced atomically.
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(path + ".lock", "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def add_chart(path, chart_id, mapping, brand=None, lot=None, replace=False):
+    """Add (or with replace=True, overwrite) one chart; the file is rewritten compactly"""
+    with _library_lock(path):
+        charts = _existing_charts(path)
+        if any(c['id'] == chart_id for c in charts):
+            if not replace:
+                raise ValueError(f"Chart already in library: {chart_id}")
+            charts = [c for c in charts if c['id'] != chart_id]
+        charts.append({'id': chart_id, 'brand': brand, 'lot': lot, 'mapping': mapping})
+        return write_library(path, charts)
+
+
+def remove_chart(path, chart_id):
+    """Remove one chart; its swatches are dropped from the rewritten file"""
+    with _library_lock(path):
+        charts = _existing_charts(path)
+        if not any(c['id'] == chart_id for c in charts):
+            raise KeyError(f"Chart not in library: {chart_id}")
+        return write_library(path, [c for c in charts if c['id'] != chart_id])
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Manage the on-disk reference library")
+    parser.add_argument('--library', default=DEFAULT_LIBRARY_PATH, help="Library file")
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('list', help="List the charts in the library")
+    add = sub.add_parser('add', help="Add a chart from a calibration artifact (.npz, see build_calibration.py)")
+    add.add_argument('artifact')
+    add.add_argument('--id', required=True, help="Chart id, e.g. brand/lot")
+    add.add_argument('--brand')
+    add.add_argument('--lot')
+    add.add_argument('--replace', action='store_true', help="Overwrite a chart with the same id")
+    remove = sub.add_parser('remove', help="Remove a chart")
+    remove.add_argument('id')
+    args = parser.parse_args()
+
+    if args.command == 'add':
+        from urine_diagnosis import load_reference_mapping
+        mapping, _ = load_reference_mapping(args.artifact)
+        add_chart(args.library, args.id, mapping, brand=args.brand, lot=args.lot, replace=args.replace)
+        print(f"✓ Added {args.id} ({sum(len(l) for l in mapping.values())} swatches)")
+    elif args.command == 'remove':
+        remove_chart(args.library, args.id)
+        print(f"✓ Removed {args.id}")
+
+    if not os.path.exists(args.library):
+        print(f"No library at {args.library}")
+    else:
+        library = ReferenceLibrary(args.library)
+        print(f"📁 {args.library}: {len(library.charts)} charts, {len(library)} swatches, "
+              f"{os.path.getsize(args.library)} bytes")
+        for chart_id in library.charts:
+            info = library.chart_info(chart_id)
+            print(f"  {chart_id}: brand={info['brand']} lot={info['lot']} "
+                  f"levels={sum(info['analytes'].values())} analytes={len(info['analytes'])}")
+        library.close()
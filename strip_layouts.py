@@ -0,0 +1,175 @@
+import json
+import os
+import cv2
+import numpy as np
+from pad_segmentation import PROFILE_LEN, strip_profiles
+
+# Strip layouts per brand/product; edit the JSON to add a strip type
+DEFAULT_LAYOUTS_PATH = os.environ.get(
+    "KAELION_LAYOUTS_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "strip_layouts.json"))
+
+# Relative template scales tried by fit_layout (strip crop tighter/looser than nominal)
+FIT_SCALES = (0.88, 0.94, 1.0, 1.06, 1.12)
+
+
+class StripLayout:
+    """Pad arrangement of one strip type, in coordinates relative to the strip length"""
+
+    def __init__(self, name, analytes, pad_centers, pad_height, description=""):
+        if len(analytes) != len(pad_centers):
+            raise ValueError(f"Layout {name}: {len(analytes)} analytes but {len(pad_centers)} pad centers")
+        self.name = name
+        self.description = description
+        self.analytes = list(analytes)
+        self.pad_centers = np.asarray(pad_centers, dtype=np.float64)
+        # one height for all pads or one per pad
+        self.pad_heights = np.broadcast_to(np.asarray(pad_height, dtype=np.float64),
+                                           self.pad_centers.shape).copy()
+
+    @property
+    def pad_count(self):
+        return len(self.analytes)
+
+    def template(self, length, scale=1.0):
+        """
+        Expected lightness profile over `length` samples: -1 on pads, +1 on the backing
+
+        With scale != 1 the layout is stretched about the strip center.
+        """
+        y = (np.arange(length) + 0.5) / length
+        t = np.ones(length, dtype=np.float32)
+        for c, ph in zip(self.pad_centers, self.pad_heights):
+            c = 0.5 + (c - 0.5) * scale
+            half = ph * scale / 2
+            t[(y >= c - half) & (y < c + half)] = -1.0
+        return t
+
+    def pad_boxes(self, h, w, offset=0.0, scale=1.0):
+        """Pad boxes (x, y, w, h) for a strip crop of h x w, top to bottom"""
+        pads = []
+        for c, ph in zip(self.pad_centers, self.pad_heights):
+            cy = (0.5 + (c - 0.5) * scale + offset) * h
+            half = ph * scale * h / 2
+            y0 = int(max(0, round(cy - half)))
+            y1 = int(min(h, round(cy + half)))
+            pads.append((0, y0, w, max(0, y1 - y0)))
+        return pads
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'analytes': self.analytes,
+            'pad_centers': self.pad_centers.tolist(),
+            'pad_heights': self.pad_heights.tolist(),
+        }
+
+
+_layouts_cache = {}
+
+
+def load_layouts(path=DEFAULT_LAYOUTS_PATH):
+    """
+    Load the layout registry from a JSON file
+
+    Returns (layouts, default_name) where layouts maps name -> StripLayout.
+    The file is parsed once per path.
+    """
+    path = os.path.abspath(path)
+    if path not in _layouts_cache:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        layouts = {
+            name: StripLayout(name, spec["analytes"], spec["pad_centers"], spec["pad_height"],
+                              spec.get("description", ""))
+            for name, spec in config["layouts"].items()
+        }
+        default = config.get("default", next(iter(layouts)))
+        _layouts_cache[path] = (layouts, default)
+    return _layouts_cache[path]
+
+
+def get_layout(name=None, path=DEFAULT_LAYOUTS_PATH):
+    """Look up a layout by name (None for the registry's default)"""
+    layouts, default = load_layouts(path)
+    name = name or default
+    if name not in layouts:
+        raise KeyError(f"Unknown strip layout '{name}'. Available: {', '.join(layouts)}")
+    return layouts[name]
+
+
+def fit_layout(profile, layout, scales=FIT_SCALES, max_shift=0.1, templates=None):
+    """
+    Fit a layout template to one lightness profile
+
+    The profile is edge-padded by max_shift of its length and every scaled
+    template is slid over it with one normalized cross-correlation pass
+    (cv2.matchTemplate) per scale. Pass templates ({scale: layout.template(n, scale)})
+    to reuse them across many profiles of the same length.
+
+    Returns (offset, scale, score): offset is the shift of the strip center as a
+    fraction of the strip length, score the correlation coefficient in [-1, 1].
+    """
+    n = len(profile)
+    margin = int(round(max_shift * n))
+    padded = np.pad(np.asarray(profile, dtype=np.float32), margin, mode='edge')[None, :]
+    best = (0.0, 1.0, -1.0)
+    for scale in scales:
+        template = templates[scale] if templates is not None else layout.template(n, scale)
+        template = template[None, :]
+        scores = cv2.matchTemplate(padded, template, cv2.TM_CCOEFF_NORMED).ravel()
+        i = int(np.argmax(scores))
+        if scores[i] > best[2]:
+            best = ((i - margin) / n, scale, float(scores[i]))
+    return best
+
+
+def localize_pads_batch(strips, layout, min_score=0.3, scales=FIT_SCALES, max_shift=0.1,
+                        profile_len=PROFILE_LEN):
+    """
+    Pad boxes for a batch of strip crops by fitting the layout template
+
+    Strips whose best fit scores below min_score get the nominal layout
+    (offset 0, scale 1) instead of a heuristic fallback.
+
+    Returns:
+        One list of (x, y, w, h) pad boxes per strip, in layout.analytes order
+    """
+    if len(strips) == 0:
+        return []
+    profiles = strip_profiles(strips, profile_len)
+    profiles = cv2.GaussianBlur(profiles, (7, 1), sigmaX=1.5, sigmaY=0, borderType=cv2.BORDER_REPLICATE)
+    templates = {scale: layout.template(profile_len, scale) for scale in scales}
+    results = []
+    for strip, profile in zip(strips, profiles):
+        h, w = strip.shape[:2]
+        offset, scale, score = fit_layout(profile, layout, scales, max_shift, templates)
+        if score < min_score:
+            offset, scale = 0.0, 1.0
+        results.append(layout.pad_boxes(h, w, offset, scale))
+    return results
+
+
+if __name__ == "__main__":
+    import time
+    from pad_segmentation import _synthetic_strip, segment_pads_batch
+
+    layout = get_layout("urs_10")
+    rng = np.random.default_rng(0)
+    strips, truth = zip(*[_synthetic_strip(rng, layout.pad_count) for _ in range(1000)])
+
+    def located(results):
+        hits = 0
+        for pads, centers, strip in zip(results, truth, strips):
+            found = np.array([y + h / 2 for _, y, _, h in pads])
+            hits += int(np.all(np.abs(found - centers) < 0.25 * strip.shape[0] / len(centers)))
+        return hits
+
+    for name, fn in [("template", lambda s: localize_pads_batch(s, layout)),
+                     ("minima", lambda s: segment_pads_batch(s, layout.pad_count))]:
+        start = time.perf_counter()
+        results = fn(list(strips))
+        elapsed = time.perf_counter() - start
+        print(f"{name:8s}: {elapsed/len(strips)*1000:.3f} ms/strip over {len(strips)} crops, "
+              f"all pads located: {located(results)}/{len(strips)}")
@@ -5,7 +5,7 @@ Windows-compatible urine strip diagnosis pipeline.
 
 - Detection: YOLOv8 (ultralytics)
 - Calibration: extract reference chart patch colors from provided image or live camera
-- Normalization: simple white-balance + scale using chart
+- Normalization: 3x4 affine LAB correction fitted on the chart patches, applied to pad means
 - Matching: mean patch LAB -> CIEDE2000 to nearest reference patch
 - Diagnosis: direct, rule-based outputs (no 'possible'), per-user mapping derived from typical dipstick meanings
 
@@ -23,9 +23,16 @@ import cv2
 import numpy as np
 import math
 import time
-from ultralytics import YOLO
-from sklearn.cluster import KMeans
-from skimage import color, filters, morphology, measure
+import os
+import hashlib
+# ultralytics and scikit-learn are imported inside the functions that use
+# them: importing them here costs seconds of start-up time.
+from pad_sampling import sample_pad_colors
+from pad_segmentation import segment_pads_batch
+from strip_layouts import get_layout, localize_pads_batch
+from pad_aggregator import PadAggregator
+from calibration_monitor import CalibrationMonitor
+from color_correction import MAX_FIT_RESIDUAL, apply_color_correction
 
 # -----------------------
 # CONFIG
@@ -34,6 +41,35 @@ from skimage import color, filters, morphology, measure
 YOLO_MODEL_PATH = "runs/detect/train/weights/best.pt"  
 # Reference chart image (Windows path style - forward slashes work)
 CALIBRATION_IMAGE_PATH = "C:/Users/hp/Documents/Kaelion-AI/reference_chart2.png"
+# Precomputed mapping for the bundled reference_chart2.png (python build_calibration.py)
+DEFAULT_CALIBRATION_ARTIFACT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                            "reference_chart2_calibration.npz")
+# Frame rate the live loop should hold; None disables adaptive quality
+# (inference size, detection skip and diagnosis cadence are lowered when too slow)
+TARGET_FPS = None
+# Pad color statistic: "mean" (original behaviour), or "trimmed"/"median" which
+# drop highlight and shadow pixels per pad (see pad_sampling.py)
+PAD_STATISTIC = "mean"
+# Strip type from strip_layouts.json and how pads are located on it:
+# "minima" searches for pad valleys (faster and more reliable on synthetic strips,
+# see strip_layouts.py), "template" fits the layout to the strip profile
+STRIP_LAYOUT = "urs_10"
+PAD_LOCALIZATION = "minima"
+# Pad readings are aggregated over frames (median of the last N) and matched
+# again only when they move by more than REMATCH_DELTA (LAB units)
+AGGREGATION_WINDOW = 8
+REMATCH_DELTA = 3.0
+# Median LAB distance between sampled live chart patches and the reference above
+# which the chart is re-clustered (in the background)
+CALIBRATION_DRIFT_THRESHOLD = 8.0
+# "grid": sample the known patch grid of the bundled chart through a homography,
+# falling back to "clustering" (KMeans over all pixels) when the fit fails
+CALIBRATION_MODE = "grid"
+# Level matching metric ("ciede2000", "cie94", "cie76"; thresholds below are tuned
+# for ciede2000) and strategy: "fast_then_verify" ranks levels by CIE76 and runs
+# the metric only for ambiguous pads (see level_matcher.py)
+MATCH_METRIC = "ciede2000"
+MATCH_STRATEGY = "exact"
 
 # Detection class labels that YOLO will output (must match what you trained)
 # Make sure your YOLO model was trained to label the reference chart and the strip as shown here
@@ -57,7 +93,8 @@ DIAGNOSIS_TEXT = {
     "SpecificGravity": "Abnormal urine concentration - check hydration or kidney function",
     "Ketone": "Ketones present - abnormal fat metabolism (check for diabetes/ketoacidosis)",
     "Bilirubin": "Bilirubin present - possible liver dysfunction or bile duct problem",
-    "Glucose": "Glucosuria - elevated urinary glucose (suggestive of diabetes)"
+    "Glucose": "Glucosuria - elevated urinary glucose (suggestive of diabetes)",
+    "AscorbicAcid": "Ascorbic acid present - may mask blood, glucose and nitrite results"
 }
 
 # Matching thresholds and tuning
@@ -146,6 +183,7 @@ def extract_patches_from_chart_image(img_bgr, expected_patches=30):
     Extract candidate color patches from a reference chart image.
     Returns list of dict { 'bbox':(x,y,w,h), 'lab':array(L,a,b), 'mean_bgr':(b,g,r) }.
     """
+    from sklearn.cluster import KMeans
     img = img_bgr.copy()
     h, w = img.shape[:2]
     blur = cv2.GaussianBlur(img, (3,3), 0)
@@ -185,11 +223,23 @@ def prepare_reference_mapping(img_path, expected_rows=10):
     img = cv2.imread(img_path)
     if img is None:
         raise FileNotFoundError(f"Chart image not found: {img_path}")
+    return prepare_reference_mapping_from_image(img, expected_rows=expected_rows)
+
+def prepare_reference_mapping_from_image(img, expected_rows=10, return_boxes=False):
+    """
+    Same as prepare_reference_mapping() for an already-loaded chart image or live chart ROI.
+    With return_boxes=True also returns analyte -> (n_levels, 4) float32 array of patch boxes
+    (x, y, w, h) normalized to the image size, in level order (used by the drift monitor).
+    """
+    from sklearn.cluster import KMeans
     patches = extract_patches_from_chart_image(img, expected_patches=40)
     if not patches:
         raise RuntimeError("No patches found in chart image - try a clearer crop.")
     # cluster patch y centers into expected_rows
     centers = np.array([p['bbox'][1] + p['bbox'][3]/2 for p in patches]).reshape(-1,1)
+    img_h, img_w = img.shape[:2]
+    norm = np.array([img_w, img_h, img_w, img_h], dtype=np.float32)
+    boxes = {}
     # if not enough patches, fallback: group evenly into rows
     try:
         km = KMeans(n_clusters=min(expected_rows, max(2, len(patches))), random_state=0).fit(centers)
@@ -211,7 +261,7 @@ def prepare_reference_mapping(img_path, expected_rows=10):
                 labvec = p['lab']
                 levels.append((label, labvec))
             mapping[analyte] = levels
-        return mapping
+            boxes[analyte] = np.array([p['bbox'] for p in plist_sorted], dtype=np.float32).reshape(-1, 4) / norm
     except Exception as e:
         # fallback: evenly split list into rows
         mapping = {}
@@ -223,7 +273,98 @@ def prepare_reference_mapping(img_path, expected_rows=10):
             slice_patches = patches[slice_start:slice_end]
             levels = [(f"level_{j}", p['lab']) for j,p in enumerate(slice_patches)]
             mapping[analyte] = levels
-        return mapping
+            boxes[analyte] = np.array([p['bbox'] for p in slice_patches], dtype=np.float32).reshape(-1, 4) / norm
+    if return_boxes:
+        return mapping, boxes
+    return mapping
+
+# -----------------------
+# Precomputed calibration artifact (.npz)
+# -----------------------
+def _file_sha1(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def save_reference_mapping(mapping, out_path, source_path=None, boxes=None):
+    """
+    Store a mapping (analyte -> list of (level_label, lab_vector)) as a small .npz.
+    If source_path is given, its SHA-1 is stored so the artifact is only reused for that exact chart image.
+    boxes (analyte -> normalized patch boxes, see prepare_reference_mapping_from_image) are stored too when given.
+    """
+    analytes = list(mapping.keys())
+    labels, labs, counts = [], [], []
+    for analyte in analytes:
+        levels = mapping[analyte]
+        counts.append(len(levels))
+        for lbl, labvec in levels:
+            labels.append(lbl)
+            labs.append(np.asarray(labvec, dtype=np.float32).reshape(3))
+    np.savez_compressed(
+        out_path,
+        analytes=np.array(analytes, dtype=str),
+        level_counts=np.array(counts, dtype=np.int32),
+        labels=np.array(labels, dtype=str),
+        labs=np.array(labs, dtype=np.float32).reshape(-1, 3),
+        source_sha1=np.array(_file_sha1(source_path) if source_path else ""),
+        **({'boxes': np.concatenate([np.asarray(boxes[a], np.float32).reshape(-1, 4) for a in analytes])}
+           if boxes is not None else {}),
+    )
+
+def load_reference_mapping(npz_path):
+    """Load a mapping written by save_reference_mapping(). Returns (mapping, source_sha1)."""
+    data = np.load(npz_path, allow_pickle=False)
+    mapping = {}
+    start = 0
+    for analyte, count in zip(data["analytes"], data["level_counts"]):
+        count = int(count)
+        mapping[str(analyte)] = [(str(lbl), data["labs"][start + j].astype(float))
+                                 for j, lbl in enumerate(data["labels"][start:start+count])]
+        start += count
+    return mapping, str(data["source_sha1"])
+
+def load_reference_boxes(npz_path):
+    """Normalized patch boxes (analyte -> (n_levels, 4)) stored in the artifact, or None for older artifacts."""
+    data = np.load(npz_path, allow_pickle=False)
+    if "boxes" not in data.files:
+        return None
+    boxes = {}
+    start = 0
+    for analyte, count in zip(data["analytes"], data["level_counts"]):
+        boxes[str(analyte)] = data["boxes"][start:start+int(count)]
+        start += int(count)
+    return boxes
+
+def get_reference_calibration(img_path, expected_rows=10, artifact_path=DEFAULT_CALIBRATION_ARTIFACT):
+    """
+    Like prepare_reference_mapping(), but returns the precomputed mapping when the artifact was
+    built from this exact chart image, so the default chart never needs clustering at runtime.
+    Returns (mapping, boxes); boxes may be None for artifacts built without patch boxes.
+    """
+    if artifact_path and os.path.exists(artifact_path) and os.path.exists(img_path):
+        try:
+            mapping, source_sha1 = load_reference_mapping(artifact_path)
+            if source_sha1 and source_sha1 == _file_sha1(img_path):
+                return mapping, load_reference_boxes(artifact_path)
+        except Exception as e:
+            print("Warning: could not use precomputed calibration:", e)
+    img = cv2.imread(img_path)
+    if img is None:
+        raise FileNotFoundError(f"Chart image not found: {img_path}")
+    return prepare_reference_mapping_from_image(img, expected_rows=expected_rows, return_boxes=True)
+
+def get_reference_mapping(img_path, expected_rows=10, artifact_path=DEFAULT_CALIBRATION_ARTIFACT):
+    """Mapping part of get_reference_calibration()."""
+    return get_reference_calibration(img_path, expected_rows, artifact_path)[0]
+
+def load_default_calibration(expected_rows=10):
+    """(mapping, boxes) for CALIBRATION_IMAGE_PATH, served from the precomputed artifact whenever possible."""
+    if os.path.exists(DEFAULT_CALIBRATION_ARTIFACT) and not os.path.exists(CALIBRATION_IMAGE_PATH):
+        return load_reference_mapping(DEFAULT_CALIBRATION_ARTIFACT)[0], load_reference_boxes(DEFAULT_CALIBRATION_ARTIFACT)
+    return get_reference_calibration(CALIBRATION_IMAGE_PATH, expected_rows=expected_rows)
+
+def load_default_reference_mapping(expected_rows=10):
+    """Mapping for CALIBRATION_IMAGE_PATH, served from the precomputed artifact whenever possible."""
+    return load_default_calibration(expected_rows)[0]
 
 # -----------------------
 # Strip segmentation (pad detection)
@@ -231,45 +372,32 @@ def prepare_reference_mapping(img_path, expected_rows=10):
 def segment_strip_into_pads(strip_img, expected_pads=10):
     """
     Given a cropped strip ROI, return a list of pad boxes (x,y,w,h) divided top-to-bottom.
-    Approach: convert to LAB, use vertical intensity changes to find boundaries. Fallback to even split.
+    Approach: LAB lightness profile, one smoothing pass and a local-minimum search
+    (see pad_segmentation.py). Fallback to even split.
     """
-    img = strip_img.copy()
-    h, w = img.shape[:2]
-    small = cv2.resize(img, (max(20, w//2), max(20, h//2)))
-    lab = cv2.cvtColor(small, cv2.COLOR_BGR2LAB)
-    L = lab[:,:,0].astype(float)
-    proj = np.mean(L, axis=1)  # across width
-    smooth = filters.gaussian(proj, sigma=3)
-    grad = np.abs(np.gradient(smooth))
-    thr = np.mean(grad) + 0.5*np.std(grad)
-    idxs = np.where(grad > thr)[0]
-    # up-scale to original coordinates
-    idxs_full = sorted(list(set([int(i*(h/smooth.shape[0])) for i in idxs])))
-    if len(idxs_full) < expected_pads-1:
-        # fallback: even split top-to-bottom
-        ph = h // expected_pads
-        pads = [(0, i*ph, w, ph if i < expected_pads-1 else h - i*ph) for i in range(expected_pads)]
-        return pads
-    # build pad centers using local minima in projection
-    minima = measure.find_peaks_cwt(-smooth, widths=np.arange(3,25))
-    minima_coords = [int(m*(h/smooth.shape[0])) for m in minima if 0 < m < smooth.shape[0]]
-    if len(minima_coords) >= expected_pads:
-        minima_coords = minima_coords[:expected_pads]
-        pad_half = int(h/(2*expected_pads))
-        pads = []
-        for c in minima_coords:
-            y0 = max(0, c - pad_half)
-            y1 = min(h, c + pad_half)
-            pads.append((0, y0, w, y1-y0))
-        return pads
-    # fallback even split
-    ph = h // expected_pads
-    pads = [(0, i*ph, w, ph if i < expected_pads-1 else h - i*ph) for i in range(expected_pads)]
-    return pads
+    return segment_pads_batch([strip_img], expected_pads=expected_pads)[0]
 
 # -----------------------
 # Matching and interpretation
 # -----------------------
+def match_pad_labs(pad_labs, analytes, ref_map, matcher=None):
+    """
+    Match an (N,3) array of pad LAB values (NaN rows for missing pads) to the
+    reference levels of each analyte. Returns analyte -> (best_label, distance).
+    A level_matcher.LevelMatcher replaces the CIEDE2000 scan when given.
+    """
+    if matcher is not None:
+        return matcher.match_pad_labs(pad_labs, analytes, ref_map)
+    match_results = {}
+    for analyte, mean_lab in zip(analytes, pad_labs):
+        refs = ref_map.get(analyte, [])
+        if np.isnan(mean_lab).any() or not refs:
+            match_results[analyte] = (None, float('inf'))
+            continue
+        # find best among analyte's levels
+        match_results[analyte] = match_lab_to_levels(mean_lab, refs)
+    return match_results
+
 def match_lab_to_levels(lab_vec, reference_levels):
     """
     Given a mean LAB vector for a pad, compare to reference_levels list:
@@ -335,26 +463,61 @@ def interpret_match_labels(match_dict):
 # MAIN pipeline
 # -----------------------
 def main():
+    from model_registry import get_model
     print("Loading YOLO model:", YOLO_MODEL_PATH)
-    ymodel = YOLO(YOLO_MODEL_PATH)  # will use CPU/GPU according to ultralytics installation
+    # loaded once per process and warmed up before the camera loop starts, at every
+    # size the adaptive quality controller may switch to
+    warmup_sizes = (640,)
+    if TARGET_FPS is not None:
+        from quality_controller import quality_sizes
+        warmup_sizes = quality_sizes()
+    ymodel = get_model(YOLO_MODEL_PATH, warmup_sizes=warmup_sizes).model  # will use CPU/GPU according to ultralytics installation
     print("YOLO model loaded. Labels:", ymodel.names)
+    layout = get_layout(STRIP_LAYOUT)
+    print(f"Strip layout: {layout.name} ({layout.pad_count} pads, {PAD_LOCALIZATION} localization)")
 
     # prepare calibration mapping from static image if available
     print("Preparing reference mapping from image (if available)...")
     try:
-        ref_map = prepare_reference_mapping(CALIBRATION_IMAGE_PATH, expected_rows=len(ANALYTE_ORDER))
+        ref_map, ref_boxes = load_default_calibration(expected_rows=len(ANALYTE_ORDER))
         print("Reference mapping prepared for analytes:", list(ref_map.keys()))
         calibrated = True
     except Exception as e:
         print("Warning: failed to prepare mapping from image:", e)
-        ref_map = {}
+        ref_map, ref_boxes = {}, None
         calibrated = False
+    # samples known patches of the chart in view; re-clusters in the background only on drift
+    monitor = CalibrationMonitor(ref_map, ref_boxes, prepare_reference_mapping_from_frame,
+                                 drift_threshold=CALIBRATION_DRIFT_THRESHOLD,
+                                 refit_threshold=MAX_FIT_RESIDUAL)
 
     cap = cv2.VideoCapture(0)
     if not cap.isOpened():
         raise RuntimeError("Could not open webcam. Check device ID and camera permissions.")
 
-    last_cal = 0
+    controller = None
+    if TARGET_FPS is not None:
+        from quality_controller import AdaptiveQualityController
+        controller = AdaptiveQualityController(target_fps=TARGET_FPS)
+    frame_index = 0
+    dets = []
+    match_results, diagnoses = None, []
+    aggregator = PadAggregator(window=AGGREGATION_WINDOW, rematch_threshold=REMATCH_DELTA)
+    calibration_version = monitor.version
+
+    matcher = None
+    if (MATCH_METRIC, MATCH_STRATEGY) != ("ciede2000", "exact"):
+        from level_matcher import LevelMatcher
+        matcher = LevelMatcher(MATCH_METRIC, MATCH_STRATEGY)
+
+    def match_and_interpret(pad_labs):
+        # the aggregator keeps raw readings; the current lighting correction from the
+        # chart is applied to the aggregate, so a refit doesn't discard the readings
+        pad_labs = apply_color_correction(pad_labs, monitor.correction)
+        results = match_pad_labs(pad_labs, layout.analytes, ref_map, matcher)
+        return results, interpret_match_labels(results)[0]
+    fps, fps_counter, fps_start = 0.0, 0, time.time()
+
     print("Press 'c' to force calibration from webcam (place chart clearly); 'q' to quit.")
     while True:
         ret, frame = cap.read()
@@ -362,9 +525,15 @@ def main():
             continue
 
         # run YOLO on the frame - ultralytics returns results object
-        results = ymodel.predict(source=frame, conf=0.35, verbose=False)
+        # (under adaptive quality, skipped frames reuse the previous detections)
+        run_detect = controller is None or controller.should_detect(frame_index)
+        t0 = time.perf_counter()
+        results = []
+        if run_detect:
+            imgsz = controller.imgsz if controller is not None else 640
+            results = ymodel.predict(source=frame, conf=0.35, imgsz=imgsz, verbose=False)
+            dets = []
         # results is a list; on single image use results[0]
-        dets = []
         if len(results) > 0:
             r = results[0]
             boxes = r.boxes
@@ -376,6 +545,8 @@ def main():
                     cls = int(b.cls[0])
                     label = ymodel.names[cls] if cls < len(ymodel.names) else str(cls)
                     dets.append({'label': label, 'bbox': (x1,y1,x2-x1,y2-y1), 'conf': conf})
+        if controller is not None:
+            controller.record("detect", time.perf_counter() - t0)
 
         # check keyboard
         key = cv2.waitKey(1) & 0xFF
@@ -390,59 +561,54 @@ def main():
         chart_box = next((d for d in dets if d['label'] == REF_LABEL), None)
         strip_box = next((d for d in dets if d['label'] == STRIP_LABEL), None)
 
-        # calibrate if chart found or user forced
-        if (chart_box is not None or force_cal) and (time.time() - last_cal > 1.5):
-            last_cal = time.time()
-            try:
-                if chart_box is not None:
-                    x,y,w,h = chart_box['bbox']
-                    roi = frame[y:y+h, x:x+w]
+        # calibration: check drift on the chart in view, or recalibrate when the user forces it
+        if chart_box is not None:
+            x,y,w,h = chart_box['bbox']
+            roi = frame[y:y+h, x:x+w]
+            if roi.size > 0:
+                if force_cal:
+                    monitor.request_recalibration(roi)
                 else:
-                    roi = cv2.imread(CALIBRATION_IMAGE_PATH)
-                    if roi is None:
-                        print("Calibration image not found; aborting calibration.")
-                        roi = None
-                if roi is not None:
-                    print("Extracting patches from calibration ROI...")
-                    mapping = prepare_reference_mapping_from_img(roi=None) if False else prepare_reference_mapping(CALIBRATION_IMAGE_PATH, expected_rows=len(ANALYTE_ORDER))
-                    if mapping:
-                        ref_map = mapping
-                        calibrated = True
-                        print("Calibration successful. Mapped analytes:", list(ref_map.keys()))
+                    monitor.observe(roi)
+        elif force_cal:
+            try:
+                ref_map, ref_boxes = load_default_calibration(expected_rows=len(ANALYTE_ORDER))
+                monitor.set_calibration(ref_map, ref_boxes)
+                calibrated = True
+                print("Calibration successful. Mapped analytes:", list(ref_map.keys()))
             except Exception as e:
                 print("Calibration failed:", e)
+        mapping = monitor.poll()
+        if mapping:
+            ref_map = mapping
+            calibrated = True
+        if monitor.version != calibration_version:
+            # new reference or color correction: keep the raw readings, match them again
+            calibration_version = monitor.version
+            aggregator.invalidate()
+        if monitor.last_drift is not None:
+            cv2.putText(frame, f"Chart drift: {monitor.last_drift:.1f}", (frame.shape[1]-200, 20),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5, (200,200,200), 1)
 
         # if we have a strip and mapping, perform pad extraction & matching
         if strip_box is not None and calibrated:
-            x,y,w,h = strip_box['bbox']
-            strip_roi = frame[y:y+h, x:x+w]
-            pads = segment_strip_into_pads(strip_roi, expected_pads=len(ANALYTE_ORDER))
-            match_results = {}
-            # for each pad, compute mean LAB and match to reference set for that analyte
-            for idx, pad in enumerate(pads):
-                px, py, pw, ph = pad
-                crop = strip_roi[py:py+ph, px:px+pw]
-                if crop.size == 0:
-                    match_results[ANALYTE_ORDER[idx]] = (None, float('inf'))
-                    continue
-                # sample inner region to avoid borders
-                ch, cw = crop.shape[:2]
-                inner = crop[int(0.15*ch):int(0.85*ch), int(0.15*cw):int(0.85*cw)]
-                if inner.size == 0:
-                    inner = crop
-                mean_bgr = cv2.mean(inner)[:3]
-                mean_lab = cv2.cvtColor(np.uint8([[mean_bgr]]), cv2.COLOR_BGR2LAB).reshape(3).astype(float)
-                analyte = ANALYTE_ORDER[idx]
-                refs = ref_map.get(analyte, [])
-                if not refs:
-                    match_results[analyte] = (None, float('inf'))
-                    continue
-                # find best among analyte's levels
-                best_lbl, best_d = match_lab_to_levels(mean_lab, refs)
-                match_results[analyte] = (best_lbl, best_d)
-
-            # interpret matches -> diagnosis list
-            diagnoses, confidences = interpret_match_labels(match_results)
+            run_diagnose = controller is None or match_results is None or controller.should_diagnose(frame_index)
+            t0 = time.perf_counter()
+            if run_diagnose:
+                x,y,w,h = strip_box['bbox']
+                strip_roi = frame[y:y+h, x:x+w]
+                if PAD_LOCALIZATION == "template":
+                    pads = localize_pads_batch([strip_roi], layout)[0]
+                else:
+                    pads = segment_strip_into_pads(strip_roi, expected_pads=layout.pad_count)
+                # LAB of every pad in one vectorized pass; matching and interpretation
+                # only re-run when the aggregated reading moves
+                pad_labs = sample_pad_colors(strip_roi, pads, statistic=PAD_STATISTIC)
+                (match_results, diagnoses), settled = aggregator.update(pad_labs, match_and_interpret)
+                if settled:
+                    print("Reading settled:", "; ".join(diagnoses) if diagnoses else "no abnormal findings")
+            if controller is not None:
+                controller.record("diagnose", time.perf_counter() - t0)
             # overlay detection & diagnosis on frame
             # draw boxes
             for d in dets:
@@ -456,7 +622,11 @@ def main():
             # overlay diagnoses
             for j, line in enumerate(diagnoses[:6]):
                 cv2.putText(frame, line, (10, 250 + j*20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,0,255), 2)
+            if aggregator.settled:
+                cv2.putText(frame, "SETTLED", (10, 250 + 6*20), cv2.FONT_HERSHEY_SIMPLEX, 0.6, (0,255,0), 2)
         else:
+            match_results = None  # strip lost: diagnose fresh when it comes back
+            aggregator.miss()
             # draw detection boxes if any
             for d in dets:
                 bx, by, bw, bh = d['bbox']
@@ -467,15 +637,44 @@ def main():
         cv2.putText(frame, "Press c=calibrate (chart), q=quit", (10, frame.shape[0]-10), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (200,200,200), 1)
         cv2.imshow("Urine Strip Diagnosis (Kaelion-AI)", frame)
 
+        # FPS measurement drives the adaptive quality level
+        frame_index += 1
+        fps_counter += 1
+        elapsed = time.time() - fps_start
+        if elapsed > 1.0:
+            fps = fps_counter / elapsed
+            fps_counter, fps_start = 0, time.time()
+        if controller is not None:
+            controller.end_frame()
+            if fps_counter == 0:
+                controller.update(fps)
+
+    if matcher is not None and matcher.conclusive_rate is not None:
+        print(f"Level matching: {matcher.stats['matches']} matches, "
+              f"{matcher.conclusive_rate:.0%} decided by CIE76 alone")
+    monitor.close()
     cap.release()
     cv2.destroyAllWindows()
 
 # -----------------------
-# small helper to support earlier fallback path (not used)
+# Live chart recalibration (runs on the CalibrationMonitor worker thread)
 # -----------------------
+def _cluster_chart(img):
+    return prepare_reference_mapping_from_image(img, expected_rows=len(ANALYTE_ORDER), return_boxes=True)
+
 def prepare_reference_mapping_from_frame(frame):
-    """Wrapper to use the already-captured frame/ROI for patch extraction (not currently used)."""
-    return prepare_reference_mapping(CALIBRATION_IMAGE_PATH, expected_rows=len(ANALYTE_ORDER))
+    """
+    Calibrate from the chart ROI cropped from the live frame. Returns (mapping, normalized patch boxes).
+    With CALIBRATION_MODE = "grid" the known patch grid of the bundled chart is sampled through a
+    homography (chart_grid.py); clustering is the fallback.
+    """
+    from chart_grid import calibrate_chart
+    ref_map, ref_boxes = {}, None
+    if os.path.exists(DEFAULT_CALIBRATION_ARTIFACT):
+        ref_map = load_reference_mapping(DEFAULT_CALIBRATION_ARTIFACT)[0]
+        ref_boxes = load_reference_boxes(DEFAULT_CALIBRATION_ARTIFACT)
+    mapping, boxes, _ = calibrate_chart(frame, ref_map, ref_boxes, _cluster_chart, mode=CALIBRATION_MODE)
+    return mapping, boxes
 
 
 if __name__ == "__main__":